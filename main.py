@@ -6,6 +6,7 @@ import random
 import os
 import json
 import signal
+import argparse
 from typing import Optional
 
 try:
@@ -13,12 +14,20 @@ try:
     load_dotenv()
 except ImportError:
     pass
-from src.config_loader import load_config, load_creators
+from src.config_loader import load_config, load_creators, resolve_encoding_profile
 from src.tiktok_api import fetch_posts, sort_posts_chronologically, Post
 from src.downloader import download_post, PostInaccessibleError
 from src.core.state import StateStore
 from src.telegram_uploader import TelegramUploader
 from src.cookie_manager import CookieManager
+from src.rate_limit import tiktok_limiter, tiktok_budget, tiktok_rate
+from src import ytdl_pool
+from src.scheduler import PollScheduler
+from src.media_store import MediaStore
+from src.transcode import EncodingProfile
+from src.transcode_pool import transcode_scheduler
+from src.governor import governor
+from src.photos import photo_normalizer
 
 # Global shutdown event for graceful shutdown
 _shutdown_event: Optional[asyncio.Event] = None
@@ -40,18 +49,12 @@ def _setup_signal_handlers():
             signal.signal(sig, _signal_handler)
 
 
-def get_retry_delay(attempt: int, is_ip_blocked: bool = False) -> float:
-    """Calculate retry delay with exponential backoff."""
-    base_delay = 5.0
-    if is_ip_blocked:
-        # Longer delays for IP-blocked scenarios
-        return min(300, base_delay * (2 ** attempt))  # Max 5 minutes
-    else:
-        return min(60, base_delay * (2 ** attempt))  # Max 60 seconds
-
 # Bot metadata (hardcoded for startup banner)
 BOT_NAME = "Tok2Gram"
 BOT_VERSION = "1.0.0"
+# Defaults for --config / --creators
+CONFIG_PATH = "config.yaml"
+CREATORS_PATH = "creators.yaml"
 
 # Configure logging
 logging.basicConfig(
@@ -64,7 +67,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger("tok2gram")
 
-async def upload_worker(queue: asyncio.Queue, uploader: TelegramUploader, state: StateStore, chat_id: str, stats: dict):
+async def upload_worker(queue: asyncio.Queue, uploader: TelegramUploader, state: StateStore, chat_id: str, stats: dict, media_store: Optional[MediaStore] = None, cleanup_after_upload: bool = False, encoding_profile: Optional[EncodingProfile] = None):
     while True:
         try:
             item = await queue.get()
@@ -77,12 +80,15 @@ async def upload_worker(queue: asyncio.Queue, uploader: TelegramUploader, state:
                 logger.debug(f"DEBUG: media type = {type(media)}, value = {media}")
                 message_id = None
                 if post.kind == 'video' and 'video' in media:
-                    message_id = await uploader.upload_video(post, media['video'], chat_id=chat_id)
+                    message_id = await uploader.upload_video(post, media['video'], chat_id=chat_id, encoding_profile=encoding_profile)
                 elif post.kind == 'slideshow' and 'images' in media:
                     message_id = await uploader.upload_slideshow(post, media['images'], chat_id=chat_id)
                 
                 if message_id:
                     state.mark_as_uploaded(post.post_id, chat_id, message_id)
+                    if media_store is not None and cleanup_after_upload:
+                        # Blobs still linked from other posts are kept
+                        media_store.release(post.post_id)
                     stats['uploaded'] += 1
                     
                     # Randomized delay between uploads to avoid Telegram flood limits
@@ -155,16 +161,26 @@ async def resume_incomplete_uploads(username: str, state: StateStore, uploader:
     
     return resumed_count
 
-async def process_creator(creator_config: dict, settings: dict, state: StateStore, uploader: TelegramUploader, cookie_manager: CookieManager, shutdown_event: asyncio.Event):
+async def process_creator(creator_config: dict, settings: dict, state: StateStore, uploader: TelegramUploader, cookie_manager: CookieManager, shutdown_event: asyncio.Event, media_store: Optional[MediaStore] = None):
     username = creator_config['username']
     user_id = creator_config.get('user_id')
     chat_id = creator_config.get('chat_id') or settings.get('telegram_chat_id')
     fetch_depth = settings.get('fetch_depth', 10)
+    max_fetch_depth = settings.get('max_fetch_depth', 50)
+    probe_workers = settings.get('probe_workers', 3)
+    redirect_check = settings.get('probe_redirect_check', False)
+    stream_transcode = settings.get('stream_transcode', False)
 
     if not chat_id:
         logger.error(f"No chat_id specified for creator {username}")
         return
 
+    try:
+        encoding_profile = resolve_encoding_profile(creator_config, chat_id, settings)
+    except ValueError as e:
+        logger.error(f"Ignoring encoding profile of {username}: {e}")
+        encoding_profile = None
+
     # Log which identifier we're using
     if user_id:
         logger.info(f"Processing creator: {username} (using user_id: {user_id})")
@@ -175,17 +191,19 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
     cookie_path = cookie_manager.get_current_cookie_path()
     
     loop = asyncio.get_running_loop()
+    cursor = state.get_cursor(username)
     
     try:
         # Run fetch_posts in executor as it is blocking
-        posts = await loop.run_in_executor(None, lambda: fetch_posts(username, depth=fetch_depth, cookie_path=cookie_path, cookie_content=cookie_content, user_id=user_id))
+        posts = await loop.run_in_executor(None, lambda: fetch_posts(username, depth=fetch_depth, cookie_path=cookie_path, cookie_content=cookie_content, user_id=user_id, filter_unseen=state.filter_unseen, probe_cache=state, cursor=cursor, max_depth=max_fetch_depth, probe_workers=probe_workers, redirect_check=redirect_check))
         
-        if not posts and cookie_manager.cookie_files:
-            logger.warning(f"No posts found for {username}, attempting cookie rotation...")
-            cookie_manager.rotate()
-            cookie_content = cookie_manager.get_cookie_content()
-            cookie_path = cookie_manager.get_current_cookie_path()
-            posts = await loop.run_in_executor(None, lambda: fetch_posts(username, depth=fetch_depth, cookie_path=cookie_path, cookie_content=cookie_content, user_id=user_id))
+        # Nothing new is the usual answer; only an empty or failed listing is worth another cookie
+        if not posts.listed and cookie_manager.cookie_files:
+            logger.warning(f"Listing for {username} came back empty, attempting cookie rotation...")
+            # This creator's own cookie, not whatever other creators rotated to meanwhile
+            cookie_path = cookie_manager.rotate(cookie_path)
+            cookie_content = cookie_manager.read_cookie(cookie_path)
+            posts = await loop.run_in_executor(None, lambda: fetch_posts(username, depth=fetch_depth, cookie_path=cookie_path, cookie_content=cookie_content, user_id=user_id, filter_unseen=state.filter_unseen, probe_cache=state, cursor=cursor, max_depth=max_fetch_depth, probe_workers=probe_workers, redirect_check=redirect_check))
     except Exception as e:
         logger.error(f"Failed to fetch posts for {username}: {e}")
         return
@@ -194,10 +212,14 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
     
     stats = {'uploaded': 0}
     ip_blocked_detected = False
+    # Newest post of the unbroken run of handled posts; the cursor must not skip
+    # past a post that failed and needs to be listed again next time.
+    cursor_post: Optional[Post] = None
+    cursor_blocked = False
     
     # Initialize Queue and Worker for pipelined processing
     queue = asyncio.Queue()
-    worker_task = asyncio.create_task(upload_worker(queue, uploader, state, chat_id, stats))
+    worker_task = asyncio.create_task(upload_worker(queue, uploader, state, chat_id, stats, media_store, settings.get('cleanup_after_upload', False), encoding_profile))
     
     try:
         # First, resume any incomplete uploads
@@ -212,20 +234,20 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
                 break
             
             if state.is_processed(post.post_id):
+                if not cursor_blocked and post.created_at is not None:
+                    cursor_post = post
                 continue
             
             logger.info(f"New post found: {post.post_id} ({post.kind})")
             
             # Download (Non-blocking)
             try:
-                # Refresh cookie path in case it changed
-                current_cookie_path = cookie_manager.get_current_cookie_path()
-                
                 # Run download in executor
-                media = await loop.run_in_executor(None, lambda: download_post(post, "downloads", cookie_path=current_cookie_path, cookie_content=cookie_content))
+                media = await loop.run_in_executor(None, lambda: download_post(post, "downloads", cookie_path=cookie_path, cookie_content=cookie_content, probe_cache=state, partials=state, media_store=media_store, stream_transcode=stream_transcode, encoding_profile=encoding_profile))
                 
                 if not media:
                     logger.error(f"Failed to download post {post.post_id}")
+                    cursor_blocked = True
                     continue
                 
                 # Record that post was downloaded
@@ -235,9 +257,13 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
                     
                 # Queue for upload (this will not block unless queue is full, which is default infinite)
                 await queue.put((post, media))
+                if not cursor_blocked and post.created_at is not None:
+                    cursor_post = post
                 
             except PostInaccessibleError as e:
                 logger.warning(f"Post {post.post_id} is inaccessible, skipping: {e}")
+                if not cursor_blocked and post.created_at is not None:
+                    cursor_post = post
                 continue
             except Exception as e:
                 error_str = str(e)
@@ -245,10 +271,13 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
                     logger.error(f"IP blocked for post {post.post_id}, skipping creator {username}")
                     # Mark creator for longer cooldown
                     state.mark_ip_blocked(username)
+                    # All creators share one IP, so every worker slows down
+                    tiktok_rate.on_block()
                     ip_blocked_detected = True
                     break  # Stop processing this creator
                 else:
                     logger.error(f"Failed to download post {post.post_id}: {e}")
+                    cursor_blocked = True
                     continue
         
         # Wait for all uploads to complete
@@ -258,13 +287,120 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
         # Stop worker
         await queue.put(None)
         await worker_task
+
+    # Downloaded posts are recorded for upload resumption, so the cursor can move past them
+    if cursor_post is not None:
+        state.update_cursor(username, cursor_post.post_id, cursor_post.created_at)
     
     if ip_blocked_detected:
         logger.warning(f"Creator {username} marked as IP-blocked. Will retry after cooldown period.")
     
     logger.info(f"Finished processing {username}. {stats['uploaded']} new posts uploaded.")
 
-async def main():
+async def poll_creators(due_creators, settings, state, uploader, cookie_manager, scheduler: Optional[PollScheduler], media_store: Optional[MediaStore] = None):
+    """
+    Process one batch of due creators, up to `creator_concurrency` at a time.
+    Request pacing is left to the shared TikTok token bucket (`tiktok_budget`), whose
+    rate the `tiktok_rate` controller adapts to 429 / IP-block feedback.
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.get('creator_concurrency', 4)))
+
+    async def run(creator: dict):
+        username = creator['username']
+        async with semaphore:
+            # Check shutdown signal before processing each creator
+            if _shutdown_event.is_set():
+                return
+            
+            # Skip creators that are currently IP-blocked
+            if state.is_ip_blocked(username):
+                logger.info(f"Skipping {username} - IP blocked (cooldown)")
+                if scheduler is not None:
+                    scheduler.defer(username, scheduler.min_interval)
+                return
+            
+            try:
+                await process_creator(creator, settings, state, uploader, cookie_manager, _shutdown_event, media_store)
+            except Exception as e:
+                logger.error(f"Failed to process creator {username}: {e}")
+                if scheduler is not None:
+                    scheduler.defer(username, scheduler.min_interval)
+                return
+            if scheduler is not None:
+                scheduler.mark_polled(username)
+
+    await asyncio.gather(*(run(creator) for creator in due_creators))
+    if _shutdown_event.is_set():
+        logger.info("Shutdown signal received, stopping processing...")
+
+
+# How often the daemon expires the probe cache and unused cached photos
+HOUSEKEEPING_INTERVAL = 3600
+
+
+def housekeeping(state: StateStore, settings: dict):
+    """Drop probe cache entries and cached photos older than their configured age."""
+    state.evict_expired_probes()
+    photo_normalizer.prune(settings.get('photo_cache_max_age_days', 7) * 86400)
+
+
+async def run_daemon(creators, settings, state, uploader, cookie_manager, scheduler: PollScheduler, media_store: Optional[MediaStore] = None, creators_path: str = CREATORS_PATH):
+    """
+    Keep polling creators as they fall due until a shutdown signal arrives.
+
+    creators_path is the file the creators were loaded from; edits to it are reloaded.
+    """
+    creators_mtime = os.path.getmtime(creators_path) if os.path.exists(creators_path) else None
+    idle_cap = settings.get('daemon_max_sleep_seconds', 300)
+    logger.info(f"Daemon mode: scheduling {len(creators)} creators")
+    loop = asyncio.get_running_loop()
+    # main() ran it at startup
+    last_housekeeping = time.monotonic()
+    
+    while not _shutdown_event.is_set():
+        if time.monotonic() - last_housekeeping >= HOUSEKEEPING_INTERVAL:
+            last_housekeeping = time.monotonic()
+            try:
+                await loop.run_in_executor(None, housekeeping, state, settings)
+            except Exception as e:
+                logger.error(f"Housekeeping failed: {e}")
+
+        # Pick up edits to the creators file without a restart
+        if os.path.exists(creators_path) and os.path.getmtime(creators_path) != creators_mtime:
+            try:
+                creators = load_creators(creators_path)
+                creators_mtime = os.path.getmtime(creators_path)
+                scheduler.load(creators)
+                logger.info(f"Reloaded {len(creators)} creators from {creators_path}")
+            except Exception as e:
+                logger.error(f"Failed to reload {creators_path}: {e}")
+                creators_mtime = os.path.getmtime(creators_path)
+        
+        due_creators = scheduler.pop_due()
+        if due_creators:
+            logger.info(f"{len(due_creators)} of {len(creators)} creators due for polling")
+            try:
+                await poll_creators(due_creators, settings, state, uploader, cookie_manager, scheduler, media_store)
+            except Exception as e:
+                # One bad cycle must not take the daemon down; requeue whatever was not polled
+                logger.error(f"Polling cycle failed: {e}")
+                for creator in due_creators:
+                    if scheduler.next_due_for(creator['username']) is None:
+                        scheduler.defer(creator['username'], scheduler.min_interval)
+            continue
+        
+        next_due = scheduler.next_due_at()
+        sleep_for = idle_cap if next_due is None else min(idle_cap, max(1.0, next_due - time.time()))
+        logger.debug(f"Next creator due in {sleep_for:.0f}s")
+        try:
+            await asyncio.wait_for(_shutdown_event.wait(), timeout=sleep_for)
+        except asyncio.TimeoutError:
+            pass
+    
+    logger.info("Daemon stopped.")
+
+
+async def main(daemon: bool = False, config_path: str = CONFIG_PATH, creators_path: str = CREATORS_PATH):
     global _shutdown_event
     
     # Startup banner (print only when running as a program, not on import)
@@ -278,64 +414,109 @@ async def main():
     _setup_signal_handlers()
     
     try:
-        config = load_config("config.yaml")
-        creators = load_creators("creators.yaml")
+        config = load_config(config_path)
+        creators = load_creators(creators_path)
         settings = config.get('settings', {})
         
         logger.info(f"Loaded config and {len(creators)} creators.")
         
-        state = StateStore("data/state.db")
+        probe_cache_ttl = int(settings.get('probe_cache_ttl_hours', 168) * 3600)
+        state = StateStore("data/state.db", probe_cache_ttl=probe_cache_ttl)
+        tiktok_limiter.configure(settings.get('probe_concurrency_per_host', 3))
+        tiktok_budget.configure(
+            rate=settings.get('tiktok_requests_per_second', 1.0),
+            burst=settings.get('tiktok_request_burst', 5),
+            jitter=settings.get('tiktok_request_jitter_seconds', 0.5),
+        )
+        tiktok_rate.configure(
+            min_rate=settings.get('tiktok_min_requests_per_second', 0.1),
+            max_rate=settings.get('tiktok_max_requests_per_second', 5.0),
+        )
+        # Encodes get their own workers, sized to the CPU count unless configured
+        transcode_scheduler.configure(
+            workers=settings.get('transcode_workers'),
+            threads_per_job=settings.get('transcode_threads_per_job'),
+        )
+        # ffmpeg/ffprobe run below the bot's priority so uploads keep moving during encodes
+        governor.configure(
+            nice=settings.get('encoder_nice', 10),
+            ionice_class=settings.get('encoder_ionice_class', 2),
+            ionice_level=settings.get('encoder_ionice_level', 7),
+        )
+        # Slideshow images are converted to Telegram-compliant JPEGs before upload
+        photo_normalizer.configure(
+            cache_dir=settings.get('photo_cache_path', 'data/photo_cache'),
+            workers=settings.get('photo_workers'),
+        )
+        # Expire old probes and cached photos; the daemon repeats this every HOUSEKEEPING_INTERVAL
+        housekeeping(state, settings)
         uploader = TelegramUploader(
             token=config['telegram']['bot_token'],
             chat_id=settings.get('telegram_chat_id')
         )
         
         cookie_manager = CookieManager("data/cookies")
+        # Keep media shared between posts (music tracks, reposts) on disk once
+        media_store = None
+        if settings.get('dedupe_media', True):
+            media_store = MediaStore(state, settings.get('media_store_path', 'data/media'))
+
+        # Poll active creators often and quiet ones rarely, most overdue first
+        min_interval = settings.get('poll_min_interval_minutes', 15) * 60
+        if settings.get('adaptive_polling', True):
+            scheduler = PollScheduler(
+                state,
+                min_interval=min_interval,
+                max_interval=settings.get('poll_max_interval_minutes', 720) * 60,
+                alpha=settings.get('poll_ewma_alpha', 0.3),
+            )
+        elif daemon:
+            # Without adaptive polling the daemon polls every creator at a fixed interval
+            scheduler = PollScheduler(state, min_interval=min_interval, max_interval=min_interval)
+        else:
+            scheduler = None
         
-        for creator in creators:
-            # Check shutdown signal before processing each creator
-            if _shutdown_event.is_set():
-                logger.info("Shutdown signal received, stopping processing...")
-                break
-                
-            username = creator['username']
-            
-            # Skip creators that are currently IP-blocked
-            if state.is_ip_blocked(username):
-                logger.info(f"Skipping {username} - IP blocked (cooldown)")
-                continue
-            
-            await process_creator(creator, settings, state, uploader, cookie_manager, _shutdown_event)
-            
-            # Check shutdown signal before delay
-            if _shutdown_event.is_set():
-                logger.info("Shutdown signal received, stopping...")
-                break
-            
-            # Delay between creators to avoid TikTok blocks
-            # Use longer delay if the previous creator was IP-blocked
-            if state.is_ip_blocked(username):
-                delay = get_retry_delay(1, is_ip_blocked=True)
-                logger.info(f"IP block detected for {username}, waiting {delay:.1f}s before next creator...")
+        if daemon:
+            scheduler.load(creators)
+            await run_daemon(creators, settings, state, uploader, cookie_manager, scheduler, media_store, creators_path)
+        else:
+            if scheduler is not None:
+                scheduler.load(creators)
+                due_creators = scheduler.pop_due()
+                logger.info(f"{len(due_creators)} of {len(creators)} creators due for polling")
             else:
-                min_delay = settings.get('delay_between_creators_seconds_min', 30)
-                max_delay = settings.get('delay_between_creators_seconds_max', 60)
-                delay = random.uniform(min_delay, max_delay)
-                logger.info(f"Waiting {delay:.1f}s before next creator...")
-            
-            # Wait with shutdown check
-            try:
-                await asyncio.wait_for(_shutdown_event.wait(), timeout=delay)
-            except asyncio.TimeoutError:
-                pass  # Timeout means delay completed normally
+                due_creators = creators
+            await poll_creators(due_creators, settings, state, uploader, cookie_manager, scheduler, media_store)
             
     except Exception as e:
         logger.error(f"Execution failed: {e}")
         sys.exit(1)
     finally:
+        # Saves cookie jars of the pooled yt-dlp instances
+        ytdl_pool.close_all()
+        stats = transcode_scheduler.stats()
+        if stats['completed']:
+            logger.info(
+                f"Transcodes: {stats['completed']} job(s), {stats['wall_seconds']:.0f}s wall, "
+                f"{stats['cpu_seconds']:.0f}s CPU, peak RSS {stats['peak_rss_kb'] / 1024:.0f}MB"
+            )
+        transcode_scheduler.shutdown()
+        photo_normalizer.shutdown()
         logger.info("StateStore connections closed via context managers.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"{BOT_NAME} - TikTok to Telegram")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="Stay running and poll creators as they fall due instead of making a single pass"
+    )
+    parser.add_argument("--config", default=CONFIG_PATH, help=f"Path to the config file (default: {CONFIG_PATH})")
+    parser.add_argument(
+        "--creators", default=CREATORS_PATH,
+        help=f"Path to the creators file; the daemon reloads this file when it changes (default: {CREATORS_PATH})"
+    )
+    args = parser.parse_args()
+    
     # Register handlers using signal.signal() for non-asyncio fallback
     def fallback_signal_handler(signum, frame):
         logger.info(f"Received signal {signum}, initiating graceful shutdown...")
@@ -349,7 +530,7 @@ if __name__ == "__main__":
             pass  # Signal not supported on this platform
     
     try:
-        asyncio.run(main())
+        asyncio.run(main(daemon=args.daemon, config_path=args.config, creators_path=args.creators))
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt received, shutting down...")
         if _shutdown_event:
@@ -1,6 +1,8 @@
 import yaml
 import os
 
+from .transcode import EncodingProfile
+
 def load_config(file_path):
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Configuration file not found: {file_path}")
@@ -18,6 +20,11 @@ def load_config(file_path):
             config['telegram'] = {}
         config['telegram']['bot_token'] = env_token
         
+    # Unquoted chat IDs (`-1001234567890: mobile`) load as ints; chat IDs are looked up as strings
+    settings = config.get('settings') or {}
+    if settings.get('chat_encoding_profiles'):
+        settings['chat_encoding_profiles'] = {str(k): v for k, v in settings['chat_encoding_profiles'].items()}
+
     # Simple validation
     if 'telegram' not in config or 'bot_token' not in config['telegram'] or not config['telegram']['bot_token']:
         raise ValueError("Telegram bot token is missing. Set it in config.yaml or TELEGRAM_BOT_TOKEN environment variable.")
@@ -42,3 +49,29 @@ def load_creators(file_path):
             raise ValueError(f"Invalid creator entry: {entry}")
             
     return creators
+
+
+def resolve_encoding_profile(creator, chat_id, settings):
+    """
+    Return the EncodingProfile for a creator's videos, or None for the defaults.
+
+    The creator's own `encoding_profile` wins, then `chat_encoding_profiles` for its
+    chat, then `default_encoding_profile`. Each may name an entry of
+    `encoding_profiles` or give the options inline. Raises ValueError on unknown
+    names or options.
+    """
+    spec = creator.get('encoding_profile')
+    if spec is None:
+        spec = (settings.get('chat_encoding_profiles') or {}).get(str(chat_id))
+    if spec is None:
+        spec = settings.get('default_encoding_profile')
+    if spec is None:
+        return None
+    if isinstance(spec, str):
+        named = settings.get('encoding_profiles') or {}
+        if spec not in named:
+            raise ValueError(f"Unknown encoding profile: {spec}")
+        spec = named[spec]
+    if not isinstance(spec, dict):
+        raise ValueError(f"Invalid encoding profile: {spec!r}")
+    return EncodingProfile.from_dict(spec)
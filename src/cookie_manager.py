@@ -33,7 +33,10 @@ class CookieManager:
         return self.cookie_files[self.current_index]
 
     def get_cookie_content(self) -> Optional[str]:
-        path = self.get_current_cookie_path()
+        return self.read_cookie(self.get_current_cookie_path())
+
+    def read_cookie(self, path: Optional[str]) -> Optional[str]:
+        """Content of the given cookie file, or None if it can't be read."""
         if not path:
             return None
         try:
@@ -43,11 +46,20 @@ class CookieManager:
             logger.error(f"Failed to read cookie file {path}: {e}")
             return None
 
-    def rotate(self) -> Optional[str]:
-        """Switch to the next available cookie and return the new cookie path."""
+    def rotate(self, from_path: Optional[str] = None) -> Optional[str]:
+        """
+        Switch to the cookie after from_path (default: the current one) and return its path.
+
+        Creators run concurrently; each passes the cookie it was using, so two tasks
+        failing on the same cookie both move to the next one instead of the second
+        rotation skipping past it.
+        """
         if not self.cookie_files:
             return None
-        self.current_index = (self.current_index + 1) % len(self.cookie_files)
+        index = self.current_index
+        if from_path in self.cookie_files:
+            index = self.cookie_files.index(from_path)
+        self.current_index = (index + 1) % len(self.cookie_files)
         new_path = self.get_current_cookie_path()
         logger.info(f"Rotated to cookie file: {new_path}")
         return new_path
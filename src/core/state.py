@@ -2,14 +2,20 @@ import sqlite3
 import logging
 import os
 import time
-from typing import Optional, Dict
+from typing import Any, Optional, Dict, Iterable, List, Set, Tuple
 from datetime import datetime, timedelta
 
 logger = logging.getLogger("tok2gram.state")
 
+# Default lifetime of a cached kind probe (the answer for a post never changes,
+# the TTL only keeps the table from growing forever)
+DEFAULT_PROBE_CACHE_TTL = 7 * 24 * 3600
+
+
 class StateStore:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, probe_cache_ttl: int = DEFAULT_PROBE_CACHE_TTL):
         self.db_path = db_path
+        self.probe_cache_ttl = probe_cache_ttl
         # In-memory tracking for IP-blocked creators (not persisted to DB)
         self.ip_blocked_creators: Dict[str, datetime] = {}
         self._init_db()
@@ -33,6 +39,62 @@ class StateStore:
                     )
                 """)
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_creator_uploaded ON posts(creator, uploaded_at)")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS creator_cursors (
+                        creator     TEXT PRIMARY KEY,
+                        post_id     TEXT NOT NULL,
+                        created_at  INTEGER,
+                        updated_at  INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS creator_polls (
+                        creator         TEXT PRIMARY KEY,
+                        last_polled_at  INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS probe_cache (
+                        post_id     TEXT PRIMARY KEY,
+                        kind        TEXT NOT NULL,
+                        url         TEXT NOT NULL,
+                        probed_at   INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS partial_downloads (
+                        post_id       TEXT NOT NULL,
+                        path          TEXT NOT NULL,
+                        url           TEXT,
+                        expected_size INTEGER,
+                        etag          TEXT,
+                        updated_at    INTEGER NOT NULL,
+                        PRIMARY KEY (post_id, path)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS media_blobs (
+                        digest      TEXT PRIMARY KEY,
+                        path        TEXT NOT NULL,
+                        size        INTEGER NOT NULL,
+                        created_at  INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS media_keys (
+                        source_key  TEXT PRIMARY KEY,
+                        digest      TEXT NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS media_refs (
+                        post_id     TEXT NOT NULL,
+                        path        TEXT NOT NULL,
+                        digest      TEXT NOT NULL,
+                        PRIMARY KEY (post_id, path)
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_media_refs_digest ON media_refs(digest)")
                 
                 # Check if downloaded_files column exists, add if not (migration)
                 cursor = conn.execute("PRAGMA table_info(posts)")
@@ -88,6 +150,320 @@ class StateStore:
             logger.error(f"Error checking processed status for {post_id}: {e}")
             return False
 
+    def filter_unseen(self, post_ids: Iterable[str]) -> Set[str]:
+        """
+        Bulk variant of is_processed().
+        Returns the subset of post_ids that have not been successfully uploaded yet,
+        using a single connection instead of one lookup per post.
+        """
+        ids = [pid for pid in dict.fromkeys(post_ids) if pid]
+        if not ids:
+            return set()
+        uploaded: Set[str] = set()
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                # Stay well below SQLite's host parameter limit
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    cursor = conn.execute(
+                        f"SELECT post_id FROM posts WHERE uploaded_at IS NOT NULL AND post_id IN ({placeholders})",
+                        chunk,
+                    )
+                    uploaded.update(row[0] for row in cursor.fetchall())
+        except sqlite3.Error as e:
+            # Treat everything as unseen; is_processed() still guards each post later
+            logger.error(f"Error filtering seen posts: {e}")
+            return set(ids)
+        return set(ids) - uploaded
+
+    def get_cursor(self, creator: str) -> Optional[Tuple[str, Optional[int]]]:
+        """
+        Return the listing high-watermark (post_id, created_at) for a creator.
+        Falls back to the newest uploaded post so databases from before cursors existed
+        get one without another full listing.
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute(
+                    "SELECT post_id, created_at FROM creator_cursors WHERE creator = ?",
+                    (creator,)
+                ).fetchone()
+                if row is None:
+                    row = conn.execute("""
+                        SELECT post_id, created_at FROM posts
+                        WHERE creator = ? AND uploaded_at IS NOT NULL AND created_at IS NOT NULL
+                        ORDER BY created_at DESC LIMIT 1
+                    """, (creator,)).fetchone()
+                return (row[0], row[1]) if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading cursor for {creator}: {e}")
+            return None
+
+    def update_cursor(self, creator: str, post_id: str, created_at: Optional[int]):
+        """Advance a creator's high-watermark. Never moves it back to an older post."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT INTO creator_cursors (creator, post_id, created_at, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(creator) DO UPDATE SET
+                        post_id = excluded.post_id,
+                        created_at = excluded.created_at,
+                        updated_at = excluded.updated_at
+                    WHERE creator_cursors.created_at IS NULL
+                        OR excluded.created_at >= creator_cursors.created_at
+                """, (creator, post_id, created_at, int(time.time())))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error updating cursor for {creator}: {e}")
+
+    def get_post_timestamps(self, creator: str, limit: int = 20) -> List[int]:
+        """Return created_at of the creator's newest `limit` known posts, oldest first."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute("""
+                    SELECT created_at FROM posts
+                    WHERE creator = ? AND created_at IS NOT NULL
+                    ORDER BY created_at DESC LIMIT ?
+                """, (creator, limit))
+                return sorted(row[0] for row in cursor.fetchall())
+        except sqlite3.Error as e:
+            logger.error(f"Error reading post timestamps for {creator}: {e}")
+            return []
+
+    def get_last_polls(self) -> Dict[str, int]:
+        """Return {creator: last_polled_at} for every creator polled before."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute("SELECT creator, last_polled_at FROM creator_polls")
+                return {row[0]: row[1] for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            logger.error(f"Error reading poll times: {e}")
+            return {}
+
+    def record_poll(self, creator: str, polled_at: Optional[int] = None):
+        """Remember when a creator was last polled."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT INTO creator_polls (creator, last_polled_at)
+                    VALUES (?, ?)
+                    ON CONFLICT(creator) DO UPDATE SET
+                        last_polled_at = excluded.last_polled_at
+                """, (creator, int(polled_at if polled_at is not None else time.time())))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error recording poll for {creator}: {e}")
+
+    def get_cached_probe(self, post_id: str) -> Optional[Tuple[str, str]]:
+        """Return the cached (kind, canonical_url) for a post, or None if missing/expired."""
+        return self.get_cached_probes([post_id]).get(post_id)
+
+    def get_cached_probes(self, post_ids: Iterable[str]) -> Dict[str, Tuple[str, str]]:
+        """
+        Bulk lookup of cached kind probes.
+        Returns {post_id: (kind, canonical_url)} for entries younger than probe_cache_ttl.
+        """
+        ids = [pid for pid in dict.fromkeys(post_ids) if pid]
+        if not ids:
+            return {}
+        cutoff = int(time.time()) - self.probe_cache_ttl
+        cached: Dict[str, Tuple[str, str]] = {}
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    cursor = conn.execute(
+                        f"SELECT post_id, kind, url FROM probe_cache WHERE probed_at >= ? AND post_id IN ({placeholders})",
+                        [cutoff, *chunk],
+                    )
+                    for post_id, kind, url in cursor.fetchall():
+                        cached[post_id] = (kind, url)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading probe cache: {e}")
+        return cached
+
+    def record_probe(self, post_id: str, kind: str, url: str):
+        """Cache the kind classification and canonical /photo/ or /video/ URL of a post."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT INTO probe_cache (post_id, kind, url, probed_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(post_id) DO UPDATE SET
+                        kind = excluded.kind,
+                        url = excluded.url,
+                        probed_at = excluded.probed_at
+                """, (post_id, kind, url, int(time.time())))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error caching probe result for {post_id}: {e}")
+
+    def evict_expired_probes(self) -> int:
+        """Delete probe cache entries older than probe_cache_ttl. Returns the number removed."""
+        cutoff = int(time.time()) - self.probe_cache_ttl
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute("DELETE FROM probe_cache WHERE probed_at < ?", (cutoff,))
+                conn.commit()
+                if cursor.rowcount:
+                    logger.info(f"Evicted {cursor.rowcount} expired probe cache entries")
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error evicting probe cache: {e}")
+            return 0
+
+    def record_partial(self, post_id: str, path: str, url: Optional[str] = None,
+                       expected_size: Optional[int] = None, etag: Optional[str] = None):
+        """
+        Remember an in-progress download so a later run can resume it.
+        path is the partial file on disk; expected_size/etag validate the resumed file.
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT INTO partial_downloads (post_id, path, url, expected_size, etag, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(post_id, path) DO UPDATE SET
+                        url = excluded.url,
+                        expected_size = excluded.expected_size,
+                        etag = excluded.etag,
+                        updated_at = excluded.updated_at
+                """, (post_id, path, url, expected_size, etag, int(time.time())))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error recording partial download for {post_id}: {e}")
+
+    def get_partial(self, post_id: str, path: str) -> Optional[Dict[str, Any]]:
+        """Return the recorded url/expected_size/etag of a partial download, if any."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute(
+                    "SELECT url, expected_size, etag FROM partial_downloads WHERE post_id = ? AND path = ?",
+                    (post_id, path)
+                ).fetchone()
+                if row:
+                    return {'url': row[0], 'expected_size': row[1], 'etag': row[2]}
+                return None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading partial download for {post_id}: {e}")
+            return None
+
+    def clear_partials(self, post_id: str):
+        """Forget the partial downloads of a post once it has been fully downloaded."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("DELETE FROM partial_downloads WHERE post_id = ?", (post_id,))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error clearing partial downloads for {post_id}: {e}")
+
+    def get_blob(self, digest: str) -> Optional[str]:
+        """Return the stored path of a media blob by content digest."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute("SELECT path FROM media_blobs WHERE digest = ?", (digest,)).fetchone()
+                return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading media blob {digest}: {e}")
+            return None
+
+    def get_blob_by_key(self, source_key: str) -> Optional[Tuple[str, str]]:
+        """Return (digest, path) of the blob a source key (CDN path + size/ETag) resolved to."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute("""
+                    SELECT b.digest, b.path FROM media_keys k
+                    JOIN media_blobs b ON b.digest = k.digest
+                    WHERE k.source_key = ?
+                """, (source_key,)).fetchone()
+                return (row[0], row[1]) if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading media key: {e}")
+            return None
+
+    def record_blob(self, digest: str, path: str, size: int, source_key: Optional[str] = None):
+        """Register a media blob and, optionally, the source key that produced it."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT INTO media_blobs (digest, path, size, created_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(digest) DO UPDATE SET path = excluded.path
+                """, (digest, path, size, int(time.time())))
+                if source_key:
+                    conn.execute("""
+                        INSERT INTO media_keys (source_key, digest) VALUES (?, ?)
+                        ON CONFLICT(source_key) DO UPDATE SET digest = excluded.digest
+                    """, (source_key, digest))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error recording media blob {digest}: {e}")
+
+    def forget_blob(self, digest: str):
+        """Drop a blob whose file has gone missing, along with its source keys."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("DELETE FROM media_keys WHERE digest = ?", (digest,))
+                conn.execute("DELETE FROM media_blobs WHERE digest = ?", (digest,))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error forgetting media blob {digest}: {e}")
+
+    def add_blob_ref(self, post_id: str, path: str, digest: str):
+        """Record that a post's file at `path` links to a blob."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT INTO media_refs (post_id, path, digest) VALUES (?, ?, ?)
+                    ON CONFLICT(post_id, path) DO UPDATE SET digest = excluded.digest
+                """, (post_id, path, digest))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error recording media reference for {post_id}: {e}")
+
+    def get_blob_ref(self, post_id: str, path: str) -> Optional[str]:
+        """Return the digest a post's file links to, if it is managed by the media store."""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute(
+                    "SELECT digest FROM media_refs WHERE post_id = ? AND path = ?", (post_id, path)
+                ).fetchone()
+                return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading media reference for {post_id}: {e}")
+            return None
+
+    def release_blob_refs(self, post_id: str) -> Tuple[List[str], List[str]]:
+        """
+        Drop every media reference of a post.
+        Returns (link paths of the post, blob paths no longer referenced by any post).
+        The orphaned blobs are unregistered in the same transaction, so a concurrent
+        download can't pick one up by key after it was decided to delete it.
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                rows = conn.execute(
+                    "SELECT path, digest FROM media_refs WHERE post_id = ?", (post_id,)
+                ).fetchall()
+                conn.execute("DELETE FROM media_refs WHERE post_id = ?", (post_id,))
+                orphans: List[str] = []
+                for digest in {row[1] for row in rows}:
+                    if conn.execute("SELECT 1 FROM media_refs WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                        continue
+                    blob = conn.execute("SELECT path FROM media_blobs WHERE digest = ?", (digest,)).fetchone()
+                    conn.execute("DELETE FROM media_keys WHERE digest = ?", (digest,))
+                    conn.execute("DELETE FROM media_blobs WHERE digest = ?", (digest,))
+                    if blob:
+                        orphans.append(blob[0])
+                conn.commit()
+                return [row[0] for row in rows], orphans
+        except sqlite3.Error as e:
+            logger.error(f"Error releasing media references for {post_id}: {e}")
+            return [], []
+
     def record_download(self, post_id: str, creator: str, kind: str, url: str, created_at: Optional[int]):
         """Record that a post has been downloaded (but not yet uploaded)."""
         try:
@@ -1,20 +1,71 @@
-import yt_dlp
 import logging
 import os
 import re
+import time
 import json
-import subprocess
-import tempfile
-from pathlib import Path
+import threading
+import http.cookiejar
 
 import requests
-
+import yt_dlp
+from yt_dlp.networking import Request as YtdlRequest
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+try:
+    from gallery_dl import config as gdl_config, extractor as gdl_extractor, job as gdl_job
+    _GALLERY_DL_AVAILABLE = True
+except ImportError:
+    _GALLERY_DL_AVAILABLE = False
+
+from . import ytdl_pool
+from .rate_limit import tiktok_budget, tiktok_rate
+from .media_store import source_key
+from .transcode import EncodingProfile, MediaInfo, prepare_for_telegram, stream_encode, upload_limit_mb
+from .transcode_pool import transcode_scheduler, PRIORITY_DOWNLOAD
 from .tiktok_api import Post
-from typing import Optional, List, Dict, Any, cast
+from typing import Optional, List, Dict, Any, Tuple, cast
 
 logger = logging.getLogger("tok2gram.downloader")
 
 
+# yt-dlp format string used when no single rendition carries both video and audio
+DEFAULT_VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+H264_VCODEC_PREFIXES = ('h264', 'avc')
+TELEGRAM_ACODEC_PREFIXES = ('aac', 'mp4a', 'mp3')
+
+# Media URLs in a probe's info dict are signed and expire; only reuse recent probes
+PROBE_INFO_TTL = 10 * 60
+
+# Guards the one-time gallery-dl setup (its config is process-global)
+_gallery_dl_lock = threading.Lock()
+_gallery_dl_ready = False
+# gallery-dl loggers whose messages decide how a failed job is classified
+GALLERY_DL_LOGGERS = ("tiktok", "download")
+GALLERY_DL_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+# Parsed cookie files: path -> (mtime, cookies); only the latest version is kept
+_gallery_dl_cookies: Dict[str, Tuple[float, Dict[str, str]]] = {}
+
+# Per-download state for select_telegram_format(), which yt-dlp calls without context
+_selection = threading.local()
+
+# Slideshow images/audio fetched at once, over one pooled keep-alive connection set
+SLIDESHOW_FETCH_WORKERS = 6
+STREAM_CHUNK_SIZE = 64 * 1024
+
+IMAGE_CONTENT_TYPES = {
+    'image/png': 'png',
+    'image/webp': 'webp',
+    'image/jpeg': 'jpg',
+    'image/jpg': 'jpg',
+}
+AUDIO_CONTENT_TYPES = {
+    'audio/mpeg': 'mp3',
+    'audio/mp4': 'm4a',
+    'audio/x-m4a': 'm4a',
+}
+
+
 class PostInaccessibleError(Exception):
     """Raised when a post is deleted, private, or region-restricted"""
     pass
@@ -84,7 +135,10 @@ def _extract_json_from_pattern(html_text: str, pattern: str) -> Optional[dict]:
 
 def _extract_slideshow_urls_from_html(post: Post, session: requests.Session, url: str) -> Dict[str, Any]:
     """Fallback extractor for TikTok photo posts by parsing webpage embedded JSON."""
+    tiktok_budget.acquire()
     resp = session.get(url, timeout=15)
+    if resp.status_code == 429:
+        tiktok_rate.on_throttle()
     resp.raise_for_status()
     html_text = resp.text or ""
     
@@ -192,100 +246,74 @@ def _extract_slideshow_urls_from_html(post: Post, session: requests.Session, url
     return {"image_urls": image_urls, "audio_url": audio_url}
 
 
-def _transcode_to_telegram_mp4(input_path: str) -> str:
-    """Ensure Telegram Desktop can preview the video.
-
-    Telegram Desktop is picky about container/codec combinations. TikTok downloads
-    can end up as:
-    - audio-only files (e.g. .m4a)
-    - MP4 with unsupported video codec (e.g. AV1/H.265)
-    - MP4 missing faststart (moov atom at end), causing bad preview/streaming
+def _transcode_to_telegram_mp4(input_path: str, profile: Optional[EncodingProfile] = None) -> str:
+    """Make the downloaded video the file that gets uploaded.
 
-    This function forces a widely-supported baseline:
-    - container: MP4
-    - video: H.264 (libx264) + yuv420p
-    - audio: AAC
-    - faststart: +faststart
+    Compatibility fixes (container, codecs, faststart), shrinking to the Bot API
+    upload limit and the destination's encoding profile are applied in one pass; see
+    transcode.prepare_for_telegram. The encode runs on the transcode scheduler's
+    workers, this download thread only waits for it.
     """
+    return transcode_scheduler.submit(
+        prepare_for_telegram, input_path, priority=PRIORITY_DOWNLOAD, name=os.path.basename(input_path),
+        profile=profile,
+    ).result()
 
-    src = Path(input_path)
-
-    # If ffmpeg isn't installed, keep the original file.
-    try:
-        subprocess.run(["ffmpeg", "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-    except Exception:
-        logger.warning("ffmpeg not found; skipping Telegram-compatibility transcode")
-        return os.path.abspath(input_path)
-
-    # Keep output alongside input.
-    out_path = src.with_suffix(".mp4")
-    if out_path.resolve() == src.resolve():
-        # avoid clobbering in-place; write to temp then replace
-        out_path = src.with_name(f"{src.stem}.telegram.mp4")
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=str(src.parent)) as tmp:
-        tmp_path = Path(tmp.name)
-
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-i",
-        str(src),
-        "-c:v",
-        "libx264",
-        "-pix_fmt",
-        "yuv420p",
-        "-preset",
-        "ultrafast",
-        "-crf",
-        "23",
-        "-c:a",
-        "aac",
-        "-b:a",
-        "128k",
-        "-movflags",
-        "+faststart",
-        str(tmp_path),
-    ]
-
-    try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        if proc.returncode != 0:
-            logger.warning(
-                "ffmpeg transcode failed; uploading original file instead. ffmpeg output: %s",
-                (proc.stdout or "").strip()[-4000:],
-            )
-            try:
-                tmp_path.unlink(missing_ok=True)
-            except Exception:
-                pass
-            return os.path.abspath(input_path)
 
-        # Replace/rename output atomically
-        try:
-            tmp_path.replace(out_path)
-        except Exception:
-            # fallback: keep temp output
-            out_path = tmp_path
+def _canonical_post_url(post: Post) -> str:
+    """Return the /photo/ or /video/ URL matching the post's (possibly corrected) kind."""
+    if post.kind == 'video':
+        return post.url.replace('/photo/', '/video/')
+    if post.kind == 'slideshow':
+        return post.url.replace('/video/', '/photo/')
+    return post.url
 
-        logger.info("Transcoded for Telegram Desktop preview: %s -> %s", src, out_path)
-        return os.path.abspath(str(out_path))
-    finally:
-        # Cleanup temp if it still exists and wasn't moved
-        try:
-            if tmp_path.exists() and tmp_path != out_path:
-                tmp_path.unlink(missing_ok=True)
-        except Exception:
-            pass
 
-def download_post(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None) -> Optional[Dict[str, Any]]:
+def download_post(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None, probe_cache: Optional[Any] = None, partials: Optional[Any] = None, media_store: Optional[Any] = None, stream_transcode: bool = False, encoding_profile: Optional[EncodingProfile] = None) -> Optional[Dict[str, Any]]:
     """
     Dispatch download based on post kind.
     Returns a dict with downloaded media paths.
     Raises PostInaccessibleError if the post is deleted, private, or region-restricted.
+
+    If probe_cache (normally the StateStore) is given, a cached kind/URL overrides the
+    listing's classification, and the kind that actually worked is written back so a
+    misclassified post only pays for the wrong downloader once.
+
+    If partials (normally the StateStore) is given, interrupted slideshow downloads are
+    tracked there and resumed by the next attempt; the records are dropped once the post
+    is done. Videos resume through yt-dlp's own `.part` continuation.
+
+    If media_store (a MediaStore) is given, the downloaded files become links into the
+    content-addressed store, so media shared between posts is kept on disk once.
+
+    If stream_transcode is set, videos that need a re-encode anyway are piped from the
+    CDN straight into ffmpeg (see download_video).
+
+    encoding_profile (an EncodingProfile) is applied to every video of the post: it
+    steers the rendition choice and caps resolution and bitrates of the encodes.
     """
+    if probe_cache is not None:
+        cached = probe_cache.get_cached_probe(post.post_id)
+        if cached:
+            post.kind, post.url = cached
+
+    result = _download_post_by_kind(post, base_download_path, cookie_path, cookie_content, partials, media_store, stream_transcode, encoding_profile)
+    # The probe metadata is single-use; don't keep it alive with the post
+    post.probe_info = None
+
+    if result and probe_cache is not None:
+        probe_cache.record_probe(post.post_id, post.kind, _canonical_post_url(post))
+    if result and media_store is not None:
+        media_store.adopt_media(post.post_id, result)
+    if result and partials is not None:
+        partials.clear_partials(post.post_id)
+    return result
+
+
+def _download_post_by_kind(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None, partials: Optional[Any] = None, media_store: Optional[Any] = None, stream_transcode: bool = False, encoding_profile: Optional[EncodingProfile] = None) -> Optional[Dict[str, Any]]:
+    """Run the downloader for post.kind, falling back to the other kind on failure."""
     if post.kind == 'video':
-        path = download_video(post, base_download_path, cookie_path, cookie_content)
+        path = download_video(post, base_download_path, cookie_path, cookie_content, stream_transcode=stream_transcode, encoding_profile=encoding_profile)
         # If the video download failed (e.g. no formats found), attempt to treat the
         # post as a slideshow as a fallback. Some TikTok slideshows can be misclassified
         # as videos during the probe. Only fallback when no video file was returned.
@@ -298,7 +326,7 @@ def download_post(post: Post, base_download_path: str, cookie_path: Optional[str
             # Update the kind to slideshow so the caller can handle upload appropriately.
             post.kind = 'slideshow'
             # Fall back to slideshow downloader. Note: download_slideshow will not check kind.
-            result = download_slideshow(post, base_download_path, cookie_path, cookie_content)
+            result = download_slideshow(post, base_download_path, cookie_path, cookie_content, partials=partials, media_store=media_store)
             return result
     elif post.kind == 'slideshow':
         # Attempt to download images for a slideshow. Some TikTok posts are
@@ -307,13 +335,13 @@ def download_post(post: Post, base_download_path: str, cookie_path: Optional[str
         # download fails, fall back to the video downloader using a reconstructed
         # /video/ URL.
         try:
-            result = download_slideshow(post, base_download_path, cookie_path, cookie_content)
+            result = download_slideshow(post, base_download_path, cookie_path, cookie_content, partials=partials, media_store=media_store)
             if result:
                 if 'video' in result and 'images' not in result:
                     logger.info(f"Slideshow downloader returned a video for {post.post_id}; updating kind to video")
                     post.kind = 'video'
                     # Ensure the video is in a Telegram-friendly format
-                    result['video'] = _transcode_to_telegram_mp4(result['video'])
+                    result['video'] = _transcode_to_telegram_mp4(result['video'], profile=encoding_profile)
                 return result
         except PostInaccessibleError:
             # Post is inaccessible - don't retry, let caller handle
@@ -336,6 +364,7 @@ def download_post(post: Post, base_download_path: str, cookie_path: Optional[str
             cookie_path=cookie_path,
             cookie_content=cookie_content,
             url_override=fallback_url,
+            encoding_profile=encoding_profile,
         )
         if vid_path:
             # Update the kind to video so the caller can handle upload appropriately.
@@ -346,16 +375,205 @@ def download_post(post: Post, base_download_path: str, cookie_path: Optional[str
         logger.error(f"Unknown post kind: {post.kind}")
         return None
 
+def _fresh_probe_info(post: Post) -> Optional[Dict[str, Any]]:
+    """Return the probe's info dict if it is young enough for its media URLs to still work."""
+    if not post.probe_info or post.probed_at is None:
+        return None
+    if time.time() - post.probed_at > PROBE_INFO_TTL:
+        return None
+    return post.probe_info
+
+
+def _reusable_probe_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The probe's info dict with the probe's own format selection removed, for
+    process_ie_result(). Left in, its requested_formats would be merged instead of
+    what select_telegram_format() picks. Same cleanup as yt-dlp's --load-info-json.
+    """
+    clean = yt_dlp.YoutubeDL.sanitize_info(dict(info), remove_private_keys=True)
+    if clean.get('formats'):
+        clean.pop('format_id', None)
+        clean.pop('url', None)
+    return clean
+
+
+def _format_size(fmt: Dict[str, Any]) -> Optional[int]:
+    return fmt.get('filesize') or fmt.get('filesize_approx')
+
+
+def _is_telegram_compatible_format(fmt: Dict[str, Any]) -> bool:
+    vcodec = (fmt.get('vcodec') or '').lower()
+    acodec = fmt.get('acodec')
+    return (vcodec.startswith(H264_VCODEC_PREFIXES)
+            and (acodec is None or acodec.lower().startswith(TELEGRAM_ACODEC_PREFIXES)))
+
+
+def _short_side(fmt: Dict[str, Any]) -> Optional[int]:
+    """The rendition's shorter side (720 for 720p, portrait or landscape), if known."""
+    width, height = fmt.get('width'), fmt.get('height')
+    if width and height:
+        return min(width, height)
+    return height or None
+
+
+def choose_video_format(formats: List[Dict[str, Any]], limit_mb: float,
+                        max_resolution: Optional[int] = None) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    Pick the TikTok rendition that needs the least work before upload.
+
+    formats are in yt-dlp's order (worst first). Only renditions with both video and
+    audio are considered, unplayable and watermarked ones last. In order of preference:
+    the best H.264/AAC rendition under limit_mb (uploaded as-is), the best H.264/AAC
+    one of unknown size, the best one under the limit (one compatibility encode), and
+    finally the smallest, which prepare_for_telegram() has to compress.
+    With max_resolution (from an encoding profile), renditions whose shorter side is
+    above it are only considered when nothing smaller is offered, since they would
+    have to be downscaled anyway.
+    Returns (format, reason), or (None, reason) when nothing qualifies.
+    """
+    limit = limit_mb * 1024 * 1024
+    muxed = [
+        f for f in formats
+        if f.get('vcodec') != 'none' and f.get('acodec') != 'none' and (f.get('preference') or 0) > -100
+    ]
+    candidates = [f for f in muxed if 'watermark' not in (f.get('format_note') or '').lower()] or muxed
+    if not candidates:
+        return None, "no rendition with both video and audio"
+    if max_resolution:
+        candidates = [f for f in candidates if (_short_side(f) or 0) <= max_resolution] or candidates
+
+    def fits(f):
+        size = _format_size(f)
+        return size is not None and size < limit
+
+    tiers = [
+        (lambda f: _is_telegram_compatible_format(f) and fits(f), f"H.264/AAC under the {limit_mb}MB upload limit"),
+        (lambda f: _is_telegram_compatible_format(f) and _format_size(f) is None, "H.264/AAC, size unknown"),
+        (fits, f"under the {limit_mb}MB upload limit, needs a compatibility encode"),
+    ]
+    for predicate, why in tiers:
+        matches = [f for f in candidates if predicate(f)]
+        if matches:
+            chosen = matches[-1]
+            break
+    else:
+        chosen = min(candidates, key=lambda f: _format_size(f) or float('inf'))
+        why = f"every rendition is over the {limit_mb}MB upload limit, smallest needs compression"
+
+    size = _format_size(chosen)
+    size_text = f"{size / (1024 * 1024):.1f}MB" if size else "unknown size"
+    return chosen, (f"{chosen.get('format_id')} ({chosen.get('vcodec')}/{chosen.get('acodec')}, "
+                    f"{chosen.get('height') or '?'}p, {size_text}): {why}")
+
+
+_default_format_selector = None
+
+
+def select_telegram_format(ctx: Dict[str, Any]):
+    """yt-dlp format selector (the `format` option also takes a callable) applying choose_video_format()."""
+    global _default_format_selector
+    chosen, reason = choose_video_format(
+        ctx['formats'], upload_limit_mb(), getattr(_selection, 'max_resolution', None)
+    )
+    if chosen is not None:
+        logger.info(f"Selected format {reason}")
+        yield chosen
+        return
+    logger.info(f"No preferred rendition ({reason}); falling back to '{DEFAULT_VIDEO_FORMAT}'")
+    if _default_format_selector is None:
+        _default_format_selector = yt_dlp.YoutubeDL({'quiet': True}).build_format_selector(DEFAULT_VIDEO_FORMAT)
+    yield from _default_format_selector(ctx)
+
+
+def _stream_video(ydl: Any, post: Post, info: Dict[str, Any], creator_path: str,
+                  profile: Optional[EncodingProfile] = None) -> Optional[str]:
+    """
+    Pipe the chosen rendition from the CDN into ffmpeg when it needs a re-encode.
+
+    Returns the final `{post_id}.mp4`, or None when the rendition can be uploaded
+    as-is (nothing to gain) or streaming failed.
+    """
+    limit_mb = upload_limit_mb()
+    fmt, reason = choose_video_format(
+        info.get('formats') or [], limit_mb, profile.max_resolution if profile else None
+    )
+    duration = info.get('duration')
+    if fmt is None or not fmt.get('url') or not duration:
+        return None
+    size = _format_size(fmt)
+    compress = size is not None and size >= limit_mb * 1024 * 1024
+    profile_reason = None
+    if profile is not None:
+        profile_reason = profile.requires_encode(MediaInfo(
+            path=fmt['url'], format_name=fmt.get('ext') or '', duration=float(duration), size=size or 0,
+            video_codec=fmt.get('vcodec'), pix_fmt=None, width=fmt.get('width'), height=fmt.get('height'),
+            audio_codec=fmt.get('acodec'), faststart=None,
+        ))
+        if profile_reason:
+            reason = f"{reason}; encoding profile: {profile_reason}"
+    if _is_telegram_compatible_format(fmt) and not compress and not profile_reason:
+        return None
+
+    out_path = os.path.join(creator_path, f"{post.post_id}.mp4")
+    logger.info(f"Streaming {post.post_id} into ffmpeg: {reason}")
+
+    def job(threads: int) -> bool:
+        # Same header/cookie handling yt-dlp applies to the download itself
+        headers = ydl._calc_headers(fmt, load_cookies=True)
+        with ydl.urlopen(YtdlRequest(fmt['url'], headers=dict(headers))) as response:
+            return stream_encode(response, out_path, float(duration), compress, limit_mb, threads, profile)
+
+    try:
+        ok = transcode_scheduler.submit(
+            job, priority=PRIORITY_DOWNLOAD, name=f"{post.post_id} (stream)"
+        ).result()
+    except Exception as e:
+        tiktok_rate.report_error(e)
+        logger.warning(f"Streaming encode of {post.post_id} failed: {e}")
+        ok = False
+    if not ok:
+        logger.warning(f"Falling back to a regular download of {post.post_id}")
+        return None
+    return os.path.abspath(out_path)
+
+
+def _video_size_ok(filename: str, info: Dict[str, Any]) -> bool:
+    """Cheap sanity check of a (possibly resumed) download against the format's reported size."""
+    size = os.path.getsize(filename)
+    if size == 0:
+        logger.error(f"Downloaded video is empty: {filename}")
+        return False
+    # Merged downloads are remuxed, so only a single-format download has a comparable size.
+    # Fixups may still rewrite the container, so only a short file counts as truncated.
+    expected = info.get('filesize') if not info.get('requested_formats') else None
+    if expected and size < expected:
+        logger.error(f"Downloaded video {filename} is {size} bytes, expected {expected}")
+        return False
+    return True
+
+
 def download_video(
     post: Post,
     base_download_path: str,
     cookie_path: Optional[str] = None,
     cookie_content: Optional[str] = None,
     url_override: Optional[str] = None,
+    stream_transcode: bool = False,
+    encoding_profile: Optional[EncodingProfile] = None,
 ) -> Optional[str]:
     """
     Download a TikTok video post using yt-dlp.
     Returns the path to the downloaded file.
+
+    yt-dlp continues any `.part` file left by an interrupted run and validates the
+    resumed bytes itself; the finished file is size-checked by _video_size_ok().
+
+    With stream_transcode, a rendition that has to be re-encoded anyway (see
+    choose_video_format) is piped into ffmpeg instead of being written to disk first.
+    Streaming can't resume, so any failure falls back to the normal download.
+
+    encoding_profile (an EncodingProfile) makes the format selection prefer
+    renditions within its resolution and is applied by the encode afterwards.
     """
     # Create structured directory: downloads/{creator}/
     creator_path = os.path.join(base_download_path, post.creator)
@@ -364,15 +582,17 @@ def download_video(
     # Filename pattern: {post_id}.mp4
     output_template = os.path.join(creator_path, f"{post.post_id}.%(ext)s")
     
-    # Prefer MP4 downloads (helps Telegram compatibility) and avoid formats that
-    # frequently produce audio-only outputs.
+    # Prefer the rendition Telegram takes as-is (H.264/AAC under the upload limit),
+    # so that no transcode or compression is needed afterwards.
     ydl_opts = {
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+        'format': select_telegram_format,
         'merge_output_format': 'mp4',
-        'outtmpl': output_template,
         'quiet': True,
         'no_warnings': True,
         'concurrent_fragment_downloads': 2,
+        # Resume .part files from interrupted runs instead of starting from byte zero
+        'continuedl': True,
+        'nopart': False,
         'http_headers': {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         },
@@ -391,11 +611,34 @@ def download_video(
     try:
         # Cast ydl_opts to ``Dict[str, Any]`` to satisfy static type checkers.
         ydl_params = cast(Dict[str, Any], ydl_opts)
-        with yt_dlp.YoutubeDL(ydl_params) as ydl:  # type: ignore[arg-type]
+        _selection.max_resolution = encoding_profile.max_resolution if encoding_profile else None
+        # The output template is per post; everything else is shared by the pooled instance.
+        with ytdl_pool.borrow("download", ydl_params, outtmpl=output_template) as ydl:
             # Allow overriding the URL to support fallback scenarios (e.g. when a post
             # was misclassified as a slideshow and we need to try the /video/ endpoint).
             target_url = url_override if url_override else post.url
-            info = ydl.extract_info(target_url, download=True)
+            leftover = [n for n in os.listdir(creator_path) if n.startswith(f"{post.post_id}.") and n.endswith(".part")]
+            if leftover:
+                logger.info(f"Resuming interrupted download of {post.post_id} ({', '.join(leftover)})")
+            tiktok_budget.acquire()
+            info = None
+            probe_info = None if url_override else _fresh_probe_info(post)
+            # A leftover .part is cheaper to resume than to stream again
+            if stream_transcode and probe_info is not None and not leftover:
+                streamed = _stream_video(ydl, post, probe_info, creator_path, encoding_profile)
+                if streamed:
+                    tiktok_rate.on_success()
+                    return streamed
+            if probe_info is not None:
+                # Metadata is already known; only fetch the media itself.
+                try:
+                    info = ydl.process_ie_result(_reusable_probe_info(probe_info), download=True)
+                    logger.info(f"Reused probe metadata for {post.post_id}")
+                except Exception as e:
+                    logger.warning(f"Reusing probe metadata failed for {post.post_id}, re-extracting: {e}")
+            if info is None:
+                info = ydl.extract_info(target_url, download=True)
+            tiktok_rate.on_success()
             # Find the actual filename
             filename = ydl.prepare_filename(info)
             # If it was merged, the extension might have changed to mp4
@@ -404,88 +647,173 @@ def download_video(
                 base, _ = os.path.splitext(filename)
                 filename = f"{base}.mp4"
                 
+            if os.path.exists(filename) and not _video_size_ok(filename, info):
+                os.remove(filename)
+                return None
             if os.path.exists(filename):
                 logger.info(f"Successfully downloaded video: {filename}")
                 # Enforce Telegram Desktop-friendly MP4 (H.264/AAC + faststart)
-                out_path = _transcode_to_telegram_mp4(filename)
+                out_path = _transcode_to_telegram_mp4(filename, profile=encoding_profile)
                 return out_path
             else:
                 logger.error(f"Download finished but file not found: {filename}")
                 return None
                 
     except Exception as e:
+        tiktok_rate.report_error(e)
         logger.error(f"Failed to download video {post.post_id}: {e}")
         return None
+    finally:
+        _selection.max_resolution = None
 
 def _is_gallery_dl_available() -> bool:
-    """Check if gallery-dl is available on the system."""
-    try:
-        subprocess.run(
-            ["gallery-dl", "--version"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=True
-        )
-        return True
-    except Exception:
-        return False
+    """Check if gallery-dl can be imported (checked once, at import time)."""
+    return _GALLERY_DL_AVAILABLE
+
+
+class _LogCapture(logging.Handler):
+    """
+    Collects gallery-dl's log messages so errors can be classified like its stderr was.
+
+    Jobs run concurrently and share gallery-dl's loggers, so only records tagged
+    with this capture's job are kept.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.DEBUG)
+        self.messages: List[str] = []
+        self.job: Any = None
+
+    def emit(self, record: logging.LogRecord):
+        if getattr(record, "job", None) is not self.job:
+            return
+        try:
+            self.messages.append(record.getMessage())
+        except Exception:
+            pass
+
+
+def _setup_gallery_dl():
+    """
+    Prepare gallery-dl's process-wide state once: the user's gallery-dl config files
+    are loaded as the CLI would, console output is off unless configured, and its
+    loggers pass INFO ("No results" is logged at INFO).
+    """
+    global _gallery_dl_ready
+    with _gallery_dl_lock:
+        if _gallery_dl_ready:
+            return
+        gdl_config.load()
+        gdl_config.setdefault(("output",), "mode", "null")
+        for name in GALLERY_DL_LOGGERS:
+            gdl_logger = logging.getLogger(name)
+            if gdl_logger.level == logging.NOTSET or gdl_logger.level > logging.INFO:
+                gdl_logger.setLevel(logging.INFO)
+        _gallery_dl_ready = True
+
+
+def _gallery_dl_extractor(url: str, output_path: str, cookies: Dict[str, str]) -> Any:
+    """
+    gallery-dl extractor for url with this job's options layered over the global config.
+
+    The output directory and cookies differ per job, so they are answered by the
+    extractor itself instead of being written into gallery-dl's shared config; jobs
+    don't have to run one at a time and the user's own settings stay as they are.
+    """
+    extr = gdl_extractor.find(url)
+    if extr is None:
+        raise PostRetryableError(f"gallery-dl has no extractor for {url}")
+    options: Dict[str, Any] = {
+        # Same as `--directory output_path`: files go exactly there
+        "base-directory": output_path,
+        "directory": (),
+        "filename": "{num:>02}.{extension}",
+        "user-agent": GALLERY_DL_USER_AGENT,
+    }
+    if cookies:
+        options["cookies"] = dict(cookies)
+    shared = extr.config
+
+    def config(key, default=None):
+        return options[key] if key in options else shared(key, default)
+
+    extr.config = config
+    return extr
+
+
+def _load_cookie_dict(cookie_path: Optional[str], cookie_content: Optional[str]) -> Dict[str, str]:
+    """TikTok cookies as a name -> value dict, parsed once per cookie file version."""
+    if cookie_path and os.path.exists(cookie_path):
+        mtime = os.path.getmtime(cookie_path)
+        entry = _gallery_dl_cookies.get(cookie_path)
+        if entry is not None and entry[0] == mtime:
+            cached = entry[1]
+        else:
+            jar = http.cookiejar.MozillaCookieJar(cookie_path)
+            try:
+                jar.load(ignore_discard=True, ignore_expires=True)
+            except (OSError, http.cookiejar.LoadError) as e:
+                logger.warning(f"Could not parse cookie file {cookie_path} for gallery-dl: {e}")
+            cached = {c.name: c.value or "" for c in jar if "tiktok" in (c.domain or "")}
+            _gallery_dl_cookies[cookie_path] = (mtime, cached)
+        return cached
+    if cookie_content:
+        pairs = (part.split("=", 1) for part in cookie_content.split(";") if "=" in part)
+        return {name.strip(): value.strip() for name, value in pairs}
+    return {}
 
 
 def _download_slideshow_gallery_dl(post: Post, output_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None) -> Optional[Dict[str, Any]]:
     """
-    Download TikTok slideshow images using gallery-dl.
+    Download TikTok slideshow images using gallery-dl's Python API.
     Returns dict with 'images' list and optional 'audio' path.
     Raises PostInaccessibleError if the post is deleted, private, or region-restricted.
+
+    The per-job options are set on the extractor (see _gallery_dl_extractor), so
+    several slideshows can download at once.
     """
     os.makedirs(output_path, exist_ok=True)
+    cookies = _load_cookie_dict(cookie_path, cookie_content)
+    _setup_gallery_dl()
 
-    command = [
-        "gallery-dl",
-        "--directory", output_path,
-        "--filename", "{num:>02}.{extension}",
-    ]
+    logger.info(f"Running gallery-dl for slideshow {post.post_id}")
 
-    # Use Netscape format cookie file with -C option if available
-    if cookie_path and os.path.exists(cookie_path):
-        command.extend(['-C', cookie_path])
-    elif cookie_content:
-        # Fallback: use http-headers with cookie content
-        command.extend(["-o", f"http-headers=Cookie: {cookie_content}"])
-    
-    # Always set User-Agent for better reliability
-    command.extend(["-a", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"])
-
-    command.append(post.url)
+    capture = _LogCapture()
+    gdl_loggers = [logging.getLogger(name) for name in GALLERY_DL_LOGGERS]
+    for gdl_logger in gdl_loggers:
+        gdl_logger.addHandler(capture)
+    try:
+        job = gdl_job.DownloadJob(_gallery_dl_extractor(post.url, output_path, cookies))
+        capture.job = job
+        tiktok_budget.acquire()
+        status = job.run()
+    except Exception as e:
+        capture.messages.append(str(e))
+        status = 1
+    finally:
+        for gdl_logger in gdl_loggers:
+            gdl_logger.removeHandler(capture)
 
-    logger.info(f"Running gallery-dl for slideshow {post.post_id}: {' '.join(command)}")
+    output = "\n".join(capture.messages)
+    logger.debug(f"gallery-dl output: {output}")
+    if status:
+        tiktok_rate.report_error(output)
 
-    try:
-        result = subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        logger.debug(f"gallery-dl stdout: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        stderr = e.stderr or ""
-        stdout = e.stdout or ""
-        
         # Check for "No results" - indicates deleted/private/region-restricted post
-        if "No results" in stderr or "No results" in stdout:
+        if "No results" in output:
             logger.warning(f"Post {post.post_id} appears to be deleted, private, or region-restricted (gallery-dl: No results)")
             raise PostInaccessibleError(f"Post {post.post_id} is inaccessible: No results from gallery-dl")
         
         # Check for 403 Forbidden
-        if "403" in stderr or "Forbidden" in stderr:
+        if "403" in output or "Forbidden" in output:
             logger.warning(f"Post {post.post_id} returned 403 Forbidden")
             raise PostInaccessibleError(f"Post {post.post_id} is inaccessible: 403 Forbidden")
         
-        logger.error(f"gallery-dl failed for {post.post_id}: {stderr}")
-        raise PostRetryableError(f"gallery-dl failed for {post.post_id}: {stderr}")
+        logger.error(f"gallery-dl failed for {post.post_id} (status {status}): {output}")
+        raise PostRetryableError(f"gallery-dl failed for {post.post_id}: {output}")
     
     # Check output for "No results" even on successful exit
-    if result.stdout and "No results" in result.stdout:
+    if "No results" in output:
         logger.warning(f"Post {post.post_id} appears to be deleted, private, or region-restricted (gallery-dl: No results)")
         raise PostInaccessibleError(f"Post {post.post_id} is inaccessible: No results from gallery-dl")
 
@@ -530,7 +858,106 @@ def _download_slideshow_gallery_dl(post: Post, output_path: str, cookie_path: Op
     return {"images": image_files, "audio": audio_path}
 
 
-def _download_slideshow_fallback(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None) -> Optional[Dict[str, Any]]:
+def _expected_size(resp: requests.Response, offset: int) -> Optional[int]:
+    """Full size of the resource from Content-Range (206) or Content-Length (200)."""
+    content_range = resp.headers.get('Content-Range') or ''
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    length = resp.headers.get('Content-Length')
+    if length and str(length).isdigit():
+        return int(length) + offset
+    return None
+
+
+def _stream_to_file(
+    session: requests.Session,
+    url: str,
+    dest_dir: str,
+    stem: str,
+    content_types: Dict[str, str],
+    default_ext: str,
+    timeout: int,
+    post_id: Optional[str] = None,
+    partials: Optional[Any] = None,
+    media_store: Optional[Any] = None,
+) -> str:
+    """
+    Stream a media URL to `dest_dir/stem.ext` without holding the body in memory.
+    The extension comes from the Content-Type header. The body goes to `.stem.part`
+    and is renamed into place once its size checks out, so a half-written file never
+    has the final name.
+
+    A `.part` left by an interrupted run is resumed with an HTTP Range request.
+    partials (normally the StateStore) remembers the expected size and ETag so the
+    server can refuse a stale range (If-Range) and the result can be verified.
+
+    With a media_store, an object already stored under the same CDN path and
+    ETag/size is linked into place without reading the body, and a new file is
+    added to the store.
+    Returns the absolute path of the file.
+    """
+    part_path = os.path.join(dest_dir, f".{stem}.part")
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    headers: Dict[str, str] = {}
+    if offset:
+        headers['Range'] = f"bytes={offset}-"
+        record = partials.get_partial(post_id, part_path) if partials is not None and post_id else None
+        if record and record.get('etag'):
+            headers['If-Range'] = record['etag']
+
+    resp = session.get(url, timeout=timeout, stream=True, headers=headers)
+    try:
+        if resp.status_code == 416:
+            # Range no longer satisfiable (resource changed); start over
+            resp.close()
+            os.remove(part_path)
+            return _stream_to_file(session, url, dest_dir, stem, content_types, default_ext, timeout,
+                                   post_id, partials, media_store)
+        resp.raise_for_status()
+
+        if offset and resp.status_code == 206:
+            logger.info(f"Resuming {stem} of {post_id or dest_dir} at byte {offset}")
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+
+        content_type = (resp.headers.get('Content-Type', '') or '').lower()
+        ext = next((e for ct, e in content_types.items() if ct in content_type), default_ext)
+        filename = os.path.join(dest_dir, f"{stem}.{ext}")
+        expected = _expected_size(resp, offset)
+        key = source_key(url, expected, resp.headers.get('ETag'))
+        if media_store is not None and post_id:
+            stored = media_store.link_key(key, post_id, filename)
+            if stored:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                return stored
+        if partials is not None and post_id:
+            partials.record_partial(post_id, part_path, url, expected, resp.headers.get('ETag'))
+
+        with open(part_path, mode) as f:
+            for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+    finally:
+        resp.close()
+
+    size = os.path.getsize(part_path)
+    if expected is not None and size != expected:
+        # A bad resume can't be fixed by appending more; throw it away
+        os.remove(part_path)
+        raise IOError(f"Size mismatch for {filename}: got {size} bytes, expected {expected}")
+    os.replace(part_path, filename)
+    if media_store is not None and post_id:
+        return media_store.adopt(post_id, filename, key=key)
+    return os.path.abspath(filename)
+
+
+def _download_slideshow_fallback(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None, partials: Optional[Any] = None, media_store: Optional[Any] = None) -> Optional[Dict[str, Any]]:
     """
     Fallback slideshow download using yt-dlp metadata extraction and direct HTTP requests.
     Used when gallery-dl is not available or fails.
@@ -553,27 +980,33 @@ def _download_slideshow_fallback(post: Post, base_download_path: str, cookie_pat
         ydl_opts['http_headers']['Cookie'] = cookie_content
 
     try:
-        info = None
-        try:
-            # Cast ydl_opts to ``Dict[str, Any]`` to satisfy type checkers when passing
-            # into ``yt_dlp.YoutubeDL``.
-            ydl_params = cast(Dict[str, Any], ydl_opts)
-            with yt_dlp.YoutubeDL(ydl_params) as ydl:  # type: ignore[arg-type]
-                # Convert /photo/ URL to /video/ for yt-dlp compatibility
-                # yt-dlp doesn't support /photo/ URLs directly, needs /video/ URL
-                video_url = post.url.replace('/photo/', '/video/')
-                logger.info(f"Using converted URL for yt-dlp: {video_url}")
-                info = ydl.extract_info(video_url, download=False)
-        except Exception as e:
-            error_str = str(e)
-            logger.warning(
-                "yt-dlp metadata extraction failed for slideshow %s; falling back to HTML parsing. Error: %s",
-                post.post_id,
-                e,
-            )
-            # Check for inaccessible post errors
-            if "No results" in error_str or "403" in error_str or "Forbidden" in error_str:
-                raise PostInaccessibleError(f"Post {post.post_id} is inaccessible: {e}")
+        info = _fresh_probe_info(post)
+        if info is not None:
+            logger.info(f"Reusing probe metadata for slideshow {post.post_id}")
+        else:
+            try:
+                # Cast ydl_opts to ``Dict[str, Any]`` to satisfy type checkers when passing
+                # into the pooled ``yt_dlp.YoutubeDL``.
+                ydl_params = cast(Dict[str, Any], ydl_opts)
+                tiktok_budget.acquire()
+                with ytdl_pool.borrow("metadata", ydl_params) as ydl:
+                    # Convert /photo/ URL to /video/ for yt-dlp compatibility
+                    # yt-dlp doesn't support /photo/ URLs directly, needs /video/ URL
+                    video_url = post.url.replace('/photo/', '/video/')
+                    logger.info(f"Using converted URL for yt-dlp: {video_url}")
+                    info = ydl.extract_info(video_url, download=False)
+                tiktok_rate.on_success()
+            except Exception as e:
+                error_str = str(e)
+                tiktok_rate.report_error(error_str)
+                logger.warning(
+                    "yt-dlp metadata extraction failed for slideshow %s; falling back to HTML parsing. Error: %s",
+                    post.post_id,
+                    e,
+                )
+                # Check for inaccessible post errors
+                if "No results" in error_str or "403" in error_str or "Forbidden" in error_str:
+                    raise PostInaccessibleError(f"Post {post.post_id} is inaccessible: {e}")
 
         image_urls: List[str] = []
         audio_url: Optional[str] = None
@@ -625,49 +1058,36 @@ def _download_slideshow_fallback(post: Post, base_download_path: str, cookie_pat
             logger.error(f"No images found in slideshow {post.post_id}")
             return None
 
-        downloaded_files: List[str] = []
-        for i, url in enumerate(image_urls):
-            ext = "jpg"
-            filename = os.path.join(creator_path, f"{i+1}.{ext}")
-            resp = session.get(url, timeout=15)
-            resp.raise_for_status()
-
-            content_type = (resp.headers.get('Content-Type', '') or '').lower()
-            if 'image/png' in content_type:
-                ext = "png"
-            elif 'image/webp' in content_type:
-                ext = "webp"
-            elif 'image/jpeg' in content_type or 'image/jpg' in content_type:
-                ext = "jpg"
-
-            if ext != "jpg":
-                filename = os.path.join(creator_path, f"{i+1}.{ext}")
-
-            with open(filename, 'wb') as f:
-                f.write(resp.content)
-
-            # Use absolute path for reliability
-            abs_path = os.path.abspath(filename)
-            downloaded_files.append(abs_path)
-            logger.info(f"Downloaded slideshow image {i+1}/{len(image_urls)}: {abs_path}")
-
-        audio_path: Optional[str] = None
-        if audio_url:
-            try:
+        session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=SLIDESHOW_FETCH_WORKERS))
+        workers = max(1, min(SLIDESHOW_FETCH_WORKERS, len(image_urls) + (1 if audio_url else 0)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            audio_future = None
+            if audio_url:
                 logger.info("Downloading slideshow audio for %s", post.post_id)
-                aresp = session.get(audio_url, timeout=20)
-                aresp.raise_for_status()
-                act = (aresp.headers.get('Content-Type', '') or '').lower()
-                aext = "m4a"
-                if 'audio/mpeg' in act:
-                    aext = "mp3"
-                elif 'audio/mp4' in act or 'audio/x-m4a' in act:
-                    aext = "m4a"
-                audio_path = os.path.join(creator_path, f"audio.{aext}")
-                with open(audio_path, 'wb') as f:
-                    f.write(aresp.content)
-            except Exception as e:
-                logger.warning("Failed to download slideshow audio for %s: %s", post.post_id, e)
+                audio_future = pool.submit(
+                    _stream_to_file, session, audio_url, creator_path, "audio", AUDIO_CONTENT_TYPES, "m4a", 20,
+                    post.post_id, partials, media_store,
+                )
+            image_futures = [
+                pool.submit(
+                    _stream_to_file, session, url, creator_path, str(i + 1), IMAGE_CONTENT_TYPES, "jpg", 15,
+                    post.post_id, partials, media_store,
+                )
+                for i, url in enumerate(image_urls)
+            ]
+
+            downloaded_files: List[str] = []
+            for i, future in enumerate(image_futures):
+                abs_path = future.result()
+                downloaded_files.append(abs_path)
+                logger.info(f"Downloaded slideshow image {i+1}/{len(image_urls)}: {abs_path}")
+
+            audio_path: Optional[str] = None
+            if audio_future is not None:
+                try:
+                    audio_path = audio_future.result()
+                except Exception as e:
+                    logger.warning("Failed to download slideshow audio for %s: %s", post.post_id, e)
 
         return {"images": downloaded_files, "audio": audio_path}
 
@@ -682,7 +1102,7 @@ def _download_slideshow_fallback(post: Post, base_download_path: str, cookie_pat
         raise PostRetryableError(f"Failed to download slideshow {post.post_id}: {e}")
 
 
-def download_slideshow(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None) -> Optional[Dict[str, Any]]:
+def download_slideshow(post: Post, base_download_path: str, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None, partials: Optional[Any] = None, media_store: Optional[Any] = None) -> Optional[Dict[str, Any]]:
     """
     Download a TikTok slideshow (multiple images).
     
@@ -710,4 +1130,4 @@ def download_slideshow(post: Post, base_download_path: str, cookie_path: Optiona
         logger.info(f"gallery-dl not available, using fallback method for slideshow {post.post_id}")
     
     # Fallback to yt-dlp/HTML parsing method
-    return _download_slideshow_fallback(post, base_download_path, cookie_path, cookie_content)
+    return _download_slideshow_fallback(post, base_download_path, cookie_path, cookie_content, partials=partials, media_store=media_store)
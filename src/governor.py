@@ -0,0 +1,83 @@
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("tok2gram.governor")
+
+# ionice scheduling classes (see ionice(1))
+IONICE_BEST_EFFORT = 2
+IONICE_IDLE = 3
+
+
+class ProcessGovernor:
+    """
+    Run external media tools (ffmpeg, ffprobe) below the bot's own priority.
+
+    wrap() prefixes a command with `nice` and `ionice`, which set the scheduling
+    priority and then exec the tool, so the child keeps its pid (and wait4() still
+    reports its CPU time and peak RSS). Uploads and the event loop stay responsive
+    while an encode saturates the CPU or the disk. Where the tools are missing
+    (non-Linux hosts, minimal containers) commands run unchanged.
+
+    A command whose own tool is not installed is also left unwrapped: `nice` would
+    exit with 127 instead, and callers rely on the FileNotFoundError to tell a
+    missing ffmpeg/ffprobe from a failed run.
+    """
+
+    def __init__(self, nice: int = 10, ionice_class: Optional[int] = IONICE_BEST_EFFORT, ionice_level: int = 7):
+        self._lock = threading.Lock()
+        self._prefix: Optional[List[str]] = None
+        self._installed: Dict[str, bool] = {}
+        self.configure(nice, ionice_class, ionice_level)
+
+    def configure(self, nice: Optional[int] = None, ionice_class: Optional[int] = None, ionice_level: Optional[int] = None):
+        """Change the levels; nice 0 or ionice_class 0 turns that part off."""
+        with self._lock:
+            if nice is not None:
+                self.nice = max(0, min(19, int(nice)))
+            if ionice_class is not None:
+                self.ionice_class = int(ionice_class)
+            if ionice_level is not None:
+                self.ionice_level = max(0, min(7, int(ionice_level)))
+            self._prefix = None
+            self._installed.clear()
+
+    def _build_prefix(self) -> List[str]:
+        prefix: List[str] = []
+        if self.ionice_class:
+            ionice = shutil.which("ionice")
+            if ionice:
+                prefix += [ionice, "-c", str(self.ionice_class)]
+                if self.ionice_class == IONICE_BEST_EFFORT:
+                    prefix += ["-n", str(self.ionice_level)]
+            else:
+                logger.info("ionice not found; media tools run at normal I/O priority")
+        if self.nice:
+            nice = shutil.which("nice")
+            if nice:
+                prefix += [nice, "-n", str(self.nice)]
+            else:
+                logger.info("nice not found; media tools run at normal CPU priority")
+        return prefix
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        """Return cmd prefixed with the configured nice/ionice invocation."""
+        if os.name != "posix":
+            return cmd
+        with self._lock:
+            if self._prefix is None:
+                self._prefix = self._build_prefix()
+            prefix = self._prefix
+            if prefix and cmd:
+                installed = self._installed.get(cmd[0])
+                if installed is None:
+                    installed = self._installed[cmd[0]] = shutil.which(cmd[0]) is not None
+                if not installed:
+                    return cmd
+        return prefix + cmd
+
+
+# Process-wide governor for every ffmpeg/ffprobe child.
+governor = ProcessGovernor()
@@ -57,13 +57,14 @@ async def process_creator(creator_config: dict, settings: dict, state: StateStor
     logger.info(f"Processing creator: {username}")
     
     cookie_content = cookie_manager.get_cookie_content()
-    posts = fetch_posts(username, depth=fetch_depth, cookie_content=cookie_content)
+    posts = fetch_posts(username, depth=fetch_depth, cookie_content=cookie_content, filter_unseen=state.filter_unseen)
     
-    if not posts and cookie_manager.cookie_files:
-        logger.warning(f"No posts found for {username}, attempting cookie rotation...")
+    # Nothing new is the usual answer; only an empty or failed listing is worth another cookie
+    if not posts.listed and cookie_manager.cookie_files:
+        logger.warning(f"Listing for {username} came back empty, attempting cookie rotation...")
         cookie_manager.rotate()
         cookie_content = cookie_manager.get_cookie_content()
-        posts = fetch_posts(username, depth=fetch_depth, cookie_content=cookie_content)
+        posts = fetch_posts(username, depth=fetch_depth, cookie_content=cookie_content, filter_unseen=state.filter_unseen)
 
     sorted_posts = sort_posts_chronologically(posts)
     
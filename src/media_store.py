@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import shutil
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from .core.state import StateStore
+
+logger = logging.getLogger("tok2gram.media_store")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def source_key(url: str, size: Optional[int] = None, etag: Optional[str] = None) -> Optional[str]:
+    """
+    Identify a CDN object without downloading it: the URL path (signed query strings
+    change on every request) plus the ETag or, failing that, the size.
+    Returns None when neither validator is known, since a bare path is not safe to trust.
+    """
+    path = urlparse(url).path
+    if not path or path == "/":
+        return None
+    if etag:
+        return f"{path}|etag:{etag.strip()}"
+    if size:
+        return f"{path}|size:{size}"
+    return None
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MediaStore:
+    """
+    Content-addressed store for downloaded media.
+
+    Every file is kept once under root/ab/cd/<sha256><ext>; the per-post files in
+    downloads/{creator}/... are hard links to it (symlinks or copies where hard links
+    are not possible). Blobs are also indexed by source_key(), so a repeated CDN object
+    such as a shared music track is linked without downloading it again.
+    References are counted per post in the StateStore; a blob is only deleted when
+    the last post referencing it is released.
+    """
+
+    def __init__(self, state: StateStore, root: str = "data/media"):
+        self.state = state
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}{ext}")
+
+    @staticmethod
+    def _link(blob: str, dest: str):
+        """Point dest at blob, replacing whatever is at dest."""
+        tmp = f"{dest}.link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(blob), tmp)
+            except OSError:
+                shutil.copy2(blob, tmp)
+        os.replace(tmp, dest)
+
+    def link_key(self, key: Optional[str], post_id: str, dest: str) -> Optional[str]:
+        """Link a known blob to dest by source key. Returns dest's absolute path, or None on a miss."""
+        if not key:
+            return None
+        found = self.state.get_blob_by_key(key)
+        if found is None:
+            return None
+        digest, blob = found
+        if not os.path.exists(blob):
+            self.state.forget_blob(digest)
+            return None
+        self._link(blob, dest)
+        dest = os.path.abspath(dest)
+        self.state.add_blob_ref(post_id, dest, digest)
+        logger.info(f"Reused stored media for {post_id}: {os.path.basename(dest)}")
+        return dest
+
+    def adopt(self, post_id: str, path: str, key: Optional[str] = None) -> str:
+        """
+        Move a freshly downloaded file into the store (or drop it in favour of an
+        identical blob) and leave a link at its original path. Returns the path.
+        """
+        path = os.path.abspath(path)
+        if self.state.get_blob_ref(post_id, path) is not None:
+            return path
+
+        digest = file_digest(path)
+        blob = self.state.get_blob(digest)
+        if blob and os.path.exists(blob):
+            logger.info(f"Deduplicated {os.path.basename(path)} of {post_id} against stored media")
+        else:
+            blob = self._blob_path(digest, os.path.splitext(path)[1].lower())
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            shutil.move(path, blob)
+        self.state.record_blob(digest, blob, os.path.getsize(blob), source_key=key)
+        self._link(blob, path)
+        self.state.add_blob_ref(post_id, path, digest)
+        return path
+
+    def adopt_media(self, post_id: str, media: Dict[str, Any]):
+        """adopt() every file of a download_post() result, in place."""
+        for name in ("video", "audio"):
+            if media.get(name):
+                media[name] = self._adopt_safely(post_id, media[name])
+        if media.get("images"):
+            media["images"] = [self._adopt_safely(post_id, p) for p in media["images"]]
+
+    def _adopt_safely(self, post_id: str, path: str) -> str:
+        # The download itself succeeded; failing to deduplicate must not lose it
+        try:
+            return self.adopt(post_id, path)
+        except Exception as e:
+            logger.warning(f"Could not add {path} to the media store: {e}")
+            return path
+
+    def release(self, post_id: str) -> int:
+        """
+        Remove a post's linked files and delete blobs no other post references.
+        Returns the number of blobs deleted.
+        """
+        links, orphans = self.state.release_blob_refs(post_id)
+        for path in links + orphans:
+            try:
+                if os.path.lexists(path):
+                    os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to remove {path}: {e}")
+        if orphans:
+            logger.info(f"Freed {len(orphans)} media blob(s) of {post_id}")
+        return len(orphans)
@@ -0,0 +1,219 @@
+import asyncio
+import io
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+    _PIL_AVAILABLE = True
+except ImportError:
+    _PIL_AVAILABLE = False
+
+from .media_store import file_digest
+
+logger = logging.getLogger("tok2gram.photos")
+
+# Telegram's limits for photos sent with sendPhoto/sendMediaGroup
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_MAX_DIMENSION_SUM = 10000  # width + height
+PHOTO_MAX_RATIO = 20
+# JPEG qualities tried in turn until the file fits PHOTO_MAX_BYTES
+JPEG_QUALITIES = (90, 80, 70, 60)
+# EXIF tag holding the camera orientation; 1 means already upright
+EXIF_ORIENTATION = 0x0112
+# Each further round shrinks the frame by this factor
+SHRINK_FACTOR = 0.75
+MAX_SHRINK_ROUNDS = 4
+
+
+def plan_photo(width: int, height: int) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """
+    Fit an image into Telegram's photo limits.
+
+    Returns (image_size, canvas_size): the image is scaled to image_size and centred
+    on a canvas_size background. A strip longer than PHOTO_MAX_RATIO:1 is padded
+    rather than cropped, so nothing of it is lost; then both are scaled down until
+    width + height is within PHOTO_MAX_DIMENSION_SUM.
+    """
+    canvas_w, canvas_h = width, height
+    if width > height * PHOTO_MAX_RATIO:
+        canvas_h = math.ceil(width / PHOTO_MAX_RATIO)
+    elif height > width * PHOTO_MAX_RATIO:
+        canvas_w = math.ceil(height / PHOTO_MAX_RATIO)
+
+    scale = 1.0
+    if canvas_w + canvas_h > PHOTO_MAX_DIMENSION_SUM:
+        # One pixel of room for the ratio correction below
+        scale = (PHOTO_MAX_DIMENSION_SUM - 1) / (canvas_w + canvas_h)
+    canvas_w, canvas_h = max(1, int(canvas_w * scale)), max(1, int(canvas_h * scale))
+    # Rounding down the short side must not push a strip back past the ratio
+    canvas = (max(canvas_w, math.ceil(canvas_h / PHOTO_MAX_RATIO)), max(canvas_h, math.ceil(canvas_w / PHOTO_MAX_RATIO)))
+    image = (min(canvas[0], max(1, round(width * scale))), min(canvas[1], max(1, round(height * scale))))
+    return image, canvas
+
+
+def photo_ok(path: str, fmt: Optional[str], mode: str, width: int, height: int) -> bool:
+    """True if the file can be sent as a photo unchanged."""
+    return (
+        fmt == "JPEG"
+        and mode in ("RGB", "L")
+        and os.path.getsize(path) <= PHOTO_MAX_BYTES
+        and plan_photo(width, height) == ((width, height), (width, height))
+    )
+
+
+def _to_rgb(img: "Image.Image") -> "Image.Image":
+    """Flatten transparency onto white; JPEG has no alpha channel."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def _encode_jpeg(img: "Image.Image") -> Optional[bytes]:
+    """Smallest-loss JPEG of img within PHOTO_MAX_BYTES, or None if none of the qualities fit."""
+    for quality in JPEG_QUALITIES:
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=quality, optimize=True)
+        if buf.tell() <= PHOTO_MAX_BYTES:
+            return buf.getvalue()
+    return None
+
+
+def normalize_photo(src: str, dst: str) -> bool:
+    """
+    Write src as a Telegram-compliant JPEG to dst (see plan_photo()).
+
+    EXIF orientation is applied, transparency is flattened onto white, and quality
+    and then size are lowered until the file is within PHOTO_MAX_BYTES.
+    Returns False if that can't be reached.
+    """
+    with Image.open(src) as opened:
+        img = _to_rgb(ImageOps.exif_transpose(opened))
+    image_size, canvas_size = plan_photo(*img.size)
+    for _ in range(MAX_SHRINK_ROUNDS):
+        frame = img.resize(image_size, Image.LANCZOS) if image_size != img.size else img
+        if canvas_size != image_size:
+            canvas = Image.new("RGB", canvas_size, (255, 255, 255))
+            canvas.paste(frame, ((canvas_size[0] - image_size[0]) // 2, (canvas_size[1] - image_size[1]) // 2))
+            frame = canvas
+        data = _encode_jpeg(frame)
+        if data is not None:
+            # Per thread: the same source may be converted twice at once (shared images)
+            tmp = f"{dst}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, dst)
+            return True
+        image_size = tuple(max(1, int(v * SHRINK_FACTOR)) for v in image_size)
+        canvas_size = tuple(max(1, int(v * SHRINK_FACTOR)) for v in canvas_size)
+    return False
+
+
+class PhotoNormalizer:
+    """
+    Turn slideshow images into JPEGs Telegram accepts as photos, before upload.
+
+    Raw gallery-dl downloads are often WebP or PNG, sometimes past the photo limits;
+    Telegram then rejects the album, or recompresses it, and the whole album upload
+    is retried. Images are converted on a small thread pool (Pillow releases the GIL
+    while decoding, resizing and encoding) and the results are cached under
+    cache_dir by the SHA-256 of the source, so retries, re-uploads and images shared
+    between posts are converted once. Files that are already compliant JPEGs are
+    used as they are. Without Pillow, images are uploaded unchanged.
+    """
+
+    def __init__(self, cache_dir: str = "data/photo_cache", workers: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self.configure(cache_dir, workers)
+
+    def configure(self, cache_dir: Optional[str] = None, workers: Optional[int] = None):
+        """Set the cache directory and pool size; None workers derives it from os.cpu_count()."""
+        with self._lock:
+            if cache_dir:
+                self.cache_dir = cache_dir
+            self.workers = max(1, int(workers)) if workers else min(4, os.cpu_count() or 1)
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="photo")
+            return self._pool
+
+    def _cache_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.jpg")
+
+    def normalize(self, path: str) -> str:
+        """Return the path to upload for path: a cached conversion, or path itself."""
+        if not _PIL_AVAILABLE:
+            return path
+        try:
+            with Image.open(path) as img:
+                upright = img.getexif().get(EXIF_ORIENTATION, 1) == 1
+                if upright and photo_ok(path, img.format, img.mode, *img.size):
+                    return path
+            cached = self._cache_path(file_digest(path))
+            if os.path.exists(cached):
+                # Touched on use, so prune() only drops images nobody uploaded lately
+                os.utime(cached)
+                logger.debug(f"Using cached photo for {os.path.basename(path)}")
+                return cached
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            if not normalize_photo(path, cached):
+                logger.warning(f"Could not bring {path} within Telegram's photo limits; uploading it unchanged")
+                return path
+            logger.info(
+                f"Converted {os.path.basename(path)} to a Telegram photo "
+                f"({os.path.getsize(path) / 1024:.0f}KB -> {os.path.getsize(cached) / 1024:.0f}KB)"
+            )
+            return cached
+        except Exception as e:
+            logger.warning(f"Failed to normalize photo {path}: {e}")
+            return path
+
+    def normalize_all(self, paths: List[str]) -> List[str]:
+        """normalize() every path on the pool; the order is kept."""
+        return list(self._executor().map(self.normalize, paths))
+
+    async def run(self, paths: List[str]) -> List[str]:
+        """normalize_all() without blocking the event loop."""
+        pool = self._executor()
+        return list(await asyncio.gather(*(asyncio.wrap_future(pool.submit(self.normalize, p)) for p in paths)))
+
+    def prune(self, max_age_seconds: float) -> int:
+        """Delete cached photos not used for max_age_seconds. Returns the number removed."""
+        removed = 0
+        cutoff = time.time() - max_age_seconds
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError as e:
+                    logger.warning(f"Failed to remove cached photo {path}: {e}")
+        if removed:
+            logger.info(f"Pruned {removed} cached photo(s)")
+        return removed
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+# Process-wide normalizer used by slideshow uploads.
+photo_normalizer = PhotoNormalizer()
@@ -0,0 +1,196 @@
+import threading
+import time
+import random
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger("tok2gram.ratelimit")
+
+
+class HostLimiter:
+    """
+    Per-host concurrency cap.
+
+    Worker threads take a slot for the host they are about to hit, so no more than
+    max_per_host requests to it are in flight. Backing off after a rate limit is the
+    job of the shared request budget (AIMDController pausing the TokenBucket).
+    """
+
+    def __init__(self, max_per_host: int = 3):
+        self.max_per_host = max(1, int(max_per_host))
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+
+    def configure(self, max_per_host: int):
+        """Change the per-host cap. Only affects hosts not seen yet."""
+        with self._lock:
+            self.max_per_host = max(1, int(max_per_host))
+            self._semaphores.clear()
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urlparse(url).netloc.lower() or url
+
+    def _semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = sem
+            return sem
+
+    @contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        """Hold one of the host's concurrency slots."""
+        with self._semaphore(self._host(url)):
+            yield
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket for a global request budget.
+
+    acquire() takes one token, sleeping until one is available. Waiters reserve their
+    token up front (the balance may go negative), so concurrent callers are released
+    one `1 / rate` apart instead of all at once when the bucket refills. A random
+    jitter of up to `jitter` seconds is added to every wait so requests from many
+    workers do not line up on a fixed beat.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 5, jitter: float = 0.0):
+        self._lock = threading.Lock()
+        self.rate = max(0.001, float(rate))
+        self.burst = max(1, int(burst))
+        self.jitter = max(0.0, float(jitter))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def configure(self, rate: Optional[float] = None, burst: Optional[int] = None, jitter: Optional[float] = None):
+        """Change the budget. Tokens already in the bucket are kept, up to the new burst."""
+        with self._lock:
+            self._refill()
+            if rate is not None:
+                self.rate = max(0.001, float(rate))
+            if burst is not None:
+                self.burst = max(1, int(burst))
+                self._tokens = min(self._tokens, float(self.burst))
+            if jitter is not None:
+                self.jitter = max(0.0, float(jitter))
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how long the caller must wait before using it."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1.0
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        wait = self.reserve()
+        if self.jitter:
+            wait += random.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold back every request for roughly `seconds` by draining the bucket."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+        logger.warning(f"Pausing the request budget for {seconds:.1f}s")
+
+
+# Substrings of yt-dlp / HTTP errors that mean TikTok wants us to slow down
+THROTTLE_MARKERS = ("HTTP Error 429", "Too Many Requests")
+BLOCK_MARKERS = ("IP address is blocked",)
+
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease control of a TokenBucket's rate.
+
+    Every successful request nudges the rate up by `increase` requests/s (up to
+    max_rate); a 429 multiplies it by `decrease` (down to min_rate) and pauses the
+    bucket. Throttles reported while a previous decrease is still being waited out
+    are treated as the same event, so a burst of in-flight 429s halves the rate once.
+    """
+
+    def __init__(
+        self,
+        bucket: TokenBucket,
+        min_rate: float = 0.1,
+        max_rate: float = 5.0,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+        throttle_pause: float = 10.0,
+        block_pause: float = 60.0,
+    ):
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttle_pause = throttle_pause
+        self.block_pause = block_pause
+        self._hold_until = 0.0
+
+    def configure(self, min_rate: Optional[float] = None, max_rate: Optional[float] = None):
+        with self._lock:
+            if min_rate is not None:
+                self.min_rate = float(min_rate)
+            if max_rate is not None:
+                self.max_rate = float(max_rate)
+
+    def on_success(self):
+        with self._lock:
+            if time.monotonic() < self._hold_until or self.bucket.rate >= self.max_rate:
+                return
+            self.bucket.configure(rate=min(self.max_rate, self.bucket.rate + self.increase))
+
+    def on_throttle(self, pause: Optional[float] = None) -> bool:
+        """Back off after a rate limit. Returns False if it belonged to an earlier event."""
+        pause = self.throttle_pause if pause is None else pause
+        with self._lock:
+            now = time.monotonic()
+            if now < self._hold_until:
+                return False
+            old_rate = self.bucket.rate
+            new_rate = max(self.min_rate, old_rate * self.decrease)
+            self.bucket.configure(rate=new_rate)
+            self.bucket.pause(pause)
+            self._hold_until = now + pause
+        logger.warning(f"TikTok rate limit hit; request rate {old_rate:.2f}/s -> {new_rate:.2f}/s")
+        return True
+
+    def on_block(self) -> bool:
+        """Back off after an IP block, which calls for a much longer pause than a 429."""
+        return self.on_throttle(pause=self.block_pause)
+
+    def report_error(self, error: object) -> bool:
+        """Feed an exception or error message in; returns True if it was a throttle signal."""
+        message = str(error)
+        if any(marker in message for marker in BLOCK_MARKERS):
+            self.on_block()
+            return True
+        if any(marker in message for marker in THROTTLE_MARKERS):
+            self.on_throttle()
+            return True
+        return False
+
+
+# Process-wide limiter for TikTok requests, shared by every probe worker.
+tiktok_limiter = HostLimiter()
+
+# Process-wide request budget for TikTok (listing, probes and downloads), shared by
+# every creator processed concurrently.
+tiktok_budget = TokenBucket()
+
+# Adjusts tiktok_budget's rate from the 429 / IP-block feedback of every call site.
+tiktok_rate = AIMDController(tiktok_budget)
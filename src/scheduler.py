@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .core.state import StateStore
+
+logger = logging.getLogger("tok2gram.scheduler")
+
+
+def ewma_interval(timestamps: List[int], alpha: float, now: Optional[float] = None) -> Optional[float]:
+    """
+    Exponentially weighted moving average of the gaps between consecutive posts.
+
+    The still-open gap since the newest post is folded in once it exceeds the average,
+    so a creator who went quiet drifts towards slower polling.
+    Returns None when there are fewer than two posts to learn from.
+    """
+    if len(timestamps) < 2:
+        return None
+    ewma: Optional[float] = None
+    for prev, cur in zip(timestamps, timestamps[1:]):
+        gap = max(0, cur - prev)
+        ewma = gap if ewma is None else alpha * gap + (1 - alpha) * ewma
+    assert ewma is not None
+    if now is not None:
+        open_gap = now - timestamps[-1]
+        if open_gap > ewma:
+            ewma = alpha * open_gap + (1 - alpha) * ewma
+    return ewma
+
+
+class PollScheduler:
+    """
+    Priority queue of creators ordered by their next due poll time.
+
+    Each creator's poll interval is a fraction (poll_factor) of the EWMA of its
+    inter-post interval, clamped to [min_interval, max_interval]. Creators with no
+    history yet use min_interval, so new creators are picked up quickly.
+    """
+
+    def __init__(
+        self,
+        state: StateStore,
+        min_interval: float = 15 * 60,
+        max_interval: float = 12 * 3600,
+        alpha: float = 0.3,
+        poll_factor: float = 0.5,
+    ):
+        self.state = state
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.alpha = alpha
+        self.poll_factor = poll_factor
+        self._heap: List[Tuple[float, int, str]] = []
+        self._counter = itertools.count()
+        self._creators: Dict[str, dict] = {}
+        self._due_at: Dict[str, float] = {}
+
+    def interval_for(self, username: str, now: Optional[float] = None) -> float:
+        """Seconds to wait between polls of this creator."""
+        now = time.time() if now is None else now
+        ewma = ewma_interval(self.state.get_post_timestamps(username), self.alpha, now=now)
+        if ewma is None:
+            return self.min_interval
+        return min(self.max_interval, max(self.min_interval, ewma * self.poll_factor))
+
+    def load(self, creators: List[dict], now: Optional[float] = None):
+        """(Re)build the queue from the creator list and the persisted poll times."""
+        now = time.time() if now is None else now
+        last_polls = self.state.get_last_polls()
+        self._heap = []
+        self._creators = {c['username']: c for c in creators}
+        self._due_at = {}
+        for username in self._creators:
+            last = last_polls.get(username)
+            due_at = now if last is None else last + self.interval_for(username, now=now)
+            self._push(username, due_at)
+
+    def _push(self, username: str, due_at: float):
+        self._due_at[username] = due_at
+        heapq.heappush(self._heap, (due_at, next(self._counter), username))
+
+    def _pop_stale(self):
+        # Entries replaced by a later _push() are dropped lazily
+        while self._heap and self._due_at.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now: Optional[float] = None) -> List[dict]:
+        """Remove and return every creator that is due, most overdue first."""
+        now = time.time() if now is None else now
+        due: List[dict] = []
+        self._pop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, username = heapq.heappop(self._heap)
+            self._due_at.pop(username, None)
+            due.append(self._creators[username])
+            self._pop_stale()
+        return due
+
+    def next_due_at(self) -> Optional[float]:
+        """Due time of the next creator in the queue, or None if it is empty."""
+        self._pop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def next_due_for(self, username: str) -> Optional[float]:
+        """Due time of one creator, or None if it is not queued (e.g. popped and not yet polled)."""
+        return self._due_at.get(username)
+
+    def mark_polled(self, username: str, now: Optional[float] = None):
+        """Persist the poll and queue the creator again at its next due time."""
+        now = time.time() if now is None else now
+        self.state.record_poll(username, int(now))
+        interval = self.interval_for(username, now=now)
+        if username in self._creators:
+            self._push(username, now + interval)
+        logger.info(f"Next poll for {username} in {interval / 60:.0f} min")
+
+    def defer(self, username: str, delay: float, now: Optional[float] = None):
+        """Queue a creator again after `delay` seconds without recording a poll."""
+        now = time.time() if now is None else now
+        if username in self._creators:
+            self._push(username, now + delay)
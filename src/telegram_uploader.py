@@ -2,12 +2,15 @@ import logging
 import asyncio
 import subprocess
 import os
-import re
 import time
 from typing import List, Optional, Any
 from telegram import Bot, InputMediaPhoto, InputFile
 from telegram.constants import ParseMode
 from .tiktok_api import Post
+from .governor import governor
+from .photos import photo_normalizer
+from .transcode import EncodingProfile, compress_video, compression_target_mb, get_duration, upload_limit_mb
+from .transcode_pool import transcode_scheduler, PRIORITY_UPLOAD
 from tenacity import retry, stop_after_attempt, wait_exponential
 from rich.progress import (
     Progress,
@@ -49,7 +52,7 @@ def _has_video_stream(path: str) -> bool:
     """Return True if ffprobe detects at least one video stream."""
     try:
         proc = subprocess.run(
-            [
+            governor.wrap([
                 "ffprobe",
                 "-hide_banner",
                 "-loglevel",
@@ -61,7 +64,7 @@ def _has_video_stream(path: str) -> bool:
                 "-of",
                 "csv=p=0",
                 path,
-            ],
+            ]),
             stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
             text=True,
@@ -131,186 +134,44 @@ class TelegramUploader:
 
     def _get_duration(self, file_path: str) -> Optional[float]:
         """Get video duration in seconds using ffprobe."""
-        try:
-            cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                file_path
-            ]
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if result.returncode == 0:
-                return float(result.stdout.strip())
-        except Exception as e:
-            logger.warning(f"Failed to get duration for {file_path}: {e}")
-        return None
+        return get_duration(file_path)
 
-    def _parse_ffmpeg_progress(self, line: str) -> Optional[dict]:
+    def _compress_video(self, input_path: str, target_size_mb: Optional[float] = None, max_attempts: int = 3,
+                        threads: int = 0, profile: Optional[EncodingProfile] = None) -> str:
         """
-        Parse ffmpeg progress output line.
-        Returns dict with frame, fps, time, speed, etc. if it's a progress line.
-        """
-        # ffmpeg outputs progress in format: frame=1234 fps=30 time=00:01:23.45 ...
-        progress_pattern = r'frame=\s*(\d+)\s+fps=\s*([\d.]+)\s+.*time=(\d{2}):(\d{2}):(\d{2}\.\d{2})'
-        match = re.search(progress_pattern, line)
-        if match:
-            hours, minutes, seconds = int(match.group(3)), int(match.group(4)), float(match.group(5))
-            time_seconds = hours * 3600 + minutes * 60 + seconds
-            return {
-                'frame': int(match.group(1)),
-                'fps': float(match.group(2)),
-                'time': time_seconds
-            }
-        return None
+        Compress video under the upload limit with progress tracking.
 
-    def _compress_video(self, input_path: str, target_size_mb: float = 47.0, max_attempts: int = 8) -> str:
-        """
-        Compress video to target size using single-pass CRF encoding with progress tracking.
-        Uses CRF (Constant Rate Factor) for faster encoding compared to 2-pass.
-        Dynamically adjusts CRF and resolution based on duration and target size.
+        Downloads are normally shrunk once at download time (transcode.prepare_for_telegram);
+        this is the fallback for files that still arrive over the limit. profile is the
+        destination's EncodingProfile, applied as in the download-time encode.
         """
-        attempt = 0
-        last_compressed_size_mb = None
-        
-        # Calculate initial CRF based on file size
-        file_size_mb = os.path.getsize(input_path) / (1024 * 1024)
-        if file_size_mb > 150:
-            current_crf = 34
-        elif file_size_mb > 100:
-            current_crf = 32
-        elif file_size_mb > 70:
-            current_crf = 30
-        else:
-            current_crf = 28
-        
-        while attempt < max_attempts:
-            attempt += 1
-            try:
-                duration = self._get_duration(input_path)
-                if not duration:
-                    logger.warning("Could not determine duration, skipping compression")
-                    return input_path
+        limit_mb = upload_limit_mb()
+        if target_size_mb is None:
+            target_size_mb = compression_target_mb(limit_mb)
+        duration = self._get_duration(input_path)
 
-                # Create temp output path
-                directory = os.path.dirname(input_path) or "."
-                filename = os.path.basename(input_path)
-                base, ext = os.path.splitext(filename)
-                output_path = os.path.join(directory, f"{base}_compressed{ext}")
-                
-                # Check if compressed file already exists and is under limit
-                if os.path.exists(output_path):
-                    existing_size = os.path.getsize(output_path) / (1024 * 1024)
-                    if existing_size < 50:
-                        logger.info(f"Using existing compressed file: {existing_size:.2f}MB")
-                        return output_path
-                    else:
-                        logger.info(f"Existing compressed file is {existing_size:.2f}MB (> 50MB), re-compressing")
-                        os.remove(output_path)
+        with progress_manager:
+            compress_task = progress_manager.add_task(
+                "compress",
+                total=duration or 0,
+                operation=f"Compressing: {os.path.basename(input_path)}",
+            )
 
-                # Calculate target bitrate to estimate if we need more drastic measures
-                # Target total bitrate in kbps
-                target_total_bitrate = (target_size_mb * 1024 * 8) / duration
-                
-                # Adjust audio bitrate based on available budget
-                audio_bitrate = "128k"
-                if target_total_bitrate < 250:
-                    audio_bitrate = "64k"
-                if target_total_bitrate < 150:
-                    audio_bitrate = "32k"
+            def on_progress(encoded: float, total: float):
+                progress_manager.update(compress_task, completed=encoded, total=total)
 
-                # Adjust resolution if target bitrate is very low or we're on a late attempt
-                vf_filters = []
-                if target_total_bitrate < 400 or attempt >= 2:
-                    vf_filters.append("scale='min(720,iw)':-2")
-                if target_total_bitrate < 200 or attempt >= 4 or current_crf >= 45:
-                    vf_filters.append("scale='min(480,iw)':-2")
-                
-                logger.info(f"Compressing {os.path.basename(input_path)} with CRF {current_crf} (file: {file_size_mb:.1f}MB, dur: {duration:.1f}s, target: {target_total_bitrate:.0f}kbps, audio: {audio_bitrate}, attempt {attempt}/{max_attempts})")
-
-                # Start progress tracking
-                with progress_manager:
-                    compress_task = progress_manager.add_task(
-                        "compress",
-                        total=duration,
-                        operation=f"Compressing: {os.path.basename(input_path)}",
-                    )
-                    
-                    # Single-pass CRF encoding
-                    cmd = [
-                        "ffmpeg", "-y", "-i", input_path,
-                        "-c:v", "libx264",
-                        "-crf", str(current_crf),
-                        "-preset", "veryfast",  # Better than ultrafast for small size
-                        "-c:a", "aac", "-b:a", audio_bitrate,
-                        "-movflags", "+faststart",
-                        "-threads", "4",
-                    ]
-                    
-                    if vf_filters:
-                        # Use the last (most aggressive) filter
-                        cmd.extend(["-vf", vf_filters[-1]])
-                        
-                    cmd.append(output_path)
-                    
-                    process = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        universal_newlines=True,
-                        cwd=directory
-                    )
-                    
-                    # Monitor progress
-                    if process.stdout:
-                        for line in process.stdout:
-                            progress_info = self._parse_ffmpeg_progress(line)
-                            if progress_info:
-                                progress_manager.update(compress_task, completed=progress_info['time'])
-                    
-                    process.wait()
-                    progress_manager.update(compress_task, completed=int(duration), refresh=True)
-                    progress_manager.remove_task(compress_task)
-                    
-                    if process.returncode != 0:
-                        logger.error("Compression encoding failed")
-                        return input_path
-                
-                if os.path.exists(output_path):
-                    new_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-                    console.print(f"✓ Compressed {os.path.basename(input_path)}: {new_size_mb:.2f}MB", style="bold green")
-                    
-                    # Verify the compressed file is actually under 50MB
-                    if new_size_mb >= 50:
-                        # Check if compression has plateaued and we're already at max CRF
-                        if last_compressed_size_mb and abs(new_size_mb - last_compressed_size_mb) < 0.5 and current_crf >= 50:
-                            logger.warning(f"Compression plateaued at {new_size_mb:.2f}MB")
-                            logger.warning("Cannot compress below 50MB limit - returning original file")
-                            return input_path
-                        
-                        last_compressed_size_mb = new_size_mb
-                        logger.warning(f"Compressed file is {new_size_mb:.2f}MB, still > 50MB! Retrying...")
-                        
-                        # Increase CRF more aggressively
-                        if new_size_mb > 100:
-                            current_crf = min(51, current_crf + 5)
-                        else:
-                            current_crf = min(51, current_crf + 3)
-                        
-                        os.remove(output_path)
-                        continue
-                    
-                    return output_path
-                
-                return input_path
-
-            except Exception as e:
-                logger.error(f"Compression failed (attempt {attempt}/{max_attempts}): {e}")
-                if attempt >= max_attempts:
-                    return input_path
-                current_crf = min(51, current_crf + 3)
+            try:
+                output_path = compress_video(
+                    input_path, target_size_mb, max_attempts=max_attempts, limit_mb=limit_mb,
+                    duration=duration, on_progress=on_progress, threads=threads, profile=profile,
+                )
+            finally:
+                progress_manager.remove_task(compress_task)
 
-        return input_path
+        if output_path != input_path:
+            new_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            console.print(f"✓ Compressed {os.path.basename(input_path)}: {new_size_mb:.2f}MB", style="bold green")
+        return output_path
 
     def _create_upload_callback(self, task_id: TaskID, file_name: str):
         """
@@ -330,31 +191,34 @@ class TelegramUploader:
         return callback
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    async def upload_video(self, post: Post, video_path: str, chat_id: Optional[str] = None, message_thread_id: Optional[int] = None) -> Optional[int]:
+    async def upload_video(self, post: Post, video_path: str, chat_id: Optional[str] = None, message_thread_id: Optional[int] = None,
+                           encoding_profile: Optional[EncodingProfile] = None) -> Optional[int]:
         """
         Upload a single video to Telegram.
+        encoding_profile shapes the compression of a file that is still over the limit.
         Returns the message_id if successful.
         """
         target_chat = chat_id or self.chat_id
         caption = self._format_caption(post)
         
-        # Check file size (50MB limit for standard bots)
+        # Check file size (50MB limit for standard bots, 2GB with TELEGRAM_LOCAL_API).
+        # download_video() already shrinks downloads to the limit, so this rarely fires.
         file_size = os.path.getsize(video_path)
         file_size_mb = file_size / (1024 * 1024)
+        limit_mb = upload_limit_mb()
         
         final_video_path = video_path
         
-        if file_size_mb >= 50:
-            if os.getenv("TELEGRAM_LOCAL_API"):
-                logger.info(f"File size {file_size_mb:.2f}MB > 50MB, but TELEGRAM_LOCAL_API is set. Proceeding.")
-            else:
-                logger.warning(f"File size {file_size_mb:.2f}MB > 50MB and standard API in use. Compressing...")
-                # Run compression in a thread to avoid blocking the event loop
-                loop = asyncio.get_running_loop()
-                final_video_path = await loop.run_in_executor(None, self._compress_video, video_path)
-                # Recalculate size for logging/timeouts
-                file_size = os.path.getsize(final_video_path)
-                file_size_mb = file_size / (1024 * 1024)
+        if file_size_mb >= limit_mb:
+            logger.warning(f"File size {file_size_mb:.2f}MB > {limit_mb}MB upload limit. Compressing...")
+            # Run compression on the transcode workers, ahead of download-time jobs
+            final_video_path = await transcode_scheduler.run(
+                self._compress_video, video_path, priority=PRIORITY_UPLOAD, name=os.path.basename(video_path),
+                profile=encoding_profile,
+            )
+            # Recalculate size for logging/timeouts
+            file_size = os.path.getsize(final_video_path)
+            file_size_mb = file_size / (1024 * 1024)
 
         # Get dynamic timeouts based on file size
         read_timeout, write_timeout, connect_timeout, pool_timeout = self._get_dynamic_timeouts(final_video_path)
@@ -497,11 +361,15 @@ class TelegramUploader:
     async def upload_slideshow(self, post: Post, image_paths: List[str], chat_id: Optional[str] = None, message_thread_id: Optional[int] = None) -> Optional[int]:
         """
         Upload multiple images as a media group, chunked into batches of MAX_ALBUM (10) images.
+        Images are first converted to Telegram-compliant JPEGs (see photos.PhotoNormalizer);
+        the conversions are cached, so a retried upload does not convert them again.
         Returns the first message_id from the first chunk if successful.
         """
         if not image_paths:
             return None
 
+        image_paths = await photo_normalizer.run(image_paths)
+
         target_chat = chat_id or self.chat_id
         caption = self._format_caption(post)
         total_images = len(image_paths)
@@ -1,18 +1,117 @@
-import yt_dlp
 import time
-import random
 import logging
 import os
-from dataclasses import dataclass
-from typing import List, Optional, Any
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional, Any, Set, Tuple
+
+import requests
+
+from . import ytdl_pool
+from .rate_limit import tiktok_limiter, tiktok_budget, tiktok_rate
 
 logger = logging.getLogger("tok2gram.tiktok")
 
-def _probe_kind(url: str, ydl_base_opts: dict, cookie_manager=None, cookie_path: Optional[str] = None) -> str:
+# TikTok lets creators pin up to three (usually older) posts above the timeline,
+# so the cursor can only end a listing once we are past these slots.
+PINNED_SLOTS = 3
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+def _kind_from_info(info: dict, url: str) -> Optional[str]:
+    """Classify a post from a yt-dlp info dict. Returns None if nothing in it is conclusive."""
+    # If formats exist and contain any video stream, it's definitely a video.
+    # This helps correctly classify posts that were redirected from /photo/ to /video/.
+    fmts = info.get("formats") or []
+    if any((f.get("vcodec") != "none") for f in fmts if isinstance(f, dict)):
+        return "video"
+
+    # Strong signal for slideshow: yt-dlp identifies it as a playlist or has entries.
+    entries = info.get("entries")
+    if info.get("_type") == "playlist" or entries:
+        return "slideshow"
+
+    # If formats exist but all are audio-only, it's very likely a slideshow.
+    if fmts and all((f.get("vcodec") == "none") for f in fmts if isinstance(f, dict)):
+        return "slideshow"
+
+    # If the URL explicitly contains /photo/, trust it as a fallback.
+    if "/photo/" in url:
+        return "slideshow"
+    return None
+
+
+def _classify_flat_entry(entry: dict, url: str) -> Optional[str]:
+    """
+    Tier 1: classify from the extract_flat listing entry alone (no network).
+    Flat entries usually carry only the URL shape, but some listings include formats
+    or mark slideshows as playlists.
+    """
+    if "/photo/" in url:
+        return "slideshow"
+    if entry.get("formats") or entry.get("_type") == "playlist" or entry.get("entries"):
+        return _kind_from_info(entry, url)
+    return None
+
+
+def _classify_by_redirect(url: str, session: requests.Session) -> Optional[str]:
+    """
+    Tier 2: one HEAD request on the post URL. TikTok redirects a post to its canonical
+    /photo/ or /video/ path, so a redirect that changes the path kind is conclusive.
+    No redirect tells us nothing and returns None.
+    """
+    try:
+        with tiktok_limiter.slot(url):
+            tiktok_budget.acquire()
+            resp = session.head(url, allow_redirects=True, timeout=10)
+    except Exception as e:
+        logger.debug(f"Redirect check failed for {url}: {e}")
+        return None
+    if resp.status_code == 429:
+        tiktok_rate.on_throttle()
+        return None
+    if resp.status_code >= 400:
+        # 403/5xx: no answer, and no reason to speed up either
+        return None
+    tiktok_rate.on_success()
+    final_url = resp.url or url
+    if final_url == url:
+        return None
+    if "/photo/" in final_url and "/photo/" not in url:
+        return "slideshow"
+    if "/video/" in final_url and "/video/" not in url:
+        return "video"
+    return None
+
+
+def _guess_kind_from_url(url: str) -> Optional[str]:
+    """URL-based kind guess used when a probe fails. Returns None if the URL gives no hint."""
+    if "/photo/" in url:
+        return "slideshow"
+    # If probe fails for a /video/ URL (e.g., "No video formats found"), consider it a slideshow fallback
+    if "/video/" in url:
+        logger.warning(f"Video probe failed for {url}; treating as slideshow fallback")
+        return "slideshow"
+    return None
+
+
+def _probe_kind(
+    url: str,
+    ydl_base_opts: dict,
+    cookie_manager=None,
+    cookie_path: Optional[str] = None,
+    strict: bool = False,
+    on_info: Optional[Callable[[dict], None]] = None,
+) -> str:
     """
     Probe a TikTok post URL to determine if it's a slideshow or video.
     Uses yt-dlp to extract metadata and check for slideshow indicators.
     Includes retry logic with exponential backoff for rate limits and cookie rotation.
+
+    With strict=True a failed probe raises instead of falling back to a URL-based
+    guess, so callers can tell real answers (safe to cache) from guesses.
+    on_info, if given, receives the extracted info dict so the download can reuse it.
     """
     max_attempts = 3
     current_cookie_path = cookie_path
@@ -29,37 +128,28 @@ def _probe_kind(url: str, ydl_base_opts: dict, cookie_manager=None, cookie_path:
             probe_opts['cookiefile'] = current_cookie_path
         
         try:
-            with yt_dlp.YoutubeDL(probe_opts) as ydl:  # type: ignore
-                info = ydl.extract_info(url, download=False)
-
-            # If formats exist and contain any video stream, it's definitely a video.
-            # This helps correctly classify posts that were redirected from /photo/ to /video/.
-            fmts = info.get("formats") or []
-            if any((f.get("vcodec") != "none") for f in fmts if isinstance(f, dict)):
-                return "video"
-
-            # Strong signal for slideshow: yt-dlp identifies it as a playlist or has entries.
-            entries = info.get("entries")
-            if info.get("_type") == "playlist" or entries:
-                return "slideshow"
+            with tiktok_limiter.slot(url):
+                tiktok_budget.acquire()
+                with ytdl_pool.borrow("probe", probe_opts) as ydl:
+                    info = ydl.extract_info(url, download=False)
+            tiktok_rate.on_success()
 
-            # If formats exist but all are audio-only, it's very likely a slideshow.
-            if fmts and all((f.get("vcodec") == "none") for f in fmts if isinstance(f, dict)):
-                return "slideshow"
+            if on_info is not None and isinstance(info, dict):
+                on_info(info)
 
-            # If the URL explicitly contains /photo/, trust it as a fallback.
-            if "/photo/" in url:
-                return "slideshow"
+            # A successful probe without any slideshow signal is a plain video; probing
+            # again would return the same metadata.
+            return _kind_from_info(info, url) or "video"
 
         except Exception as e:
             error_str = str(e)
             logger.warning(f"Probe failed for {url} (attempt {attempt + 1}/{max_attempts}): {e}")
             
-            # Handle rate limiting with exponential backoff
-            if "HTTP Error 429" in error_str and attempt < max_attempts - 1:
-                wait_time = 2 ** attempt * 5  # 5, 10, 20 seconds
-                logger.warning(f"Rate limited, waiting {wait_time}s before retry...")
-                time.sleep(wait_time)
+            # Rate limits slow down the shared request budget, so the retry (and every
+            # other worker) waits on the token bucket rather than a local sleep.
+            throttled = tiktok_rate.report_error(error_str)
+            if throttled and "HTTP Error 429" in error_str and attempt < max_attempts - 1:
+                logger.warning("Rate limited, retrying once the request budget allows")
                 continue
             
             # Handle "No video formats found" with cookie rotation
@@ -72,13 +162,13 @@ def _probe_kind(url: str, ydl_base_opts: dict, cookie_manager=None, cookie_path:
                 else:
                     logger.warning("No more cookies to rotate, falling back to URL-based detection")
             
+            if strict:
+                raise
+
             # On failure, fall back to URL-based guess.
-            if "/photo/" in url:
-                return "slideshow"
-            # If probe fails for a /video/ URL (e.g., "No video formats found"), consider it a slideshow fallback
-            if "/video/" in url:
-                logger.warning(f"Video probe failed for {url}; treating as slideshow fallback")
-                return "slideshow"
+            guess = _guess_kind_from_url(url)
+            if guess:
+                return guess
             
             # If we've exhausted retries or it's not a retryable error, re-raise
             if attempt == max_attempts - 1:
@@ -94,8 +184,90 @@ class Post:
     url: str
     caption: Optional[str]
     created_at: Optional[int]  # unix epoch
+    # Full yt-dlp info dict from the kind probe, reused by the downloader while fresh
+    probe_info: Optional[dict] = field(default=None, repr=False, compare=False)
+    probed_at: Optional[float] = field(default=None, compare=False)  # time.time() of the probe
+
+class FetchedPosts(list):
+    """
+    fetch_posts() result: the new posts, in listing order.
 
-def fetch_posts(username: str, depth: int = 10, cookie_path: Optional[str] = None, cookie_content: Optional[str] = None, user_id: Optional[str] = None) -> List[Post]:
+    An empty result is the normal answer for a creator with nothing new, so `listed`
+    tells it apart from a failure: it is True when TikTok returned a listing with
+    entries (all of which may have been filtered out), False when the listing failed
+    or came back empty, which is worth retrying with other cookies.
+    """
+
+    def __init__(self, posts: Iterable[Post] = (), listed: bool = False):
+        super().__init__(posts)
+        self.listed = listed
+
+
+def _take_listing(
+    entries: Iterable[Any],
+    depth: int,
+    cursor: Optional[Tuple[str, Optional[int]]] = None,
+    max_depth: Optional[int] = None,
+) -> Tuple[List[dict], int]:
+    """
+    Consume a (lazy) yt-dlp entry generator up to the creator's cursor.
+
+    Without a cursor this takes the first `depth` entries. With a cursor it stops at the
+    first entry at or older than the cursor, so only the pages holding new posts are
+    requested. A burst larger than `depth` keeps listing until the cursor is found,
+    bounded by `max_depth`.
+
+    Returns (new_entries, seen): seen counts every listed entry looked at, including
+    the old ones the cursor skipped, so a listing that is all old posts ("nothing
+    new") can be told apart from an empty one.
+    """
+    limit = depth if depth and depth > 0 else None
+    if cursor and limit is not None:
+        limit = max(limit, max_depth or limit)
+    cursor_id, cursor_ts = cursor if cursor else (None, None)
+
+    taken: List[dict] = []
+    reached_cursor = False
+    seen = 0
+    for idx, entry in enumerate(entries):
+        if not entry:
+            continue
+        seen += 1
+        if cursor:
+            entry_ts = entry.get('timestamp')
+            is_old = entry.get('id') == cursor_id or (
+                cursor_ts is not None and entry_ts is not None and entry_ts <= cursor_ts
+            )
+            if is_old:
+                if idx >= PINNED_SLOTS:
+                    reached_cursor = True
+                    break
+                # Old pinned post; skip it but keep looking for the timeline
+                continue
+        taken.append(entry)
+        if limit is not None and len(taken) >= limit:
+            break
+
+    if cursor and not reached_cursor and limit is not None and len(taken) >= limit:
+        logger.warning(f"Listing hit max depth {limit} before reaching cursor {cursor_id}; older posts may be skipped")
+    elif cursor and len(taken) > depth:
+        logger.info(f"Burst detected: listed {len(taken)} new posts (fetch_depth={depth})")
+    return taken, seen
+
+
+def fetch_posts(
+    username: str,
+    depth: int = 10,
+    cookie_path: Optional[str] = None,
+    cookie_content: Optional[str] = None,
+    user_id: Optional[str] = None,
+    filter_unseen: Optional[Callable[[List[str]], Set[str]]] = None,
+    probe_cache: Optional[Any] = None,
+    cursor: Optional[Tuple[str, Optional[int]]] = None,
+    max_depth: Optional[int] = None,
+    probe_workers: int = 1,
+    redirect_check: bool = False,
+) -> FetchedPosts:
     """
     Fetch latest posts for a TikTok user using yt-dlp metadata extraction.
     
@@ -107,6 +279,23 @@ def fetch_posts(username: str, depth: int = 10, cookie_path: Optional[str] = Non
         user_id: Optional TikTok user ID (numeric). If provided, will be used instead of username
                  for fetching posts, which helps with accounts that have privacy settings
                  preventing username-based lookups.
+        filter_unseen: Optional bulk "known IDs" predicate (e.g. StateStore.filter_unseen).
+                 Called once with every listed post ID; entries not in the returned set are
+                 already handled and are skipped without probing.
+        probe_cache: Optional kind cache (normally the StateStore) exposing get_cached_probes()
+                 and record_probe(). Cached posts skip the yt-dlp probe entirely.
+        cursor: Optional (post_id, created_at) high-watermark from StateStore.get_cursor().
+                 Listing stops paginating once it reaches this post.
+        max_depth: Upper bound on how far a cursor-bounded listing may grow past depth.
+        probe_workers: Number of entries probed concurrently. Requests still go through the
+                 shared tiktok_limiter, which caps per-host concurrency, and the tiktok_rate
+                 controller, which slows every worker down on a 429.
+        redirect_check: Try a HEAD/redirect check on the post URL before falling back to a
+                 full yt-dlp probe. It only ever detects slideshows, so a video the flat
+                 tier can't classify pays one extra request; off unless configured.
+
+    Returns a FetchedPosts list; see its `listed` flag for telling "nothing new" from
+    an empty or failed listing.
     """
     actual_cookie_path = cookie_path
     
@@ -125,9 +314,6 @@ def fetch_posts(username: str, depth: int = 10, cookie_path: Optional[str] = Non
         'no_warnings': True,
     }
     
-    if depth and depth > 0:
-        ydl_opts['playlist_items'] = f"1:{depth}"
-    
     # Preferred: use cookiefile (Netscape format) when available
     if actual_cookie_path and os.path.exists(actual_cookie_path):
         ydl_opts['cookiefile'] = actual_cookie_path
@@ -136,28 +322,38 @@ def fetch_posts(username: str, depth: int = 10, cookie_path: Optional[str] = Non
         ydl_opts.setdefault('http_headers', {})
         ydl_opts['http_headers']['Cookie'] = cookie_content
 
-    posts = []
+    posts = FetchedPosts()
     
     try:
-        # Retry extraction with exponential backoff when facing HTTP 429 rate limits.
+        # Retry extraction when facing HTTP 429 rate limits.
         max_attempts = 6
         info = None
+        entries: List[dict] = []
+        seen = 0
         for attempt in range(max_attempts):
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
-                    info = ydl.extract_info(url, download=False)
+                tiktok_budget.acquire()
+                with ytdl_pool.borrow("listing", ydl_opts) as ydl:
+                    # process=False keeps 'entries' a lazy generator, so pages past the
+                    # cursor/depth are never requested.
+                    info = ydl.extract_info(url, download=False, process=False)
+                    if info and 'entries' in info:
+                        raw_entries = info.get('entries') or []
+                        if isinstance(raw_entries, (str, dict)):
+                            raw_entries = []
+                        entries, seen = _take_listing(raw_entries, depth, cursor=cursor, max_depth=max_depth)
+                tiktok_rate.on_success()
                 break
             except Exception as inner:
                 msg = str(inner)
-                # yt-dlp surfaces HTTP 429 errors in the exception string. If we hit a 429,
-                # back off for an increasing amount of time and retry.
-                if "HTTP Error 429" in msg and attempt < max_attempts - 1:
-                    sleep_s = min(300, (2 ** attempt) * 5) + random.uniform(0, 3)
+                # yt-dlp surfaces HTTP 429 errors in the exception string. A 429 lowers the
+                # shared request rate; the retry then waits for its token like any request.
+                throttled = tiktok_rate.report_error(msg)
+                if throttled and "HTTP Error 429" in msg and attempt < max_attempts - 1:
                     logger.warning(
                         f"429 from TikTok while fetching posts for {username}. "
-                        f"Backing off {sleep_s:.1f}s (attempt {attempt + 1}/{max_attempts})"
+                        f"Retrying at the reduced request rate (attempt {attempt + 1}/{max_attempts})"
                     )
-                    time.sleep(sleep_s)
                     continue
                 # Handle IP blocking errors - raise immediately to trigger creator skip
                 if "IP address is blocked" in msg or "HTTP Error 403" in msg or "403" in msg:
@@ -172,25 +368,70 @@ def fetch_posts(username: str, depth: int = 10, cookie_path: Optional[str] = Non
 
         if not info or 'entries' not in info:
             logger.warning(f"No posts found for creator: {username}")
-            return []
+            return posts
+        # Reaching the cursor with no newer post is "nothing new", not a failed listing
+        posts.listed = seen > 0
 
-        entries = info.get('entries') or []
-        if not isinstance(entries, list):
-            entries = []
-        for entry in entries:
-            if not entry:
-                continue
+        # Drop posts we already uploaded before spending a probe request on them.
+        if filter_unseen is not None:
+            listed_ids = [e.get('id') for e in entries if e.get('id')]
+            unseen = filter_unseen(listed_ids)
+            known_count = len(entries)
+            entries = [e for e in entries if not e.get('id') or e.get('id') in unseen]
+            known_count -= len(entries)
+            if known_count:
+                logger.info(f"Skipping {known_count} already-processed post(s) for {username}")
+
+        cached_probes = {}
+        if probe_cache is not None:
+            cached_probes = probe_cache.get_cached_probes([e.get('id') for e in entries if e.get('id')])
+            if cached_probes:
+                logger.info(f"Using cached kind for {len(cached_probes)} post(s) of {username}")
 
-            caption = entry.get('description') or entry.get('title') or ""
+        session = requests.Session()
+        session.headers.update({'User-Agent': USER_AGENT})
+        probe_infos: dict = {}
+
+        def classify(entry: dict) -> Tuple[str, str, str]:
+            """
+            Return (kind, url, tier) for one listing entry, using the cheapest tier that
+            gives an answer: cache, flat metadata, redirect check, then the full probe.
+            """
             # Use either 'url' or 'webpage_url' from yt-dlp; if missing, default to empty string.
             entry_url: str = entry.get('url') or entry.get('webpage_url') or ""
 
+            cached = cached_probes.get(entry.get('id'))
+            if cached:
+                return cached[0], cached[1], 'cache'
+
             # Initial guess: if the URL already contains /photo/, mark as slideshow.
             kind = 'slideshow' if '/photo/' in entry_url else 'video'
+            probed = False
+            tier = 'guess'
+
+            decided = _classify_flat_entry(entry, entry_url)
+            if decided:
+                kind, tier = decided, 'flat'
+            elif entry_url and redirect_check:
+                decided = _classify_by_redirect(entry_url, session)
+                if decided:
+                    kind, tier, probed = decided, 'redirect', True
 
             # Probe the URL to determine if it's truly a slideshow or video.
-            if entry_url:
-                kind = _probe_kind(entry_url, ydl_opts, cookie_manager=None, cookie_path=actual_cookie_path)
+            if entry_url and not decided:
+                tier = 'probe'
+                keep_info = lambda info: probe_infos.__setitem__(entry.get('id'), (info, time.time()))
+                if probe_cache is not None:
+                    # Only real probe answers are cached; on failure use the URL-based guess.
+                    try:
+                        kind = _probe_kind(entry_url, ydl_opts, cookie_manager=None, cookie_path=actual_cookie_path, strict=True, on_info=keep_info)
+                        probed = True
+                    except Exception as e:
+                        kind = _guess_kind_from_url(entry_url) or kind
+                        tier = 'guess'
+                        logger.warning(f"Probe failed for {entry_url}, using URL-based kind '{kind}': {e}")
+                else:
+                    kind = _probe_kind(entry_url, ydl_opts, cookie_manager=None, cookie_path=actual_cookie_path, on_info=keep_info)
 
             # When yt-dlp labels a post as slideshow but the URL is still using /video/, rewrite
             # the URL to point at the /photo/ endpoint so downstream downloaders can fetch images.
@@ -203,15 +444,40 @@ def fetch_posts(username: str, depth: int = 10, cookie_path: Optional[str] = Non
                         else:
                             entry_url = f"https://www.tiktok.com/@{username}/photo/{post_id}"
 
-            post = Post(
+            if probed and probe_cache is not None and entry.get('id') and entry_url:
+                probe_cache.record_probe(entry.get('id'), kind, entry_url)
+            logger.info(f"Classified {entry.get('id')} as {kind} (tier: {tier})")
+            return kind, entry_url, tier
+
+        # Probe entries concurrently; map() keeps results in listing order.
+        workers = max(1, min(probe_workers, len(entries)))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as pool:
+                classified = list(pool.map(classify, entries))
+        else:
+            classified = [classify(entry) for entry in entries]
+
+        session.close()
+
+        if classified:
+            tiers = Counter(tier for _, _, tier in classified)
+            logger.info(
+                f"Kind classification for {username}: "
+                + ", ".join(f"{tier}={count}" for tier, count in sorted(tiers.items()))
+            )
+
+        for entry, (kind, entry_url, _) in zip(entries, classified):
+            probe_info, probed_at = probe_infos.get(entry.get('id'), (None, None))
+            posts.append(Post(
                 post_id=entry.get('id'),
                 creator=username,
                 kind=kind,
                 url=entry_url,
-                caption=caption,
-                created_at=entry.get('timestamp')
-            )
-            posts.append(post)
+                caption=entry.get('description') or entry.get('title') or "",
+                created_at=entry.get('timestamp'),
+                probe_info=probe_info,
+                probed_at=probed_at,
+            ))
     except Exception as e:
         logger.error(f"Failed to fetch posts for {username}: {e}")
     return posts
@@ -0,0 +1,842 @@
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+from .governor import governor
+from .transcode_pool import record_usage
+
+logger = logging.getLogger("tok2gram.transcode")
+
+# What Telegram clients (Desktop included) play inline without server-side conversion
+TELEGRAM_VIDEO_CODECS = {"h264"}
+TELEGRAM_AUDIO_CODECS = {"aac", "mp3"}
+TELEGRAM_PIX_FMTS = {"yuv420p", "yuvj420p"}
+
+# Bot API upload limits; a self-hosted Bot API server (TELEGRAM_LOCAL_API) allows 2 GB
+STANDARD_UPLOAD_LIMIT_MB = 50
+LOCAL_API_UPLOAD_LIMIT_MB = 2000
+# Aim a little under the limit to leave room for container overhead and estimation error
+TARGET_HEADROOM = 0.94
+# Share of a compressed file taken by the container rather than the streams
+CONTAINER_OVERHEAD = 0.02
+# libx264 preset unless an encoding profile sets one
+DEFAULT_PRESET = "veryfast"
+# Below this there is no point trying; plateau detection gives up instead
+MIN_VIDEO_KBPS = 50
+
+# Videos at least this long are encoded as parallel segments of about SEGMENT_SECONDS
+SEGMENT_MIN_DURATION = 180
+SEGMENT_SECONDS = 60
+# Allowed drift (seconds, or 1% if larger) between a segment and its source range
+SEGMENT_DURATION_TOLERANCE = 0.5
+
+# Bytes piped into ffmpeg per write by stream_encode()
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def upload_limit_mb() -> int:
+    """Largest video (in MB) the configured Bot API accepts."""
+    return LOCAL_API_UPLOAD_LIMIT_MB if os.getenv("TELEGRAM_LOCAL_API") else STANDARD_UPLOAD_LIMIT_MB
+
+
+def compression_target_mb(limit_mb: float) -> float:
+    return limit_mb * TARGET_HEADROOM
+
+
+@dataclass
+class MediaInfo:
+    path: str
+    format_name: str
+    duration: Optional[float]
+    size: int
+    video_codec: Optional[str]
+    pix_fmt: Optional[str]
+    width: Optional[int]
+    height: Optional[int]
+    audio_codec: Optional[str]
+    # None when the container is not ISO-BMFF or the atoms can't be read
+    faststart: Optional[bool]
+
+    @property
+    def is_mp4(self) -> bool:
+        return "mp4" in self.format_name.split(",")
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """
+    Per-destination encoding limits (creators.yaml / config `encoding_profiles`).
+
+    max_resolution caps the shorter side (720 = 720p), video_bitrate_kbps and
+    audio_bitrate_kbps cap the bitrates, preset is the libx264 preset. Unset
+    fields keep the defaults; a profile never raises quality above them.
+    """
+    max_resolution: Optional[int] = None
+    video_bitrate_kbps: Optional[int] = None
+    audio_bitrate_kbps: Optional[int] = None
+    preset: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "EncodingProfile":
+        unknown = set(data) - {f.name for f in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown encoding profile option(s): {', '.join(sorted(unknown))}")
+        values = {}
+        for key, value in data.items():
+            if value is None:
+                continue
+            values[key] = str(value) if key == "preset" else int(value)
+        return cls(**values)
+
+    def requires_encode(self, info: MediaInfo) -> Optional[str]:
+        """Why a file that is otherwise fine to upload must be re-encoded for this profile, or None."""
+        if self.max_resolution and info.width and info.height and min(info.width, info.height) > self.max_resolution:
+            return f"{min(info.width, info.height)}p over the profile's {self.max_resolution}p"
+        if self.video_bitrate_kbps and info.size and info.duration:
+            total_kbps = info.size * 8 / 1024 / info.duration
+            budget = self.video_bitrate_kbps + (self.audio_bitrate_kbps or 128)
+            # Some slack, so a file just over the target isn't re-encoded for nothing
+            if total_kbps > budget * 1.2:
+                return f"{total_kbps:.0f}kbps over the profile's {budget}kbps"
+        return None
+
+
+def moov_before_mdat(path: str) -> Optional[bool]:
+    """
+    Walk the top-level MP4 atoms and report whether 'moov' comes before 'mdat'
+    (i.e. the file is faststart). Only atom headers are read, not the media data.
+    """
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                size, atom = struct.unpack(">I4s", header)
+                if atom == b"moov":
+                    return True
+                if atom == b"mdat":
+                    return False
+                if size == 1:
+                    large = f.read(8)
+                    if len(large) < 8:
+                        return None
+                    f.seek(struct.unpack(">Q", large)[0] - 16, 1)
+                elif size < 8:
+                    # size 0 means "to end of file"; anything else is corrupt
+                    return None
+                else:
+                    f.seek(size - 8, 1)
+    except OSError:
+        return None
+
+
+def probe_media(path: str) -> Optional[MediaInfo]:
+    """Inspect a media file with a single ffprobe call. Returns None if ffprobe fails."""
+    try:
+        proc = subprocess.run(
+            governor.wrap([
+                "ffprobe", "-v", "error",
+                "-show_entries",
+                "format=format_name,duration,size:stream=codec_type,codec_name,pix_fmt,width,height",
+                "-of", "json",
+                path,
+            ]),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if proc.returncode != 0:
+            logger.warning(f"ffprobe failed for {path}: {(proc.stderr or '').strip()}")
+            return None
+        data = json.loads(proc.stdout or "{}")
+    except Exception as e:
+        logger.warning(f"ffprobe failed for {path}: {e}")
+        return None
+
+    fmt = data.get("format") or {}
+    streams = data.get("streams") or []
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    # Cover art in audio files shows up as an mjpeg/png "video" stream
+    if video and video.get("codec_name") in ("mjpeg", "png"):
+        video = None
+
+    def _num(value, cast):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    format_name = fmt.get("format_name") or ""
+    info = MediaInfo(
+        path=path,
+        format_name=format_name,
+        duration=_num(fmt.get("duration"), float),
+        size=_num(fmt.get("size"), int) or 0,
+        video_codec=video.get("codec_name") if video else None,
+        pix_fmt=video.get("pix_fmt") if video else None,
+        width=_num(video.get("width"), int) if video else None,
+        height=_num(video.get("height"), int) if video else None,
+        audio_codec=audio.get("codec_name") if audio else None,
+        faststart=None,
+    )
+    if info.is_mp4:
+        info.faststart = moov_before_mdat(path)
+    return info
+
+
+def plan_telegram_transcode(info: MediaInfo) -> Tuple[str, str]:
+    """
+    Decide the cheapest way to make a file Telegram-compatible.
+    Returns (action, reason) where action is:
+      'none'   - already H.264/yuv420p (+AAC) in a faststart MP4
+      'remux'  - streams are fine, only the container or moov position is wrong
+      'encode' - video must be re-encoded (HEVC/AV1/VP9, odd pixel format, audio-only)
+    """
+    if not info.video_codec:
+        return "encode", "no video stream"
+    if info.video_codec not in TELEGRAM_VIDEO_CODECS:
+        return "encode", f"video codec {info.video_codec}"
+    if info.pix_fmt not in TELEGRAM_PIX_FMTS:
+        return "encode", f"pixel format {info.pix_fmt}"
+    if info.audio_codec and info.audio_codec not in TELEGRAM_AUDIO_CODECS:
+        return "remux", f"audio codec {info.audio_codec} (video copied, audio to AAC)"
+    if not info.is_mp4 or not info.path.lower().endswith(".mp4"):
+        return "remux", f"container {info.format_name}"
+    if not info.faststart:
+        return "remux", "moov atom after media data"
+    return "none", "already H.264/AAC faststart MP4"
+
+
+def parse_ffmpeg_progress(line: str) -> Optional[dict]:
+    """
+    Parse ffmpeg progress output line.
+    Returns dict with frame, fps, time, speed, etc. if it's a progress line.
+    """
+    # ffmpeg outputs progress in format: frame=1234 fps=30 time=00:01:23.45 ...
+    progress_pattern = r'frame=\s*(\d+)\s+fps=\s*([\d.]+)\s+.*time=(\d{2}):(\d{2}):(\d{2}\.\d{2})'
+    match = re.search(progress_pattern, line)
+    if match:
+        hours, minutes, seconds = int(match.group(3)), int(match.group(4)), float(match.group(5))
+        time_seconds = hours * 3600 + minutes * 60 + seconds
+        return {
+            'frame': int(match.group(1)),
+            'fps': float(match.group(2)),
+            'time': time_seconds
+        }
+    return None
+
+
+def get_duration(file_path: str) -> Optional[float]:
+    """Get video duration in seconds using ffprobe."""
+    try:
+        cmd = [
+            "ffprobe",
+            "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            file_path
+        ]
+        result = subprocess.run(governor.wrap(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode == 0:
+            return float(result.stdout.strip())
+    except Exception as e:
+        logger.warning(f"Failed to get duration for {file_path}: {e}")
+    return None
+
+
+def plan_bitrate(target_size_mb: float, duration: float,
+                 profile: Optional["EncodingProfile"] = None) -> Tuple[int, int, Optional[int]]:
+    """
+    Split a size budget into (video_kbps, audio_kbps, max_resolution).
+
+    The total bitrate follows directly from size and duration; audio gets a fixed
+    share that shrinks on tight budgets, and low video bitrates are paired with a
+    smaller frame so they don't turn into blocky full-resolution video.
+    max_resolution limits the shorter side (720 = 720p) and is None when the source
+    resolution can be kept. A profile can only lower the values.
+    """
+    total_kbps = (target_size_mb * 1024 * 8) / duration
+    # Container (MP4 atoms, faststart index) overhead
+    total_kbps *= 1 - CONTAINER_OVERHEAD
+
+    audio_kbps = 128
+    if total_kbps < 250:
+        audio_kbps = 64
+    if total_kbps < 150:
+        audio_kbps = 32
+
+    video_kbps = max(MIN_VIDEO_KBPS, int(total_kbps - audio_kbps))
+    max_resolution = None
+    if video_kbps < 1200:
+        max_resolution = 720
+    if video_kbps < 400:
+        max_resolution = 480
+    if profile is not None:
+        video_kbps = _lower(video_kbps, profile.video_bitrate_kbps)
+        audio_kbps = _lower(audio_kbps, profile.audio_bitrate_kbps)
+        max_resolution = _lower(max_resolution, profile.max_resolution)
+    return video_kbps, audio_kbps, max_resolution
+
+
+def _lower(value, cap):
+    """The smaller of two optional limits."""
+    if value is None:
+        return cap
+    return value if cap is None else min(value, cap)
+
+
+def _scale_args(max_resolution: Optional[int]) -> list:
+    # Limit the shorter side, so 720 means 720p for portrait and landscape alike
+    if not max_resolution:
+        return []
+    r = int(max_resolution)
+    return ["-vf", f"scale='if(gt(iw,ih),-2,min({r},iw))':'if(gt(iw,ih),min({r},ih),-2)'"]
+
+
+def _bitrate_video_args(video_kbps: int, max_resolution: Optional[int], preset: Optional[str] = None) -> list:
+    # Capped VBR: average bitrate video_kbps, and the VBV buffer keeps peaks from
+    # pushing the file over budget, so the size is known before encoding.
+    return [
+        "-c:v", "libx264",
+        "-b:v", f"{video_kbps}k",
+        "-maxrate", f"{video_kbps}k",
+        "-bufsize", f"{video_kbps * 2}k",
+        "-preset", preset or DEFAULT_PRESET,
+        "-pix_fmt", "yuv420p",
+        *_scale_args(max_resolution),
+    ]
+
+
+def _bitrate_cmd(input_path: str, output_path: str, video_kbps: int, audio_kbps: int,
+                 max_resolution: Optional[int], threads: int = 0, preset: Optional[str] = None) -> list:
+    return [
+        "ffmpeg", "-y", "-i", input_path,
+        *_bitrate_video_args(video_kbps, max_resolution, preset),
+        "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+        "-movflags", "+faststart",
+        "-threads", str(threads),
+        output_path,
+    ]
+
+
+def compress_video(
+    input_path: str,
+    target_size_mb: float = 47.0,
+    max_attempts: int = 3,
+    limit_mb: float = STANDARD_UPLOAD_LIMIT_MB,
+    output_path: Optional[str] = None,
+    duration: Optional[float] = None,
+    on_progress: Optional[Callable[[float, float], None]] = None,
+    threads: int = 0,
+    profile: Optional["EncodingProfile"] = None,
+) -> str:
+    """
+    Compress video to target size with a bitrate computed from its duration.
+
+    The first pass is a capped-VBR encode at the bitrate that fits target_size_mb
+    (see plan_bitrate), so it normally lands under limit_mb without retries. If it
+    still misses, the next pass scales the bitrate by how far off the result was;
+    when a pass no longer shrinks the file (plateau) the original is returned.
+    The output is H.264/AAC with +faststart, so it is Telegram-compatible as well.
+
+    Writes to output_path (default `{base}_compressed{ext}` next to the input) and
+    returns it, or returns input_path if the file can't be brought under limit_mb.
+    on_progress, if given, is called with (encoded_seconds, duration).
+    threads is passed to ffmpeg's -threads (0 lets ffmpeg pick); profile (an
+    EncodingProfile) lowers resolution and bitrates and sets the preset from the first pass.
+    """
+    last_compressed_size_mb = None
+    file_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+
+    directory = os.path.dirname(input_path) or "."
+    if output_path is None:
+        base, ext = os.path.splitext(os.path.basename(input_path))
+        output_path = os.path.join(directory, f"{base}_compressed{ext}")
+
+    if not duration:
+        duration = get_duration(input_path)
+    if not duration:
+        logger.warning("Could not determine duration, skipping compression")
+        return input_path
+
+    # Check if compressed file already exists and is under limit. An empty file is
+    # a placeholder (prepare_for_telegram's temp file), not a finished encode.
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        existing_size = os.path.getsize(output_path) / (1024 * 1024)
+        if existing_size < limit_mb:
+            logger.info(f"Using existing compressed file: {existing_size:.2f}MB")
+            return output_path
+        logger.info(f"Existing compressed file is {existing_size:.2f}MB (> {limit_mb}MB), re-compressing")
+        os.remove(output_path)
+
+    video_kbps, audio_kbps, max_resolution = plan_bitrate(target_size_mb, duration, profile)
+    preset = profile.preset if profile else None
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            logger.info(
+                f"Compressing {os.path.basename(input_path)} at {video_kbps}kbps video + {audio_kbps}kbps audio"
+                f"{f' (max {max_resolution}p)' if max_resolution else ''} "
+                f"(file: {file_size_mb:.1f}MB, dur: {duration:.1f}s, target: {target_size_mb:.1f}MB, "
+                f"attempt {attempt}/{max_attempts})"
+            )
+            segmented = encode_segmented(
+                input_path, output_path, duration,
+                _bitrate_video_args(video_kbps, max_resolution, preset), ["-c:a", "aac", "-b:a", f"{audio_kbps}k"],
+                threads=threads,
+            )
+            if not segmented:
+                process = subprocess.Popen(
+                    governor.wrap(_bitrate_cmd(input_path, output_path, video_kbps, audio_kbps, max_resolution, threads, preset)),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                )
+
+                # Monitor progress
+                if process.stdout:
+                    for line in process.stdout:
+                        progress_info = parse_ffmpeg_progress(line)
+                        if progress_info and on_progress:
+                            on_progress(progress_info['time'], duration)
+
+                wait_for_ffmpeg(process)
+                if process.returncode != 0:
+                    logger.error("Compression encoding failed")
+                    return input_path
+            if on_progress:
+                on_progress(duration, duration)
+            
+            if not os.path.exists(output_path):
+                return input_path
+
+            new_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            logger.info(f"Compressed {os.path.basename(input_path)}: {new_size_mb:.2f}MB")
+            if new_size_mb < limit_mb:
+                return output_path
+
+            # Check if compression has plateaued
+            if last_compressed_size_mb and last_compressed_size_mb - new_size_mb < 0.5:
+                logger.warning(f"Compression plateaued at {new_size_mb:.2f}MB")
+                logger.warning(f"Cannot compress below {limit_mb}MB limit - returning original file")
+                os.remove(output_path)
+                return input_path
+            last_compressed_size_mb = new_size_mb
+
+            # Overshoot means the encoder spent more than asked (e.g. audio or
+            # container overhead the estimate missed); correct by the observed ratio.
+            scale = (target_size_mb / new_size_mb) * 0.95
+            video_kbps = max(MIN_VIDEO_KBPS, int(video_kbps * scale))
+            logger.warning(f"Compressed file is {new_size_mb:.2f}MB, still > {limit_mb}MB! Retrying at {video_kbps}kbps")
+            os.remove(output_path)
+
+        except Exception as e:
+            logger.error(f"Compression failed (attempt {attempt}/{max_attempts}): {e}")
+            if attempt >= max_attempts:
+                return input_path
+
+    return input_path
+
+
+def _ffmpeg_available() -> bool:
+    try:
+        subprocess.run(["ffmpeg", "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return True
+    except Exception:
+        return False
+
+
+def prepare_for_telegram(input_path: str, limit_mb: Optional[float] = None, threads: int = 0,
+                         profile: Optional[EncodingProfile] = None) -> str:
+    """
+    Turn a download into the file that will be uploaded, in at most one encode.
+
+    Telegram Desktop is picky about container/codec combinations, and the Bot API caps
+    upload size (limit_mb, default upload_limit_mb()). One ffprobe inspection decides:
+    - over the size limit: a single size-targeted H.264/AAC encode (compress_video)
+    - otherwise plan_telegram_transcode(): keep as-is, stream-copy remux, or a
+      libx264/AAC encode whose bitrate is capped so it can't overshoot the limit
+    - an encoding profile (EncodingProfile) turns a keep/remux into an encode when
+      the file exceeds its resolution or bitrate, and shapes every encode
+
+    The result replaces the download as `{stem}.mp4`, so no intermediate copies are
+    left behind. On any failure the original file is returned unchanged.
+    threads is passed to ffmpeg's -threads (0 lets ffmpeg pick).
+    """
+    src = Path(input_path)
+
+    # If ffmpeg isn't installed, keep the original file.
+    if not _ffmpeg_available():
+        logger.warning("ffmpeg not found; skipping Telegram-compatibility transcode")
+        return os.path.abspath(input_path)
+
+    limit_mb = upload_limit_mb() if limit_mb is None else limit_mb
+    info = probe_media(str(src))
+    size_mb = os.path.getsize(src) / (1024 * 1024)
+    duration = info.duration if info else None
+
+    if size_mb >= limit_mb:
+        action, reason = "compress", f"{size_mb:.1f}MB over the {limit_mb}MB upload limit"
+    elif info is None:
+        action, reason = "encode", "ffprobe failed"
+    else:
+        action, reason = plan_telegram_transcode(info)
+        profile_reason = profile.requires_encode(info) if profile else None
+        if action != "encode" and profile_reason:
+            action, reason = "encode", f"encoding profile: {profile_reason}"
+    if action == "none":
+        logger.info("No transcode needed for %s: %s", src.name, reason)
+        return os.path.abspath(input_path)
+    logger.info("Preparing %s for Telegram: %s (%s)", src.name, action, reason)
+
+    out_path = src.with_suffix(".mp4")
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=str(src.parent)) as tmp:
+        tmp_path = Path(tmp.name)
+
+    try:
+        ok = False
+        if action == "compress":
+            result = compress_video(
+                str(src), compression_target_mb(limit_mb), limit_mb=limit_mb,
+                output_path=str(tmp_path), duration=duration, threads=threads, profile=profile,
+            )
+            ok = result == str(tmp_path)
+        else:
+            if action == "remux":
+                audio_ok = info is not None and info.audio_codec in TELEGRAM_AUDIO_CODECS
+                ok = _run_ffmpeg([
+                    "ffmpeg", "-y", "-i", str(src),
+                    "-c:v", "copy",
+                    "-c:a", "copy" if audio_ok else "aac",
+                    "-movflags", "+faststart",
+                    "-threads", str(threads),
+                    str(tmp_path),
+                ])
+                if not ok:
+                    logger.warning("Remux of %s failed; re-encoding instead", src.name)
+            if not ok and duration:
+                ok = encode_segmented(
+                    str(src), str(tmp_path), duration,
+                    _crf_video_args(duration, limit_mb, profile), _audio_args(profile),
+                    threads=threads,
+                )
+            if not ok:
+                ok = _run_ffmpeg(_encode_cmd(str(src), str(tmp_path), duration, limit_mb, threads, profile))
+
+        if not ok:
+            logger.warning("Could not prepare %s for Telegram; uploading original file instead", src.name)
+            return os.path.abspath(input_path)
+
+        tmp_path.replace(out_path)
+        if src != out_path and src.exists():
+            src.unlink()
+        logger.info("Prepared for Telegram: %s -> %s (%.2fMB)", src.name, out_path.name,
+                    os.path.getsize(out_path) / (1024 * 1024))
+        return os.path.abspath(str(out_path))
+    finally:
+        # Cleanup temp if it still exists and wasn't moved
+        try:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        except Exception:
+            pass
+
+
+def _crf_video_args(duration: Optional[float], limit_mb: float, profile: Optional[EncodingProfile] = None) -> list:
+    args = [
+        "-c:v", "libx264",
+        "-pix_fmt", "yuv420p",
+        "-preset", (profile.preset if profile else None) or DEFAULT_PRESET,
+        "-crf", "23",
+    ]
+    video_kbps = None
+    if duration:
+        video_kbps = int(compression_target_mb(limit_mb) * 1024 * 8 / duration) - 128
+        if video_kbps <= 0:
+            video_kbps = None
+    if profile is not None:
+        video_kbps = _lower(video_kbps, profile.video_bitrate_kbps)
+    if video_kbps:
+        args += ["-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k"]
+    return args + _scale_args(profile.max_resolution if profile else None)
+
+
+def _audio_args(profile: Optional[EncodingProfile] = None) -> list:
+    return ["-c:a", "aac", "-b:a", f"{_lower(128, profile.audio_bitrate_kbps if profile else None)}k"]
+
+
+def _encode_cmd(src: str, dst: str, duration: Optional[float], limit_mb: float, threads: int = 0,
+                profile: Optional[EncodingProfile] = None) -> list:
+    """
+    Baseline Telegram encode (H.264 yuv420p + AAC, faststart). With a known duration
+    the video bitrate is capped so the output stays under the upload limit.
+    """
+    return [
+        "ffmpeg", "-y", "-i", src,
+        *_crf_video_args(duration, limit_mb, profile),
+        *_audio_args(profile),
+        "-movflags", "+faststart",
+        "-threads", str(threads),
+        dst,
+    ]
+
+
+def keyframe_times(path: str) -> List[float]:
+    """Timestamps of the video keyframes, read from packet flags (no decoding)."""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        path,
+    ]
+    try:
+        result = subprocess.run(governor.wrap(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except Exception as e:
+        logger.warning(f"Failed to read keyframes of {path}: {e}")
+        return []
+    if result.returncode != 0:
+        return []
+    times = []
+    for line in result.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags:
+            try:
+                times.append(float(pts))
+            except ValueError:
+                continue
+    return sorted(times)
+
+
+def segment_bounds(keyframes: List[float], duration: float, count: int) -> List[Tuple[float, Optional[float]]]:
+    """
+    Split [0, duration) into up to `count` (start, end) ranges cut at the keyframes
+    closest to equal shares. The last range is open-ended (end None).
+    """
+    cuts: List[float] = []
+    for i in range(1, count):
+        if not keyframes:
+            break
+        ideal = duration * i / count
+        cut = min(keyframes, key=lambda k: abs(k - ideal))
+        if cut > (cuts[-1] if cuts else 0.0):
+            cuts.append(cut)
+    points = [0.0] + cuts
+    return [(start, end) for start, end in zip(points, points[1:])] + [(points[-1], None)]
+
+
+def _duration_matches(actual: Optional[float], expected: float) -> bool:
+    return actual is not None and abs(actual - expected) <= max(SEGMENT_DURATION_TOLERANCE, expected * 0.01)
+
+
+def _has_audio(path: str) -> bool:
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "a",
+        "-show_entries", "stream=index",
+        "-of", "csv=p=0",
+        path,
+    ]
+    try:
+        result = subprocess.run(governor.wrap(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except Exception:
+        return False
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+
+def encode_segmented(src: str, dst: str, duration: float, video_args: list, audio_args: list,
+                     threads: int = 0) -> bool:
+    """
+    Encode a long video as keyframe-aligned segments in parallel, then join them.
+
+    One libx264 process per segment (each with an equal share of `threads`, default
+    all cores) shares the same rate settings, so the bitrate budget is spread over the
+    segments by their length. Audio is encoded once, whole, to avoid gaps at the
+    joins; the concat demuxer then stream-copies segments and audio into dst.
+    Every segment and the joined file are checked against the source duration.
+    Returns False without touching dst when the video is too short to be worth
+    splitting or anything fails, so the caller can fall back to a single encode.
+    """
+    if duration < SEGMENT_MIN_DURATION:
+        return False
+    cores = threads or os.cpu_count() or 1
+    count = min(cores, math.ceil(duration / SEGMENT_SECONDS))
+    if count < 2:
+        return False
+    bounds = segment_bounds(keyframe_times(src), duration, count)
+    if len(bounds) < 2:
+        logger.info(f"Not enough keyframes to split {os.path.basename(src)}; encoding in one piece")
+        return False
+    seg_threads = max(1, cores // len(bounds))
+    logger.info(
+        f"Encoding {os.path.basename(src)} ({duration:.0f}s) as {len(bounds)} parallel segments "
+        f"with {seg_threads} thread(s) each"
+    )
+
+    workdir = tempfile.mkdtemp(prefix=".segments-", dir=os.path.dirname(dst) or ".")
+    processes: list = []
+    try:
+        jobs = []
+        for i, (start, end) in enumerate(bounds):
+            out = os.path.join(workdir, f"{i:03d}.mp4")
+            cmd = ["ffmpeg", "-y", "-ss", f"{start:.3f}"]
+            if end is not None:
+                cmd += ["-to", f"{end:.3f}"]
+            cmd += ["-i", src, "-an", *video_args, "-threads", str(seg_threads), out]
+            jobs.append((out, (end if end is not None else duration) - start, cmd))
+        audio = os.path.join(workdir, "audio.m4a") if _has_audio(src) else None
+        if audio:
+            jobs.append((audio, duration, ["ffmpeg", "-y", "-i", src, "-vn", *audio_args, audio]))
+
+        # Start every process first, then reap them on this thread so their CPU time
+        # is charged to the transcode job
+        for out, _, cmd in jobs:
+            log = open(f"{out}.log", "w")
+            try:
+                processes.append((subprocess.Popen(governor.wrap(cmd), stdout=subprocess.DEVNULL, stderr=log), log))
+            except Exception:
+                log.close()
+                raise
+        returncodes = [wait_for_ffmpeg(process) for process, _ in processes]
+
+        for (out, expected, _), returncode in zip(jobs, returncodes):
+            if returncode != 0:
+                with open(f"{out}.log") as f:
+                    logger.warning(f"Segment encode {os.path.basename(out)} failed: {f.read().strip()[-2000:]}")
+                return False
+            actual = get_duration(out)
+            if not _duration_matches(actual, expected):
+                logger.warning(f"Segment {os.path.basename(out)} is {actual}s, expected {expected:.2f}s")
+                return False
+
+        concat_list = os.path.join(workdir, "segments.txt")
+        with open(concat_list, "w") as f:
+            for out, _, _ in jobs[:len(bounds)]:
+                f.write(f"file '{os.path.basename(out)}'\n")
+        cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_list]
+        if audio:
+            cmd += ["-i", audio, "-map", "0:v", "-map", "1:a"]
+        cmd += ["-c", "copy", "-movflags", "+faststart", dst]
+        if not _run_ffmpeg(cmd):
+            return False
+        joined = get_duration(dst)
+        if not _duration_matches(joined, duration):
+            logger.warning(f"Joined segments are {joined}s, expected {duration:.2f}s")
+            os.remove(dst)
+            return False
+        return True
+    except Exception as e:
+        logger.warning(f"Segmented encode of {os.path.basename(src)} failed: {e}")
+        return False
+    finally:
+        for process, log in processes:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+            log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def stream_encode(source: BinaryIO, dst: str, duration: float, compress: bool,
+                  limit_mb: Optional[float] = None, threads: int = 0,
+                  profile: Optional[EncodingProfile] = None) -> bool:
+    """
+    Encode media read from `source` (e.g. an HTTP response) straight into dst.
+
+    The bytes are piped into ffmpeg's stdin, so only the finished Telegram-ready MP4
+    reaches disk. compress selects the size-targeted bitrate (plan_bitrate) instead
+    of the capped-CRF compatibility encode; an encoding profile shapes either one.
+    A pipe can't be read twice, so there is a single pass: the output is kept only
+    if it matches `duration` and is under limit_mb, otherwise dst is left untouched
+    and False is returned.
+    """
+    limit_mb = upload_limit_mb() if limit_mb is None else limit_mb
+    if compress:
+        video_kbps, audio_kbps, max_resolution = plan_bitrate(compression_target_mb(limit_mb), duration, profile)
+        video_args = _bitrate_video_args(video_kbps, max_resolution, profile.preset if profile else None)
+        audio_args = ["-c:a", "aac", "-b:a", f"{audio_kbps}k"]
+    else:
+        video_args, audio_args = _crf_video_args(duration, limit_mb, profile), _audio_args(profile)
+
+    directory = os.path.dirname(dst) or "."
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=directory) as tmp:
+        tmp_path = tmp.name
+    cmd = [
+        "ffmpeg", "-y", "-i", "pipe:0",
+        *video_args, *audio_args,
+        "-movflags", "+faststart",
+        "-threads", str(threads),
+        tmp_path,
+    ]
+    try:
+        with tempfile.TemporaryFile(mode="w+") as log:
+            process = subprocess.Popen(governor.wrap(cmd), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log)
+            try:
+                assert process.stdin is not None
+                for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b""):
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                # ffmpeg gave up on the input; its log says why
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                wait_for_ffmpeg(process)
+            if process.returncode != 0:
+                log.seek(0)
+                logger.warning(f"Streaming encode failed: {log.read().strip()[-2000:]}")
+                return False
+
+        actual = get_duration(tmp_path)
+        if not _duration_matches(actual, duration):
+            logger.warning(f"Streamed encode is {actual}s, expected {duration:.2f}s")
+            return False
+        size_mb = os.path.getsize(tmp_path) / (1024 * 1024)
+        if size_mb >= limit_mb:
+            logger.warning(f"Streamed encode is {size_mb:.2f}MB, over the {limit_mb}MB upload limit")
+            return False
+        os.replace(tmp_path, dst)
+        logger.info(f"Streamed and encoded {os.path.basename(dst)} ({size_mb:.2f}MB)")
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def wait_for_ffmpeg(process: subprocess.Popen) -> int:
+    """
+    Wait for an ffmpeg process and charge its resource usage to the current transcode job.
+
+    os.wait4() reaps the child and returns its getrusage() record (CPU time, peak RSS),
+    which Popen.wait() would discard. Falls back to a plain wait where wait4 isn't available.
+    """
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except (AttributeError, ChildProcessError, TypeError):
+        return process.wait()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record_usage(usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+    return process.returncode
+
+
+def _run_ffmpeg(cmd: list) -> bool:
+    with subprocess.Popen(governor.wrap(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as process:
+        output = process.stdout.read() if process.stdout else ""
+        returncode = wait_for_ffmpeg(process)
+    if returncode != 0:
+        logger.warning("ffmpeg failed: %s", (output or "").strip()[-4000:])
+        return False
+    return True
@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("tok2gram.transcode_pool")
+
+# Lower runs first. A video waiting to be uploaded holds up its post's upload right
+# now; a download being prepared can wait behind it.
+PRIORITY_UPLOAD = 0
+PRIORITY_DOWNLOAD = 10
+
+# Encoder threads per job when the worker count is derived from the CPU count;
+# x264 scales well up to a few threads per encode, beyond that parallel jobs win.
+DEFAULT_THREADS_PER_JOB = 4
+
+_current = threading.local()
+
+
+def record_usage(cpu_seconds: float, max_rss_kb: int = 0):
+    """Charge a finished child process (CPU time, peak RSS in KB) to the job running on this thread."""
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.cpu_seconds += cpu_seconds
+        job.peak_rss_kb = max(job.peak_rss_kb, max_rss_kb)
+
+
+@dataclass
+class _Job:
+    fn: Callable[..., Any]
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+    name: str
+    priority: int
+    future: Future = field(default_factory=Future)
+    submitted: float = field(default_factory=time.monotonic)
+    cpu_seconds: float = 0.0
+    peak_rss_kb: int = 0
+
+
+class TranscodeScheduler:
+    """
+    Priority queue and dedicated worker threads for ffmpeg work.
+
+    Encodes are CPU-bound and long, so they get their own workers instead of the
+    event loop's default executor, where they would hold up listing and downloads.
+    The pool is sized from the CPU count: `workers` jobs run at once and each is
+    handed `threads` (passed to the job as a keyword argument) so that together
+    they fill, but do not oversubscribe, the machine.
+    Every finished job logs its queue wait, wall time, and the CPU time and peak RSS
+    of the ffmpeg processes it ran (reported through record_usage()).
+    """
+
+    def __init__(self, workers: Optional[int] = None, threads_per_job: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._queue: "queue.PriorityQueue[Tuple[float, int, Optional[_Job]]]" = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._workers: List[threading.Thread] = []
+        self._running = 0
+        self._completed = 0
+        self._wall_seconds = 0.0
+        self._cpu_seconds = 0.0
+        self._peak_rss_kb = 0
+        self.configure(workers, threads_per_job)
+
+    def configure(self, workers: Optional[int] = None, threads_per_job: Optional[int] = None):
+        """Size the pool; None derives the value from os.cpu_count(). Started workers are kept."""
+        cpus = os.cpu_count() or 1
+        with self._lock:
+            self.workers = max(1, int(workers)) if workers else max(1, cpus // DEFAULT_THREADS_PER_JOB)
+            self.threads_per_job = max(1, int(threads_per_job)) if threads_per_job else max(1, cpus // self.workers)
+
+    def _ensure_workers(self):
+        with self._lock:
+            while len(self._workers) < self.workers:
+                worker = threading.Thread(
+                    target=self._work, name=f"transcode-{len(self._workers)}", daemon=True
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, fn: Callable[..., Any], *args: Any, priority: int = PRIORITY_DOWNLOAD,
+               name: Optional[str] = None, **kwargs: Any) -> Future:
+        """Queue fn(*args, threads=..., **kwargs); returns a Future for its result."""
+        job = _Job(fn, args, kwargs, name or getattr(fn, "__name__", "job"), priority)
+        self._ensure_workers()
+        self._queue.put((priority, next(self._counter), job))
+        logger.info(f"Queued transcode '{job.name}' (priority {priority}); queue depth {self.queue_depth()}")
+        return job.future
+
+    async def run(self, fn: Callable[..., Any], *args: Any, priority: int = PRIORITY_DOWNLOAD,
+                  name: Optional[str] = None, **kwargs: Any) -> Any:
+        """submit() and await the result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, priority=priority, name=name, **kwargs))
+
+    def queue_depth(self) -> int:
+        """Jobs waiting for a worker."""
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queued": self.queue_depth(),
+                "running": self._running,
+                "completed": self._completed,
+                "wall_seconds": self._wall_seconds,
+                "cpu_seconds": self._cpu_seconds,
+                "peak_rss_kb": self._peak_rss_kb,
+            }
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            waited = time.monotonic() - job.submitted
+            with self._lock:
+                self._running += 1
+                threads = self.threads_per_job
+            _current.job = job
+            start = time.monotonic()
+            try:
+                job.future.set_result(job.fn(*job.args, threads=threads, **job.kwargs))
+            except BaseException as e:
+                job.future.set_exception(e)
+            finally:
+                _current.job = None
+                wall = time.monotonic() - start
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._wall_seconds += wall
+                    self._cpu_seconds += job.cpu_seconds
+                    self._peak_rss_kb = max(self._peak_rss_kb, job.peak_rss_kb)
+                logger.info(
+                    f"Transcode '{job.name}' finished in {wall:.1f}s wall / {job.cpu_seconds:.1f}s CPU, "
+                    f"peak RSS {job.peak_rss_kb / 1024:.0f}MB, on {threads} thread(s), "
+                    f"after {waited:.1f}s in queue; queue depth {self.queue_depth()}"
+                )
+
+    def shutdown(self):
+        """Stop the workers once the jobs already queued have run."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put((float("inf"), next(self._counter), None))
+        for worker in workers:
+            worker.join()
+
+
+# Process-wide scheduler shared by download-time preparation and upload-time compression.
+transcode_scheduler = TranscodeScheduler()
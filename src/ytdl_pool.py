@@ -0,0 +1,164 @@
+import os
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import yt_dlp
+from yt_dlp.extractor import get_info_extractor
+
+logger = logging.getLogger("tok2gram.ytdl_pool")
+
+# Only the extractors we actually hit. Registering these instead of the ~1800 default
+# extractors keeps instance creation and URL matching cheap.
+TIKTOK_EXTRACTORS = ("TikTok", "TikTokUser", "TikTokVM")
+
+# (profile, cookie file, Cookie header, cookie file generation)
+PoolKey = Tuple[str, Optional[str], Optional[str], int]
+
+
+class YoutubeDLPool:
+    """
+    Pool of long-lived yt_dlp.YoutubeDL objects.
+
+    Instances are keyed by option profile (e.g. 'listing', 'probe', 'download') and by
+    the cookie file / Cookie header in the options, so extractor setup, cookie-jar
+    parsing and the HTTP connection pool are paid once instead of on every call.
+    A YoutubeDL is not thread-safe, so each borrow() hands out an instance exclusively.
+    Callers must use the same options for the same profile; only outtmpl may vary per call.
+
+    An instance keeps the cookie jar it loaded and saves it back when closed. When a
+    cookie file's mtime changes behind the pool's back (the operator replaced it), the
+    instances holding the old jar are dropped without saving, so the new file is
+    loaded instead of being overwritten by a stale jar.
+    """
+
+    def __init__(self, max_idle_per_key: int = 4):
+        self.max_idle_per_key = max_idle_per_key
+        self._lock = threading.Lock()
+        self._idle: Dict[PoolKey, List[Any]] = {}
+        # cookie file -> (mtime last loaded or saved by the pool, generation)
+        self._cookie_files: Dict[str, Tuple[Optional[float], int]] = {}
+
+    @staticmethod
+    def _mtime(path: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _generation(self, cookiefile: Optional[str]) -> Tuple[int, List[Any]]:
+        """
+        Current generation of cookiefile, bumped when its mtime changed since the pool
+        last loaded or saved it. Returns (generation, stale idle instances). Call with
+        the lock held.
+        """
+        if not cookiefile:
+            return 0, []
+        mtime = self._mtime(cookiefile)
+        known = self._cookie_files.get(cookiefile)
+        if known is None:
+            self._cookie_files[cookiefile] = (mtime, 0)
+            return 0, []
+        known_mtime, generation = known
+        if mtime == known_mtime:
+            return generation, []
+        logger.info(f"Cookie file {cookiefile} changed on disk; reloading it in new yt-dlp instances")
+        self._cookie_files[cookiefile] = (mtime, generation + 1)
+        stale: List[Any] = []
+        for key in [k for k in self._idle if k[1] == cookiefile]:
+            stale.extend(self._idle.pop(key))
+        return generation + 1, stale
+
+    def _key(self, profile: str, opts: Dict[str, Any], generation: int) -> PoolKey:
+        headers = opts.get("http_headers") or {}
+        return (profile, opts.get("cookiefile"), headers.get("Cookie"), generation)
+
+    @staticmethod
+    def _discard(ydl: Any):
+        """Close an instance holding an outdated cookie jar without writing it back."""
+        ydl.params["cookiefile"] = None
+        try:
+            ydl.close()
+        except Exception as e:
+            logger.debug(f"Error closing YoutubeDL instance: {e}")
+
+    def _close(self, key: PoolKey, ydl: Any):
+        """Close an instance, saving its cookie jar only if it is still the current one."""
+        cookiefile = key[1]
+        with self._lock:
+            current = key[3] == self._current_generation(cookiefile)
+            if current:
+                try:
+                    ydl.close()
+                except Exception as e:
+                    logger.debug(f"Error closing YoutubeDL instance: {e}")
+                if cookiefile:
+                    # Our own save is not an outside change
+                    self._cookie_files[cookiefile] = (self._mtime(cookiefile), key[3])
+        if not current:
+            self._discard(ydl)
+
+    def _current_generation(self, cookiefile: Optional[str]) -> int:
+        known = self._cookie_files.get(cookiefile) if cookiefile else None
+        return known[1] if known else 0
+
+    @staticmethod
+    def _create(opts: Dict[str, Any]) -> Any:
+        # YoutubeDL mutates its params (headers, outtmpl), so hand it a copy
+        params = dict(opts)
+        if "http_headers" in params:
+            params["http_headers"] = dict(params["http_headers"])
+        ydl = yt_dlp.YoutubeDL(params, auto_init=False)  # type: ignore[arg-type]
+        for ie_key in TIKTOK_EXTRACTORS:
+            ydl.add_info_extractor(get_info_extractor(ie_key))
+        return ydl
+
+    @contextmanager
+    def borrow(self, profile: str, opts: Dict[str, Any], outtmpl: Optional[str] = None) -> Iterator[Any]:
+        """Check out a YoutubeDL for `profile`, creating one if none is idle."""
+        with self._lock:
+            generation, stale = self._generation(opts.get("cookiefile"))
+            key = self._key(profile, opts, generation)
+            idle = self._idle.get(key)
+            ydl = idle.pop() if idle else None
+        for old in stale:
+            self._discard(old)
+        if ydl is None:
+            logger.debug(f"Creating YoutubeDL instance for profile '{profile}'")
+            ydl = self._create(opts)
+
+        if outtmpl is not None:
+            ydl.params["outtmpl"]["default"] = outtmpl
+
+        try:
+            yield ydl
+        finally:
+            with self._lock:
+                if key[3] == self._current_generation(key[1]):
+                    idle = self._idle.setdefault(key, [])
+                    if len(idle) < self.max_idle_per_key:
+                        idle.append(ydl)
+                        ydl = None
+            if ydl is not None:
+                self._close(key, ydl)
+
+    def close_all(self):
+        """Close every idle instance (this also saves cookie jars back to their files)."""
+        with self._lock:
+            instances = [(key, ydl) for key, idle in self._idle.items() for ydl in idle]
+            self._idle.clear()
+        for key, ydl in instances:
+            self._close(key, ydl)
+
+
+_pool = YoutubeDLPool()
+
+
+def borrow(profile: str, opts: Dict[str, Any], outtmpl: Optional[str] = None):
+    """Borrow a pooled YoutubeDL from the process-wide pool."""
+    return _pool.borrow(profile, opts, outtmpl=outtmpl)
+
+
+def close_all():
+    _pool.close_all()
@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import ytdl_pool
+from src.rate_limit import tiktok_budget
+
+
+@pytest.fixture(autouse=True)
+def _reset_ytdl_pool():
+    # Pooled instances would otherwise leak mocks from one test into the next
+    ytdl_pool.close_all()
+    yield
+    ytdl_pool.close_all()
+
+
+@pytest.fixture(autouse=True)
+def _unthrottled_budget():
+    # Mocked TikTok calls should not wait on the production request budget
+    saved = (tiktok_budget.rate, tiktok_budget.burst, tiktok_budget.jitter)
+    tiktok_budget.configure(rate=1000, burst=1000, jitter=0)
+    yield
+    tiktok_budget.configure(rate=saved[0], burst=saved[1], jitter=saved[2])
@@ -4,6 +4,7 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from src.core.config_loader import load_config, load_creators
+from src.config_loader import load_config as load_settings, resolve_encoding_profile
 
 def test_load_config_valid(tmp_path):
     config_file = tmp_path / "config.yaml"
@@ -54,3 +55,31 @@ def test_load_config_env_override(tmp_path, monkeypatch):
 def test_load_config_missing_file():
     with pytest.raises(FileNotFoundError):
         load_config("non_existent.yaml")
+
+def test_resolve_encoding_profile():
+    settings = {
+        'encoding_profiles': {'mobile': {'max_resolution': 720, 'preset': 'faster'}},
+        'chat_encoding_profiles': {'-100123': 'mobile'},
+        'default_encoding_profile': {'video_bitrate_kbps': 2000},
+    }
+    assert resolve_encoding_profile({'username': 'a'}, -100123, settings).max_resolution == 720
+    assert resolve_encoding_profile({'username': 'a'}, '-100999', settings).video_bitrate_kbps == 2000
+    inline = resolve_encoding_profile({'username': 'a', 'encoding_profile': {'audio_bitrate_kbps': 64}}, -100123, settings)
+    assert inline.audio_bitrate_kbps == 64 and inline.max_resolution is None
+    assert resolve_encoding_profile({'username': 'a'}, -100123, {}) is None
+
+    with pytest.raises(ValueError):
+        resolve_encoding_profile({'username': 'a', 'encoding_profile': 'tv'}, -100123, settings)
+
+
+def test_chat_encoding_profile_with_unquoted_yaml_chat_id(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        "telegram:\n  bot_token: t\n"
+        "settings:\n"
+        "  encoding_profiles:\n    mobile:\n      max_resolution: 720\n"
+        "  chat_encoding_profiles:\n    -1001234567890: mobile\n"
+    )
+    settings = load_settings(str(config_file))['settings']
+    profile = resolve_encoding_profile({'username': 'a'}, -1001234567890, settings)
+    assert profile is not None and profile.max_resolution == 720
@@ -0,0 +1,18 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.cookie_manager import CookieManager
+
+
+def test_rotate_from_a_cookie_is_independent_of_other_rotations(tmp_path):
+    for name in ("a.txt", "b.txt", "c.txt"):
+        (tmp_path / name).write_text(name)
+    manager = CookieManager(str(tmp_path))
+    first = manager.get_current_cookie_path()
+
+    # Two creators fail on the same cookie at once: both move to the next one
+    assert manager.rotate(first) == str(tmp_path / "b.txt")
+    assert manager.rotate(first) == str(tmp_path / "b.txt")
+    assert manager.read_cookie(str(tmp_path / "b.txt")) == "b.txt"
+    # Without a cookie, rotation continues from the current one
+    assert manager.rotate() == str(tmp_path / "c.txt")
@@ -3,18 +3,22 @@ from unittest.mock import patch, MagicMock
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from src.downloader import download_video, download_slideshow
+from src.downloader import download_video, download_slideshow, _download_slideshow_fallback, _stream_to_file
+from src.downloader import _download_slideshow_gallery_dl, PostInaccessibleError
+from src.downloader import choose_video_format, select_telegram_format
+from src import downloader
+from src.core.state import StateStore
 from src.tiktok_api import Post
 
 
-@patch('src.downloader.yt_dlp.YoutubeDL')
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
 def test_download_video_success(mock_ytdl, tmp_path):
     post = Post("vid1", "creator1", "video", "https://tiktok.com/vid1", "caption", 1600000000)
     download_path = tmp_path / "downloads"
     download_path.mkdir()
     
     # Mock successful download
-    mock_instance = mock_ytdl.return_value.__enter__.return_value
+    mock_instance = mock_ytdl.return_value
     # Mock prepare_filename to return an existing file
     mock_instance.prepare_filename.return_value = str(download_path / "vid1.mp4")
     
@@ -27,7 +31,7 @@ def test_download_video_success(mock_ytdl, tmp_path):
     # Check yt-dlp was called with correct options
     args, kwargs = mock_ytdl.call_args
     opts = args[0]
-    assert opts['format'] == 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+    assert opts['format'] is select_telegram_format
     assert opts['merge_output_format'] == 'mp4'
     assert opts['concurrent_fragment_downloads'] in [1, 2]
     
@@ -35,14 +39,14 @@ def test_download_video_success(mock_ytdl, tmp_path):
     assert os.path.exists(result_path)
 
 
-@patch('src.downloader.yt_dlp.YoutubeDL')
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
 def test_download_slideshow_success(mock_ytdl, tmp_path):
     post = Post("slide1", "creator1", "slideshow", "https://tiktok.com/slide1", "caption", 1600000000)
     download_path = tmp_path / "downloads"
     download_path.mkdir()
     
     # Mock slideshow metadata
-    mock_instance = mock_ytdl.return_value.__enter__.return_value
+    mock_instance = mock_ytdl.return_value
     mock_instance.extract_info.return_value = {
         'entries': [
             {'url': 'img1_url', 'id': 'img1', 'ext': 'jpg'},
@@ -62,3 +66,257 @@ def test_download_slideshow_success(mock_ytdl, tmp_path):
     assert result_paths is not None
     # Check if we got images or video
     assert 'images' in result_paths or 'video' in result_paths
+
+
+@patch('src.downloader._transcode_to_telegram_mp4', side_effect=lambda p, **kw: p)
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_download_video_reuses_fresh_probe_info(mock_ytdl, mock_transcode, tmp_path):
+    import time
+    probe_info = {'id': 'vid2', 'formats': [{'vcodec': 'h264', 'url': 'https://cdn/x.mp4'}]}
+    post = Post("vid2", "creator1", "video", "https://tiktok.com/vid2", "caption", 1600000000,
+                probe_info=probe_info, probed_at=time.time())
+    download_path = tmp_path / "downloads"
+    (download_path / "creator1").mkdir(parents=True)
+    (download_path / "creator1" / "vid2.mp4").write_text("dummy content")
+
+    mock_instance = mock_ytdl.return_value
+    mock_instance.process_ie_result.return_value = probe_info
+    mock_instance.prepare_filename.return_value = str(download_path / "creator1" / "vid2.mp4")
+
+    assert download_video(post, str(download_path)) is not None
+    mock_instance.process_ie_result.assert_called_once()
+    mock_instance.extract_info.assert_not_called()
+
+    # Stale probe metadata is ignored
+    post.probed_at = time.time() - 3600
+    download_video(post, str(download_path))
+    mock_instance.extract_info.assert_called_once()
+
+
+
+@patch('src.downloader.stream_encode')
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_download_video_streams_when_reencode_needed(mock_ytdl, mock_stream, tmp_path):
+    import time
+    probe_info = {'id': 'vid3', 'duration': 30.0,
+                  'formats': [{'format_id': 'bytevc1', 'vcodec': 'h265', 'acodec': 'aac', 'url': 'https://cdn/x.mp4'}]}
+    post = Post("vid3", "creator1", "video", "https://tiktok.com/vid3", "caption", 1600000000,
+                probe_info=probe_info, probed_at=time.time())
+    mock_instance = mock_ytdl.return_value
+    mock_instance._calc_headers.return_value = {'User-Agent': 'ua'}
+    mock_stream.return_value = True
+
+    result = download_video(post, str(tmp_path), stream_transcode=True)
+
+    assert result == str(tmp_path / "creator1" / "vid3.mp4")
+    mock_instance.urlopen.assert_called_once()
+    assert mock_stream.call_args[0][3] is False  # fits the limit: compatibility encode, not compression
+    mock_instance.process_ie_result.assert_not_called()
+    mock_instance.extract_info.assert_not_called()
+
+    # A failed stream falls back to the regular download
+    mock_stream.return_value = False
+    mock_instance.process_ie_result.return_value = probe_info
+    mock_instance.prepare_filename.return_value = str(tmp_path / "creator1" / "vid3.mp4")
+    (tmp_path / "creator1" / "vid3.mp4").write_text("dummy content")
+    with patch('src.downloader._transcode_to_telegram_mp4', side_effect=lambda p, **kw: p):
+        assert download_video(post, str(tmp_path), stream_transcode=True) is not None
+    mock_instance.process_ie_result.assert_called_once()
+
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_slideshow_fallback_streams_images_in_order(mock_ytdl, tmp_path):
+    post = Post("slide2", "creator1", "slideshow", "https://tiktok.com/slide2", "caption", 1600000000)
+    mock_ytdl.return_value.extract_info.return_value = {
+        'entries': [{'url': f'https://cdn.example/img{i}'} for i in range(1, 6)]
+    }
+
+    def fake_get(url, timeout=None, stream=False, headers=None):
+        assert stream
+        resp = MagicMock()
+        resp.headers = {'Content-Type': 'image/png' if url.endswith('3') else 'image/jpeg'}
+        resp.iter_content.return_value = [url.encode(), b"-", b"tail"]
+        return resp
+
+    with patch('src.downloader.requests.Session') as mock_session:
+        mock_session.return_value.get.side_effect = fake_get
+        result = _download_slideshow_fallback(post, str(tmp_path))
+
+    images = result['images']
+    assert [os.path.basename(p) for p in images] == ['1.jpg', '2.jpg', '3.png', '4.jpg', '5.jpg']
+    with open(images[2], 'rb') as f:
+        assert f.read() == b"https://cdn.example/img3-tail"
+    # Temp files are renamed into place, none are left behind
+    assert not [n for n in os.listdir(os.path.dirname(images[0])) if n.endswith('.part')]
+
+
+def test_stream_to_file_resumes_partial_with_range(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    part = tmp_path / ".1.part"
+    part.write_bytes(b"abc")
+    store.record_partial("post1", str(part), "https://cdn.example/1", expected_size=6, etag='"v1"')
+
+    resp = MagicMock()
+    resp.status_code = 206
+    resp.headers = {'Content-Type': 'image/jpeg', 'Content-Range': 'bytes 3-5/6', 'ETag': '"v1"'}
+    resp.iter_content.return_value = [b"def"]
+    session = MagicMock()
+    session.get.return_value = resp
+
+    path = _stream_to_file(session, "https://cdn.example/1", str(tmp_path), "1", {'image/jpeg': 'jpg'}, "jpg", 15,
+                           "post1", store)
+
+    headers = session.get.call_args.kwargs['headers']
+    assert headers == {'Range': 'bytes=3-', 'If-Range': '"v1"'}
+    assert os.path.basename(path) == "1.jpg"
+    with open(path, 'rb') as f:
+        assert f.read() == b"abcdef"
+    assert not part.exists()
+
+
+def test_stream_to_file_rejects_short_body(tmp_path):
+    resp = MagicMock()
+    resp.status_code = 200
+    resp.headers = {'Content-Type': 'image/jpeg', 'Content-Length': '10'}
+    resp.iter_content.return_value = [b"short"]
+    session = MagicMock()
+    session.get.return_value = resp
+
+    with pytest.raises(IOError):
+        _stream_to_file(session, "https://cdn.example/1", str(tmp_path), "1", {'image/jpeg': 'jpg'}, "jpg", 15)
+    assert not os.listdir(tmp_path)
+
+
+def test_gallery_dl_runs_in_process(tmp_path):
+    post = Post("slide3", "creator1", "slideshow", "https://www.tiktok.com/@c/photo/3", "caption", 1600000000)
+    cookie_file = tmp_path / "cookies.txt"
+    cookie_file.write_text(
+        "# Netscape HTTP Cookie File\n"
+        ".tiktok.com\tTRUE\t/\tTRUE\t0\tsessionid\tabc\n"
+        ".example.com\tTRUE\t/\tTRUE\t0\tother\tx\n"
+    )
+    out = tmp_path / "out"
+    # Settings from the user's gallery-dl config survive the job
+    downloader.gdl_config.set(("extractor",), "retries", 7)
+
+    class FakeJob:
+        def __init__(self, extr):
+            assert extr.url == post.url
+            self.extr = extr
+
+        def run(self):
+            assert self.extr.config("base-directory") == str(out)
+            assert self.extr.config("cookies") == {"sessionid": "abc"}
+            assert self.extr.config("retries") == 7
+            # Per-job options stay out of the shared config
+            assert downloader.gdl_config.get((), "base-directory") is None
+            for name in ("01.jpg", "02.jpg", "03.mp3"):
+                (out / name).write_bytes(b"x")
+            return 0
+
+    try:
+        with patch.object(downloader.gdl_job, "DownloadJob", FakeJob):
+            result = _download_slideshow_gallery_dl(post, str(out), cookie_path=str(cookie_file))
+        assert downloader.gdl_config.get(("extractor",), "retries") == 7
+    finally:
+        downloader.gdl_config.unset(("extractor",), "retries")
+
+    assert [os.path.basename(p) for p in sorted(result['images'])] == ["01.jpg", "02.jpg"]
+    assert os.path.basename(result['audio']) == "03.mp3"
+
+
+def test_gallery_dl_cookie_cache_keeps_latest_version(tmp_path):
+    cookie_file = tmp_path / "cookies.txt"
+    for mtime, value in ((1000, "old"), (2000, "new")):
+        cookie_file.write_text(f"# Netscape HTTP Cookie File\n.tiktok.com\tTRUE\t/\tTRUE\t0\tsessionid\t{value}\n")
+        os.utime(cookie_file, (mtime, mtime))
+        assert downloader._load_cookie_dict(str(cookie_file), None) == {"sessionid": value}
+    assert downloader._gallery_dl_cookies[str(cookie_file)] == (2000, {"sessionid": "new"})
+
+
+def test_gallery_dl_no_results_is_inaccessible(tmp_path):
+    post = Post("slide4", "creator1", "slideshow", "https://www.tiktok.com/@c/photo/4", "caption", 1600000000)
+
+    class FakeJob:
+        def __init__(self, extr):
+            pass
+
+        def run(self):
+            import logging
+            # Another slideshow's job logging at the same time is not ours
+            logging.getLogger("tiktok").info("No results for another post", extra={"job": object()})
+            logging.getLogger("tiktok").info("No results for %s", post.url, extra={"job": self})
+            return 4
+
+    with patch.object(downloader.gdl_job, "DownloadJob", FakeJob):
+        with pytest.raises(PostInaccessibleError):
+            _download_slideshow_gallery_dl(post, str(tmp_path / "out"))
+
+
+def _fmt(format_id, vcodec, size_mb=None, **extra):
+    fmt = {'format_id': format_id, 'vcodec': vcodec, 'acodec': 'aac', 'url': f'https://cdn/{format_id}'}
+    if size_mb is not None:
+        fmt['filesize'] = int(size_mb * 1024 * 1024)
+    fmt.update(extra)
+    return fmt
+
+
+def test_choose_video_format_prefers_h264_under_limit():
+    # yt-dlp order, worst first
+    formats = [
+        _fmt('h264_540p', 'h264', 20),
+        _fmt('download_addr', 'h264', 30, format_note='Download video, watermarked', preference=-2),
+        _fmt('h264_720p', 'h264', 45),
+        _fmt('h264_1080p', 'h264', 80),
+        _fmt('bytevc1_1080p', 'h265', 35),
+    ]
+    chosen, reason = choose_video_format(formats, 50)
+    assert chosen['format_id'] == 'h264_720p'
+    assert 'H.264/AAC under the 50MB' in reason
+    # With the local Bot API the 1080p H.264 rendition fits
+    assert choose_video_format(formats, 2000)[0]['format_id'] == 'h264_1080p'
+
+
+def test_choose_video_format_fallbacks():
+    # Only HEVC fits: take it, one compatibility encode beats compression
+    formats = [_fmt('h264_1080p', 'h264', 90), _fmt('bytevc1_1080p', 'h265', 40)]
+    assert choose_video_format(formats, 50)[0]['format_id'] == 'bytevc1_1080p'
+    # Nothing fits: the smallest rendition needs the least compression
+    formats = [_fmt('a', 'h265', 70), _fmt('b', 'h264', 90), _fmt('c', 'h265', 120)]
+    chosen, reason = choose_video_format(formats, 50)
+    assert chosen['format_id'] == 'a' and 'compression' in reason
+    # Unplayable and audio-only renditions are never picked
+    formats = [_fmt('bytevc2', 'bytevc2', 10, preference=-100), _fmt('music', 'none', 1)]
+    assert choose_video_format(formats, 50)[0] is None
+
+
+def test_choose_video_format_respects_profile_resolution():
+    formats = [
+        _fmt('h264_540p', 'h264', 20, width=576, height=1024),
+        _fmt('h264_720p', 'h264', 30, width=720, height=1280),
+        _fmt('h264_1080p', 'h264', 45, width=1080, height=1920),
+    ]
+    assert choose_video_format(formats, 50)[0]['format_id'] == 'h264_1080p'
+    assert choose_video_format(formats, 50, max_resolution=720)[0]['format_id'] == 'h264_720p'
+    # Nothing small enough: keep choosing as before, the encode downscales
+    assert choose_video_format(formats, 50, max_resolution=360)[0]['format_id'] == 'h264_1080p'
+
+
+def test_reused_probe_info_does_not_keep_probe_format_selection():
+    import yt_dlp
+    from src.downloader import _reusable_probe_info, select_telegram_format
+    formats = [
+        _fmt('v', 'h264', 1, acodec='none', ext='mp4'),
+        _fmt('a', 'none', 0.1, ext='m4a'),
+        _fmt('m', 'h264', 2, ext='mp4'),
+    ]
+    probe = {'id': '1', 'title': 't', 'extractor': 'TikTok', 'extractor_key': 'TikTok',
+             'webpage_url': 'https://www.tiktok.com/@u/video/1', 'formats': formats}
+    with yt_dlp.YoutubeDL({'quiet': True, 'format': 'v+a'}) as ydl:
+        probed = ydl.process_ie_result(dict(probe), download=False)
+    assert [f['format_id'] for f in probed['requested_formats']] == ['v', 'a']
+
+    with yt_dlp.YoutubeDL({'quiet': True, 'format': select_telegram_format}) as ydl:
+        info = ydl.process_ie_result(_reusable_probe_info(probed), download=False)
+    # The download's own selection wins; nothing of the probe's v+a is merged
+    assert info['format_id'] == 'm'
+    assert 'requested_formats' not in info
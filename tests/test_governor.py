@@ -0,0 +1,30 @@
+import os
+import sys
+from unittest.mock import patch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.governor import ProcessGovernor, IONICE_IDLE
+
+
+def _which(name):
+    return f"/usr/bin/{name}"
+
+
+def test_wrap_prefixes_nice_and_ionice():
+    with patch("src.governor.shutil.which", side_effect=_which):
+        governor = ProcessGovernor(nice=10, ionice_level=7)
+        assert governor.wrap(["ffmpeg", "-i", "in.mp4"]) == [
+            "/usr/bin/ionice", "-c", "2", "-n", "7", "/usr/bin/nice", "-n", "10", "ffmpeg", "-i", "in.mp4",
+        ]
+        governor.configure(nice=0, ionice_class=IONICE_IDLE)
+        assert governor.wrap(["ffprobe", "x"]) == ["/usr/bin/ionice", "-c", "3", "ffprobe", "x"]
+
+
+def test_wrap_without_tools_runs_command_unchanged():
+    with patch("src.governor.shutil.which", return_value=None):
+        assert ProcessGovernor().wrap(["ffmpeg", "-version"]) == ["ffmpeg", "-version"]
+
+
+def test_wrap_leaves_missing_tool_unwrapped():
+    # nice/ionice installed, ffprobe not: nice would exit 127 instead of raising
+    with patch("src.governor.shutil.which", side_effect=lambda name: None if name == "ffprobe" else _which(name)):
+        assert ProcessGovernor().wrap(["ffprobe", "x"]) == ["ffprobe", "x"]
@@ -0,0 +1,92 @@
+import asyncio
+import importlib
+import os
+import sys
+from unittest.mock import MagicMock, patch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.tiktok_api import FetchedPosts
+
+
+def _import_main(tmp_path, monkeypatch):
+    # main.py logs to logs/run.log relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("logs", exist_ok=True)
+    return importlib.import_module("main")
+
+
+def _run_creator(main, listing):
+    state = MagicMock()
+    state.get_cursor.return_value = None
+    state.get_incomplete_uploads.return_value = []
+    cookie_manager = MagicMock(cookie_files=["a.txt", "b.txt"])
+    cookie_manager.get_current_cookie_path.return_value = "a.txt"
+    cookie_manager.rotate.return_value = "b.txt"
+    with patch.object(main, "fetch_posts", return_value=listing) as fetch:
+        asyncio.run(main.process_creator(
+            {"username": "creator1", "chat_id": "-100"}, {}, state, MagicMock(), cookie_manager, asyncio.Event(),
+        ))
+    return fetch, cookie_manager
+
+
+def test_fully_seen_listing_does_not_rotate_cookies(tmp_path, monkeypatch):
+    main = _import_main(tmp_path, monkeypatch)
+    fetch, cookie_manager = _run_creator(main, FetchedPosts([], listed=True))
+    assert fetch.call_count == 1
+    cookie_manager.rotate.assert_not_called()
+
+
+def test_empty_listing_retries_with_next_cookie(tmp_path, monkeypatch):
+    main = _import_main(tmp_path, monkeypatch)
+    fetch, cookie_manager = _run_creator(main, FetchedPosts([], listed=False))
+    assert fetch.call_count == 2
+    # Rotates from the cookie this creator used, and retries with the one it got back
+    cookie_manager.rotate.assert_called_once_with("a.txt")
+    assert fetch.call_args.kwargs["cookie_path"] == "b.txt"
+
+
+def test_daemon_runs_housekeeping_periodically(tmp_path, monkeypatch):
+    main = _import_main(tmp_path, monkeypatch)
+    monkeypatch.setattr(main, "HOUSEKEEPING_INTERVAL", 0)
+    scheduler = MagicMock()
+    scheduler.pop_due.return_value = []
+    scheduler.next_due_at.return_value = None
+    calls = []
+
+    async def run():
+        main._shutdown_event = asyncio.Event()
+
+        def housekeeping(state, settings):
+            calls.append(state)
+            if len(calls) == 2:
+                main._shutdown_event.set()
+
+        monkeypatch.setattr(main, "housekeeping", housekeeping)
+        await main.run_daemon([], {'daemon_max_sleep_seconds': 0.01}, "state", MagicMock(), MagicMock(), scheduler)
+
+    asyncio.run(run())
+    assert calls == ["state", "state"]
+
+
+def test_daemon_reloads_the_creators_file_it_was_given(tmp_path, monkeypatch):
+    main = _import_main(tmp_path, monkeypatch)
+    creators_file = tmp_path / "custom-creators.yaml"
+    creators_file.write_text("creators:\n  - username: creator1\n")
+    scheduler = MagicMock()
+    scheduler.next_due_at.return_value = None
+
+    def pop_due():
+        # Edited once the daemon has started
+        os.utime(creators_file, (1000, 1000))
+        return []
+
+    scheduler.pop_due.side_effect = pop_due
+
+    async def run():
+        main._shutdown_event = asyncio.Event()
+        scheduler.load.side_effect = lambda creators: main._shutdown_event.set()
+        await main.run_daemon([], {'daemon_max_sleep_seconds': 0.01}, "state", MagicMock(), MagicMock(), scheduler,
+                              creators_path=str(creators_file))
+
+    with patch.object(main, "load_creators", return_value=[{"username": "creator1"}]) as load_creators:
+        asyncio.run(run())
+    load_creators.assert_called_once_with(str(creators_file))
@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.core.state import StateStore
+from src.media_store import MediaStore, source_key
+
+
+@pytest.fixture
+def media(tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    return MediaStore(state, str(tmp_path / "media"))
+
+
+def _write(path, data: bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_source_key_ignores_signed_query():
+    a = source_key("https://p16.tiktokcdn.com/obj/music/abc.mp3?x-expires=1&sig=a", etag='"e1"')
+    b = source_key("https://p19.tiktokcdn.com/obj/music/abc.mp3?x-expires=2&sig=b", etag='"e1"')
+    assert a == b
+    assert source_key("https://cdn/obj/abc.mp3", size=10) != source_key("https://cdn/obj/abc.mp3", size=11)
+    assert source_key("https://cdn/obj/abc.mp3") is None
+
+
+def test_identical_files_share_one_blob(media, tmp_path):
+    first = media.adopt("post1", _write(tmp_path / "a" / "post1" / "audio.mp3", b"same track"))
+    second = media.adopt("post2", _write(tmp_path / "b" / "post2" / "audio.mp3", b"same track"))
+
+    assert os.path.samefile(first, second)
+    blobs = [f for _, _, files in os.walk(media.root) for f in files]
+    assert len(blobs) == 1
+
+
+def test_link_by_key_skips_download(media, tmp_path):
+    key = source_key("https://cdn/obj/track.mp3?sig=1", size=5)
+    media.adopt("post1", _write(tmp_path / "post1" / "audio.mp3", b"track"), key=key)
+
+    dest = str(tmp_path / "post2" / "audio.mp3")
+    os.makedirs(os.path.dirname(dest))
+    assert media.link_key(key, "post2", dest) == os.path.abspath(dest)
+    with open(dest, "rb") as f:
+        assert f.read() == b"track"
+    assert media.link_key(source_key("https://cdn/obj/other.mp3", size=5), "post2", dest) is None
+
+
+def test_release_keeps_blobs_still_referenced(media, tmp_path):
+    shared1 = media.adopt("post1", _write(tmp_path / "post1" / "audio.mp3", b"shared"))
+    only1 = media.adopt("post1", _write(tmp_path / "post1" / "1.jpg", b"image one"))
+    shared2 = media.adopt("post2", _write(tmp_path / "post2" / "audio.mp3", b"shared"))
+
+    assert media.release("post1") == 1
+    assert not os.path.exists(shared1) and not os.path.exists(only1)
+    with open(shared2, "rb") as f:
+        assert f.read() == b"shared"
+
+    assert media.release("post2") == 1
+    assert not [f for _, _, files in os.walk(media.root) for f in files]
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+Image = pytest.importorskip("PIL.Image")
+from src import photos
+from src.photos import PhotoNormalizer, plan_photo, PHOTO_MAX_DIMENSION_SUM
+
+
+def test_plan_photo_limits():
+    # Within the limits: unchanged
+    assert plan_photo(1080, 1920) == ((1080, 1920), (1080, 1920))
+    # Too large: scaled so width + height fits, aspect ratio kept
+    image, canvas = plan_photo(8000, 6000)
+    assert image == canvas and sum(image) <= PHOTO_MAX_DIMENSION_SUM
+    assert abs(image[0] / image[1] - 8000 / 6000) < 0.01
+    # Too narrow: padded to 20:1, not cropped
+    assert plan_photo(100, 3000) == ((100, 3000), (150, 3000))
+
+
+def test_normalize_converts_and_caches(tmp_path):
+    src = str(tmp_path / "slide.png")
+    Image.new("RGBA", (12000, 600), (255, 0, 0, 128)).save(src)
+    normalizer = PhotoNormalizer(str(tmp_path / "cache"), workers=2)
+
+    out = normalizer.normalize(src)
+    assert out.startswith(str(tmp_path / "cache")) and out.endswith(".jpg")
+    with Image.open(out) as img:
+        assert img.format == "JPEG" and img.mode == "RGB"
+        assert sum(img.size) <= PHOTO_MAX_DIMENSION_SUM and img.size[0] / img.size[1] <= 20
+
+    # A second upload reuses the conversion
+    mtime = os.path.getmtime(out)
+    os.utime(out, (mtime - 100, mtime - 100))
+    assert normalizer.normalize_all([src, src]) == [out, out]
+    with Image.open(out) as img:
+        assert img.format == "JPEG"
+    normalizer.shutdown()
+
+
+def test_compliant_jpeg_is_kept(tmp_path):
+    src = str(tmp_path / "slide.jpg")
+    Image.new("RGB", (1080, 1440), (0, 128, 0)).save(src, "JPEG")
+    normalizer = PhotoNormalizer(str(tmp_path / "cache"))
+    assert asyncio.run(normalizer.run([src])) == [src]
+    assert not os.path.exists(tmp_path / "cache")
+
+
+def test_unreadable_or_without_pillow_uploads_unchanged(tmp_path, monkeypatch):
+    normalizer = PhotoNormalizer(str(tmp_path / "cache"))
+    assert normalizer.normalize(str(tmp_path / "missing.webp")) == str(tmp_path / "missing.webp")
+    src = str(tmp_path / "slide.webp")
+    Image.new("RGB", (100, 100)).save(src, "WEBP")
+    monkeypatch.setattr(photos, "_PIL_AVAILABLE", False)
+    assert normalizer.normalize(src) == src
+
+
+def test_prune_drops_unused_cache_entries(tmp_path):
+    normalizer = PhotoNormalizer(str(tmp_path / "cache"))
+    old = tmp_path / "cache" / "ab" / "old.jpg"
+    fresh = tmp_path / "cache" / "cd" / "fresh.jpg"
+    for path in (old, fresh):
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"jpg")
+    os.utime(old, (0, 0))
+    assert normalizer.prune(3600) == 1
+    assert not old.exists() and fresh.exists()
@@ -0,0 +1,82 @@
+import threading
+import time
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.rate_limit import HostLimiter, TokenBucket, AIMDController
+
+
+def test_host_limiter_caps_concurrency():
+    limiter = HostLimiter(max_per_host=2)
+    active = []
+    peak = [0]
+    lock = threading.Lock()
+
+    def worker():
+        with limiter.slot("https://www.tiktok.com/@u/video/1"):
+            with lock:
+                active.append(1)
+                peak[0] = max(peak[0], len(active))
+            time.sleep(0.05)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert peak[0] == 2
+
+
+def test_token_bucket_spaces_requests_after_burst():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # Waiters queue up one 1/rate apart instead of all at once
+    assert abs(bucket.reserve() - 0.1) < 0.02
+    assert abs(bucket.reserve() - 0.2) < 0.02
+
+
+def test_token_bucket_pause_drains_budget():
+    bucket = TokenBucket(rate=10, burst=5)
+    bucket.pause(0.5)
+    assert abs(bucket.reserve() - 0.6) < 0.02
+
+
+def test_aimd_increases_additively_and_decreases_multiplicatively():
+    bucket = TokenBucket(rate=1.0, burst=5)
+    controller = AIMDController(bucket, min_rate=0.25, max_rate=1.2, increase=0.1, throttle_pause=0.05)
+
+    controller.on_success()
+    controller.on_success()
+    assert abs(bucket.rate - 1.2) < 1e-9
+    controller.on_success()
+    assert abs(bucket.rate - 1.2) < 1e-9  # capped at max_rate
+
+    assert controller.on_throttle() is True
+    assert abs(bucket.rate - 0.6) < 1e-9
+    # 429s from requests already in flight belong to the same event
+    assert controller.on_throttle() is False
+    assert abs(bucket.rate - 0.6) < 1e-9
+
+    time.sleep(0.06)
+    controller.on_throttle()
+    assert abs(bucket.rate - 0.3) < 1e-9
+    time.sleep(0.06)
+    controller.on_throttle()
+    assert abs(bucket.rate - 0.25) < 1e-9  # never below min_rate
+
+
+def test_aimd_classifies_error_messages():
+    bucket = TokenBucket(rate=2.0, burst=5)
+    controller = AIMDController(bucket, throttle_pause=0.01, block_pause=0.01)
+
+    assert controller.report_error("ERROR: Unable to download webpage: HTTP Error 404") is False
+    assert bucket.rate == 2.0
+    assert controller.report_error(Exception("HTTP Error 429: Too Many Requests")) is True
+    assert bucket.rate == 1.0
+    time.sleep(0.02)
+    assert controller.report_error("Your IP address is blocked from accessing this post") is True
+    assert bucket.rate == 0.5
@@ -0,0 +1,70 @@
+import sqlite3
+import pytest
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.core.state import StateStore
+from src.scheduler import PollScheduler, ewma_interval
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StateStore(str(tmp_path / "state.db"))
+
+
+def _add_posts(store, creator, timestamps):
+    conn = sqlite3.connect(store.db_path)
+    for i, ts in enumerate(timestamps):
+        conn.execute("INSERT INTO posts (post_id, creator, kind, source_url, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (f"{creator}-{i}", creator, "video", "url", ts))
+    conn.commit()
+    conn.close()
+
+
+def test_ewma_interval():
+    assert ewma_interval([100], 0.5) is None
+    assert ewma_interval([0, 100, 200], 0.5) == 100
+    # A long silence since the last post slows polling down
+    assert ewma_interval([0, 100, 200], 0.5, now=1200) == 550
+
+
+def test_active_creator_is_polled_more_often(store):
+    now = 1_000_000
+    _add_posts(store, "hourly", [now - 3600 * i for i in range(10)])
+    _add_posts(store, "monthly", [now - 30 * 86400 * i for i in range(1, 5)])
+    scheduler = PollScheduler(store, min_interval=600, max_interval=86400)
+
+    assert scheduler.interval_for("hourly", now=now) == 1800
+    assert scheduler.interval_for("monthly", now=now) == 86400
+    assert scheduler.interval_for("unknown", now=now) == 600
+
+
+def test_pop_due_orders_by_due_time(store):
+    now = 1_000_000
+    store.record_poll("a", now - 700)
+    store.record_poll("b", now - 60)
+    scheduler = PollScheduler(store, min_interval=600)
+    scheduler.load([{'username': 'a'}, {'username': 'b'}, {'username': 'c'}], now=now)
+
+    due = scheduler.pop_due(now=now)
+    assert [c['username'] for c in due] == ['a', 'c']
+    assert scheduler.next_due_at() == now - 60 + 600
+
+    scheduler.mark_polled('a', now=now)
+    assert scheduler.pop_due(now=now + 599) == [{'username': 'b'}]
+    assert scheduler.pop_due(now=now + 600) == [{'username': 'a'}]
+
+
+def test_defer_requeues_popped_creator(store):
+    now = 1_000_000
+    scheduler = PollScheduler(store, min_interval=600)
+    scheduler.load([{'username': 'a'}], now=now)
+
+    assert scheduler.pop_due(now=now) == [{'username': 'a'}]
+    assert scheduler.next_due_for('a') is None
+    assert scheduler.next_due_at() is None
+
+    scheduler.defer('a', 300, now=now)
+    assert scheduler.next_due_for('a') == now + 300
+    assert scheduler.pop_due(now=now + 299) == []
+    assert scheduler.pop_due(now=now + 300) == [{'username': 'a'}]
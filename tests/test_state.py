@@ -32,3 +32,61 @@ def test_is_processed_found_uploaded(store):
     conn.close()
     
     assert store.is_processed("id2") is True
+
+def test_filter_unseen(store):
+    conn = sqlite3.connect(store.db_path)
+    conn.execute("INSERT INTO posts (post_id, creator, kind, source_url, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                 ("up1", "creator1", "video", "url1", 1600000000))
+    conn.execute("INSERT INTO posts (post_id, creator, kind, source_url) VALUES (?, ?, ?, ?)",
+                 ("dl1", "creator1", "video", "url2"))
+    conn.commit()
+    conn.close()
+
+    assert store.filter_unseen(["up1", "dl1", "new1"]) == {"dl1", "new1"}
+    assert store.filter_unseen([]) == set()
+
+def test_probe_cache_roundtrip(store):
+    assert store.get_cached_probe("p1") is None
+    store.record_probe("p1", "slideshow", "https://tiktok.com/@u/photo/p1")
+    assert store.get_cached_probe("p1") == ("slideshow", "https://tiktok.com/@u/photo/p1")
+    assert store.get_cached_probes(["p1", "p2"]) == {"p1": ("slideshow", "https://tiktok.com/@u/photo/p1")}
+
+def test_probe_cache_ttl_eviction(store):
+    store.record_probe("p1", "video", "https://tiktok.com/@u/video/p1")
+    conn = sqlite3.connect(store.db_path)
+    conn.execute("UPDATE probe_cache SET probed_at = ?", (1600000000,))
+    conn.commit()
+    conn.close()
+
+    assert store.get_cached_probe("p1") is None
+    assert store.evict_expired_probes() == 1
+
+def test_cursor_falls_back_to_newest_uploaded(store):
+    assert store.get_cursor("creator1") is None
+    conn = sqlite3.connect(store.db_path)
+    conn.execute("INSERT INTO posts (post_id, creator, kind, source_url, created_at, uploaded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                 ("id1", "creator1", "video", "url1", 1000, 1600000000))
+    conn.execute("INSERT INTO posts (post_id, creator, kind, source_url, created_at, uploaded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                 ("id2", "creator1", "video", "url2", 2000, 1600000000))
+    conn.commit()
+    conn.close()
+
+    assert store.get_cursor("creator1") == ("id2", 2000)
+
+def test_cursor_only_advances(store):
+    store.update_cursor("creator1", "id2", 2000)
+    store.update_cursor("creator1", "id1", 1000)
+    assert store.get_cursor("creator1") == ("id2", 2000)
+    store.update_cursor("creator1", "id3", 3000)
+    assert store.get_cursor("creator1") == ("id3", 3000)
+
+
+def test_partial_download_records(store):
+    assert store.get_partial("p1", "/tmp/.1.part") is None
+    store.record_partial("p1", "/tmp/.1.part", "https://cdn/1", expected_size=100, etag='"abc"')
+    store.record_partial("p1", "/tmp/.2.part", "https://cdn/2")
+    assert store.get_partial("p1", "/tmp/.1.part") == {'url': "https://cdn/1", 'expected_size': 100, 'etag': '"abc"'}
+
+    store.clear_partials("p1")
+    assert store.get_partial("p1", "/tmp/.1.part") is None
+    assert store.get_partial("p1", "/tmp/.2.part") is None
@@ -3,7 +3,8 @@ from unittest.mock import AsyncMock, MagicMock, patch, ANY
 import sys
 import os
 
-from src.telegram_uploader import TelegramUploader
+from src.telegram_uploader import TelegramUploader, _has_video_stream
+from src.governor import ProcessGovernor
 from src.tiktok_api import Post
 
 @pytest.fixture
@@ -115,3 +116,28 @@ async def test_upload_small_file_no_compression(mock_run, mock_getsize, mock_sen
         # The 'video' arg is a file object in the real code, so we can't easily check path 
         # without more complex mocking. But the test passing means no exception occurred.
         assert mock_send_video.called
+
+
+def test_has_video_stream_assumes_video_without_ffprobe():
+    # nice/ionice installed, ffprobe not
+    def run(cmd, **kwargs):
+        if cmd[0] == "ffprobe":
+            raise FileNotFoundError("ffprobe")
+        return MagicMock(returncode=127, stdout="")
+
+    which = lambda name: None if name == "ffprobe" else f"/usr/bin/{name}"
+    with patch("src.governor.shutil.which", side_effect=which), \
+            patch("src.telegram_uploader.governor", ProcessGovernor()), \
+            patch("src.telegram_uploader.subprocess.run", side_effect=run):
+        assert _has_video_stream("video.mp4") is True
+
+
+def test_upload_time_compression_applies_encoding_profile(uploader, tmp_path):
+    from src.transcode import EncodingProfile
+    profile = EncodingProfile(max_resolution=720)
+    video = tmp_path / "v.mp4"
+    video.write_bytes(b"x")
+    with patch("src.telegram_uploader.get_duration", return_value=30.0), \
+            patch("src.telegram_uploader.compress_video", return_value=str(video)) as compress:
+        uploader._compress_video(str(video), profile=profile)
+    assert compress.call_args.kwargs["profile"] is profile
@@ -1,9 +1,10 @@
 import pytest
+import time
 from unittest.mock import patch, MagicMock
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from src.tiktok_api import fetch_posts, Post, sort_posts_chronologically
+from src.tiktok_api import fetch_posts, Post, sort_posts_chronologically, _take_listing, _classify_flat_entry, _classify_by_redirect
 
 
 def test_post_model():
@@ -19,10 +20,10 @@ def test_post_model():
     assert post.kind == "video"
 
 
-@patch('src.tiktok_api.yt_dlp.YoutubeDL')
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
 def test_fetch_posts_success(mock_ytdl):
     # Mock yt-dlp response
-    mock_instance = mock_ytdl.return_value.__enter__.return_value
+    mock_instance = mock_ytdl.return_value
     mock_instance.extract_info.return_value = {
         'entries': [
             {
@@ -46,10 +47,10 @@ def test_fetch_posts_success(mock_ytdl):
         assert posts[0].creator == 'creator1'
 
 
-@patch('src.tiktok_api.yt_dlp.YoutubeDL')
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
 def test_fetch_posts_slideshow_detection(mock_ytdl):
     # Mock yt-dlp response for slideshow
-    mock_instance = mock_ytdl.return_value.__enter__.return_value
+    mock_instance = mock_ytdl.return_value
     mock_instance.extract_info.return_value = {
         'entries': [
             {
@@ -79,10 +80,10 @@ def test_fetch_posts_slideshow_detection(mock_ytdl):
         assert posts[1].kind == 'slideshow'
 
 
-@patch('src.tiktok_api.yt_dlp.YoutubeDL')
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
 def test_fetch_posts_mixed_media_prioritization(mock_ytdl):
     # Mock mixed media (video metadata + playlist type)
-    mock_instance = mock_ytdl.return_value.__enter__.return_value
+    mock_instance = mock_ytdl.return_value
     mock_instance.extract_info.return_value = {
         'entries': [
             {
@@ -103,6 +104,155 @@ def test_fetch_posts_mixed_media_prioritization(mock_ytdl):
         assert posts[0].kind == 'video'
 
 
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_fetch_posts_skips_known_ids(mock_ytdl):
+    mock_instance = mock_ytdl.return_value
+    mock_instance.extract_info.return_value = {
+        'entries': [
+            {'id': 'old1', 'webpage_url': 'https://tiktok.com/@user/video/1', 'timestamp': 1600000000},
+            {'id': 'new1', 'webpage_url': 'https://tiktok.com/@user/video/2', 'timestamp': 1600000500},
+        ]
+    }
+
+    with patch('src.tiktok_api._probe_kind') as mock_probe:
+        mock_probe.return_value = 'video'
+
+        posts = fetch_posts("creator1", depth=10, filter_unseen=lambda ids: {'new1'})
+        assert [p.post_id for p in posts] == ['new1']
+        assert mock_probe.call_count == 1
+
+
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_fetch_posts_tells_nothing_new_from_empty_listing(mock_ytdl):
+    mock_instance = mock_ytdl.return_value
+    mock_instance.extract_info.return_value = {
+        'entries': [{'id': 'old1', 'webpage_url': 'https://tiktok.com/@user/video/1', 'timestamp': 1600000000}]
+    }
+    posts = fetch_posts("creator1", depth=10, filter_unseen=lambda ids: set())
+    assert posts == [] and posts.listed
+
+    mock_instance.extract_info.return_value = {'entries': []}
+    posts = fetch_posts("creator1", depth=10, filter_unseen=lambda ids: set())
+    assert posts == [] and not posts.listed
+
+
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_fetch_posts_uses_probe_cache(mock_ytdl):
+    mock_instance = mock_ytdl.return_value
+    mock_instance.extract_info.return_value = {
+        'entries': [
+            {'id': 'cached1', 'webpage_url': 'https://tiktok.com/@user/video/1', 'timestamp': 1600000000},
+            {'id': 'new1', 'webpage_url': 'https://tiktok.com/@user/video/2', 'timestamp': 1600000500},
+        ]
+    }
+    cache = MagicMock()
+    cache.get_cached_probes.return_value = {'cached1': ('slideshow', 'https://tiktok.com/@user/photo/1')}
+
+    with patch('src.tiktok_api._probe_kind') as mock_probe:
+        mock_probe.return_value = 'video'
+
+        posts = fetch_posts("creator1", depth=10, probe_cache=cache)
+        assert mock_probe.call_count == 1
+        assert posts[0].kind == 'slideshow'
+        assert posts[0].url == 'https://tiktok.com/@user/photo/1'
+        cache.record_probe.assert_called_once_with('new1', 'video', 'https://tiktok.com/@user/video/2')
+
+
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_fetch_posts_parallel_probe_keeps_listing_order(mock_ytdl):
+    mock_instance = mock_ytdl.return_value
+    mock_instance.extract_info.return_value = {
+        'entries': [
+            {'id': str(i), 'webpage_url': f'https://tiktok.com/@user/video/{i}', 'timestamp': 1600000000 + i}
+            for i in range(8)
+        ]
+    }
+
+    def slow_probe(url, *args, **kwargs):
+        # Earlier entries finish last
+        time.sleep(0.01 * (8 - int(url.rsplit('/', 1)[-1])))
+        return 'video'
+
+    with patch('src.tiktok_api._probe_kind', side_effect=slow_probe):
+        posts = fetch_posts("creator1", depth=10, probe_workers=4)
+        assert [p.post_id for p in posts] == [str(i) for i in range(8)]
+
+
+def test_classify_flat_entry():
+    assert _classify_flat_entry({}, 'https://tiktok.com/@u/photo/1') == 'slideshow'
+    assert _classify_flat_entry({'_type': 'playlist'}, 'https://tiktok.com/@u/video/1') == 'slideshow'
+    assert _classify_flat_entry({'formats': [{'vcodec': 'h264'}]}, 'https://tiktok.com/@u/video/1') == 'video'
+    # A bare /video/ URL is not conclusive: slideshows are listed under /video/ too
+    assert _classify_flat_entry({'_type': 'url'}, 'https://tiktok.com/@u/video/1') is None
+
+
+def test_classify_by_redirect():
+    session = MagicMock()
+    session.head.return_value = MagicMock(status_code=200, url='https://www.tiktok.com/@u/photo/1')
+    assert _classify_by_redirect('https://www.tiktok.com/@u/video/1', session) == 'slideshow'
+
+    session.head.return_value = MagicMock(status_code=200, url='https://www.tiktok.com/@u/video/1')
+    assert _classify_by_redirect('https://www.tiktok.com/@u/video/1', session) is None
+
+
+def test_classify_by_redirect_errors_do_not_raise_rate():
+    session = MagicMock()
+    with patch('src.tiktok_api.tiktok_rate') as rate:
+        for status in (403, 500, 503):
+            session.head.return_value = MagicMock(status_code=status, url='https://www.tiktok.com/@u/photo/1')
+            assert _classify_by_redirect('https://www.tiktok.com/@u/video/1', session) is None
+        rate.on_success.assert_not_called()
+        session.head.return_value = MagicMock(status_code=200, url='https://www.tiktok.com/@u/photo/1')
+        _classify_by_redirect('https://www.tiktok.com/@u/video/1', session)
+        rate.on_success.assert_called_once()
+
+
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_fetch_posts_redirect_tier_skips_probe(mock_ytdl):
+    mock_instance = mock_ytdl.return_value
+    mock_instance.extract_info.return_value = {
+        'entries': [{'id': '1', 'url': 'https://www.tiktok.com/@u/video/1', 'timestamp': 1600000000}]
+    }
+
+    with patch('src.tiktok_api._probe_kind') as mock_probe, \
+         patch('src.tiktok_api._classify_by_redirect', return_value='slideshow'):
+        posts = fetch_posts("u", depth=10, redirect_check=True)
+        assert mock_probe.call_count == 0
+        assert posts[0].kind == 'slideshow'
+        assert posts[0].url == 'https://www.tiktok.com/@u/photo/1'
+
+
+def test_take_listing_stops_at_cursor():
+    def listing():
+        yield {'id': 'pinned', 'timestamp': 100}  # old pinned post above the timeline
+        yield {'id': 'n2', 'timestamp': 900}
+        yield {'id': 'n1', 'timestamp': 800}
+        yield {'id': 'c', 'timestamp': 700}
+        raise AssertionError("paginated past the cursor")
+
+    taken, seen = _take_listing(listing(), depth=10, cursor=('c', 700))
+    assert [e['id'] for e in taken] == ['n2', 'n1'] and seen == 4
+
+
+@patch('src.ytdl_pool.yt_dlp.YoutubeDL')
+def test_fetch_posts_at_cursor_is_nothing_new(mock_ytdl):
+    # Nothing newer than the cursor: an empty result, but not a failed listing
+    mock_instance = mock_ytdl.return_value
+    mock_instance.extract_info.return_value = {
+        'entries': iter([{'id': str(i), 'timestamp': 1000 - i} for i in range(10)])
+    }
+    posts = fetch_posts("creator1", depth=10, cursor=('0', 1000))
+    assert posts == [] and posts.listed
+
+
+def test_take_listing_grows_past_depth_for_bursts():
+    entries = [{'id': str(i), 'timestamp': 1000 - i} for i in range(30)]
+
+    assert len(_take_listing(entries, depth=5)[0]) == 5
+    taken, _ = _take_listing(entries, depth=5, cursor=('20', 980), max_depth=50)
+    assert len(taken) == 20
+
+
 def test_sort_posts_chronologically():
     p1 = Post("1", "c1", "v", "u1", "cap1", 1000)
     p2 = Post("2", "c1", "v", "u2", "cap2", 500)
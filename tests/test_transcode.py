@@ -0,0 +1,259 @@
+import io
+import os
+import struct
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from unittest.mock import MagicMock, patch
+from src.transcode import (
+    EncodingProfile, MediaInfo, compress_video, encode_segmented, moov_before_mdat, plan_bitrate, plan_telegram_transcode,
+    prepare_for_telegram, segment_bounds, stream_encode, upload_limit_mb,
+)
+
+
+def _atoms(path, *names):
+    with open(path, "wb") as f:
+        for name in names:
+            f.write(struct.pack(">I4s", 16, name.encode()) + b"\0" * 8)
+    return str(path)
+
+
+def _info(**overrides):
+    values = dict(
+        path="/d/v.mp4", format_name="mov,mp4,m4a,3gp,3g2,mj2", duration=30.0, size=5_000_000,
+        video_codec="h264", pix_fmt="yuv420p", width=1080, height=1920, audio_codec="aac", faststart=True,
+    )
+    values.update(overrides)
+    return MediaInfo(**values)
+
+
+def test_moov_position(tmp_path):
+    assert moov_before_mdat(_atoms(tmp_path / "fast.mp4", "ftyp", "moov", "mdat")) is True
+    assert moov_before_mdat(_atoms(tmp_path / "slow.mp4", "ftyp", "mdat", "moov")) is False
+    assert moov_before_mdat(_atoms(tmp_path / "none.mp4", "ftyp")) is None
+
+
+def test_plan_telegram_transcode():
+    assert plan_telegram_transcode(_info())[0] == "none"
+    assert plan_telegram_transcode(_info(faststart=False))[0] == "remux"
+    assert plan_telegram_transcode(_info(path="/d/v.mkv", format_name="matroska,webm"))[0] == "remux"
+    assert plan_telegram_transcode(_info(audio_codec="opus"))[0] == "remux"
+    assert plan_telegram_transcode(_info(video_codec="hevc"))[0] == "encode"
+    assert plan_telegram_transcode(_info(video_codec="av1"))[0] == "encode"
+    assert plan_telegram_transcode(_info(pix_fmt="yuv420p10le"))[0] == "encode"
+    assert plan_telegram_transcode(_info(video_codec=None, pix_fmt=None))[0] == "encode"
+
+
+def test_compatible_download_is_not_transcoded(tmp_path):
+    from src.downloader import _transcode_to_telegram_mp4
+    video = tmp_path / "v.mp4"
+    video.write_bytes(b"x")
+    with patch("src.transcode.subprocess.run") as run, \
+            patch("src.transcode.probe_media", return_value=_info(path=str(video))):
+        assert _transcode_to_telegram_mp4(str(video)) == str(video)
+    # Only the `ffmpeg -version` availability check ran
+    assert run.call_count == 1
+
+
+def test_upload_limit_follows_local_api(monkeypatch):
+    monkeypatch.delenv("TELEGRAM_LOCAL_API", raising=False)
+    assert upload_limit_mb() == 50
+    monkeypatch.setenv("TELEGRAM_LOCAL_API", "1")
+    assert upload_limit_mb() == 2000
+
+
+def test_oversized_download_is_encoded_once(tmp_path):
+    video = tmp_path / "v.webm"
+    video.write_bytes(b"x" * 2048)
+
+    def fake_compress(src, target_mb, limit_mb, output_path, duration, threads, profile):
+        with open(output_path, "wb") as f:
+            f.write(b"y")
+        return output_path
+
+    # 2 KB against a 1 KB limit: straight to the size-targeted encode, no compatibility pass
+    with patch("src.transcode.subprocess.run") as run, \
+            patch("src.transcode.probe_media", return_value=_info(path=str(video), video_codec="vp9")), \
+            patch("src.transcode.compress_video", side_effect=fake_compress) as compress:
+        out = prepare_for_telegram(str(video), limit_mb=1 / 1024)
+    assert compress.call_count == 1
+    assert run.call_count == 1
+    assert out == str(tmp_path / "v.mp4")
+    assert (tmp_path / "v.mp4").read_bytes() == b"y"
+    # The source is replaced, not kept alongside the prepared file
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["v.mp4"]
+
+
+def test_prepare_relative_path_compresses_at_download_time(tmp_path, monkeypatch):
+    # yt-dlp hands over paths like downloads/<creator>/<id>.mp4, relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("downloads/creator1")
+    video = os.path.join("downloads", "creator1", "v.webm")
+    with open(video, "wb") as f:
+        f.write(b"x" * 2048)
+
+    def popen(cmd, **kwargs):
+        src = os.path.join(kwargs.get("cwd") or ".", cmd[cmd.index("-i") + 1])
+        assert os.path.exists(src), f"ffmpeg would not find {src}"
+        with open(os.path.join(kwargs.get("cwd") or ".", cmd[-1]), "wb") as f:
+            f.write(b"y")
+        return MagicMock(returncode=0, stdout=[])
+
+    with patch("src.transcode.subprocess.run"), \
+            patch("src.transcode.subprocess.Popen", side_effect=popen) as ffmpeg, \
+            patch("src.transcode.probe_media", return_value=_info(path=video, video_codec="vp9", duration=60.0)):
+        out = prepare_for_telegram(video, limit_mb=1 / 1024)
+    assert ffmpeg.call_count == 1
+    assert out == str(tmp_path / "downloads" / "creator1" / "v.mp4")
+    assert (tmp_path / "downloads" / "creator1" / "v.mp4").read_bytes() == b"y"
+
+
+def test_plan_bitrate_fits_budget():
+    video_kbps, audio_kbps, max_width = plan_bitrate(47.0, 60.0)
+    # 47MB over a minute leaves plenty of room: no downscale, full audio
+    assert (video_kbps + audio_kbps) * 60 / 8 / 1024 <= 47.0
+    assert audio_kbps == 128 and max_width is None
+
+    video_kbps, audio_kbps, max_width = plan_bitrate(47.0, 30 * 60.0)
+    assert audio_kbps == 64 and max_width == 480
+
+
+def test_encoding_profile_lowers_plan_and_requires_encode():
+    profile = EncodingProfile.from_dict({"max_resolution": 720, "video_bitrate_kbps": 1500, "audio_bitrate_kbps": 96})
+    video_kbps, audio_kbps, max_resolution = plan_bitrate(47.0, 60.0, profile)
+    assert (video_kbps, audio_kbps, max_resolution) == (1500, 96, 720)
+    # A tighter budget than the profile still wins
+    assert plan_bitrate(47.0, 30 * 60.0, profile)[1:] == (64, 480)
+
+    assert "1080p" in profile.requires_encode(_info())
+    assert profile.requires_encode(_info(width=720, height=1280, size=5_000_000)) is None
+    assert "kbps" in profile.requires_encode(_info(width=720, height=1280, size=20_000_000))
+
+
+def test_encoding_profile_rejects_unknown_options():
+    with pytest.raises(ValueError):
+        EncodingProfile.from_dict({"max_height": 720})
+
+
+def _fake_encoder(sizes):
+    """Popen stand-in writing one output per call, sized from `sizes` (MB)."""
+    calls = []
+
+    def popen(cmd, **kwargs):
+        calls.append(cmd)
+        with open(cmd[-1], "wb") as f:
+            f.truncate(int(sizes[len(calls) - 1] * 1024 * 1024))
+        return MagicMock(returncode=0, stdout=[])
+    return popen, calls
+
+
+def test_compress_video_hits_target_in_one_pass(tmp_path):
+    video = tmp_path / "v.mp4"
+    video.write_bytes(b"x")
+    popen, calls = _fake_encoder([40])
+    with patch("src.transcode.subprocess.Popen", side_effect=popen):
+        out = compress_video(str(video), 47.0, duration=120.0)
+    assert out == str(tmp_path / "v_compressed.mp4")
+    assert len(calls) == 1
+    expected_kbps = plan_bitrate(47.0, 120.0)[0]
+    assert calls[0][calls[0].index("-b:v") + 1] == f"{expected_kbps}k"
+
+
+def test_compress_video_corrects_miss_and_detects_plateau(tmp_path):
+    video = tmp_path / "v.mp4"
+    video.write_bytes(b"x")
+    popen, calls = _fake_encoder([60, 59.8])
+    with patch("src.transcode.subprocess.Popen", side_effect=popen):
+        out = compress_video(str(video), 47.0, duration=120.0)
+    assert out == str(video)
+    assert len(calls) == 2
+    first, second = (int(c[c.index("-b:v") + 1][:-1]) for c in calls)
+    assert second < first
+
+
+def test_segment_bounds_cut_at_keyframes():
+    keyframes = [0.0, 2.0, 95.0, 118.0, 205.0, 240.0, 300.0]
+    assert segment_bounds(keyframes, 360.0, 3) == [(0.0, 118.0), (118.0, 240.0), (240.0, None)]
+    # Cuts that would collapse onto the same keyframe are dropped
+    assert segment_bounds([0.0, 150.0], 360.0, 3) == [(0.0, 150.0), (150.0, None)]
+    assert segment_bounds([0.0], 360.0, 3) == [(0.0, None)]
+
+
+def _fake_segment_encoder(calls):
+    def popen(cmd, **kwargs):
+        calls.append(cmd)
+        with open(cmd[-1], "wb") as f:
+            f.write(b"seg")
+        return MagicMock(returncode=0, pid=None, **{"wait.return_value": 0})
+    return popen
+
+
+def test_long_video_is_encoded_as_parallel_segments(tmp_path):
+    video = tmp_path / "live.mp4"
+    video.write_bytes(b"x")
+    dst = tmp_path / "out.mp4"
+    calls = []
+    durations = {"000.mp4": 120.0, "001.mp4": 120.0, "002.mp4": 120.0, "audio.m4a": 360.0, "out.mp4": 360.0}
+    concat = []
+
+    def run_ffmpeg(cmd):
+        with open(cmd[cmd.index("-i") + 1]) as f:
+            concat.append(f.read())
+        dst.write_bytes(b"joined")
+        return True
+
+    with patch("src.transcode.subprocess.Popen", side_effect=_fake_segment_encoder(calls)), \
+            patch("src.transcode.keyframe_times", return_value=[0.0, 60.0, 120.0, 180.0, 240.0, 300.0]), \
+            patch("src.transcode._has_audio", return_value=True), \
+            patch("src.transcode.get_duration", side_effect=lambda p: durations[os.path.basename(p)]), \
+            patch("src.transcode._run_ffmpeg", side_effect=run_ffmpeg):
+        assert encode_segmented(str(video), str(dst), 360.0, ["-c:v", "libx264"], ["-c:a", "aac"], threads=3)
+
+    segments = [c for c in calls if "-an" in c]
+    assert [c[c.index("-ss") + 1] for c in segments] == ["0.000", "120.000", "240.000"]
+    assert all(c[c.index("-threads") + 1] == "1" for c in segments)
+    assert concat == ["file '000.mp4'\nfile '001.mp4'\nfile '002.mp4'\n"]
+    # Work files are cleaned up
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["live.mp4", "out.mp4"]
+
+
+def test_segment_duration_mismatch_falls_back(tmp_path):
+    video = tmp_path / "live.mp4"
+    video.write_bytes(b"x")
+    calls = []
+    with patch("src.transcode.subprocess.Popen", side_effect=_fake_segment_encoder(calls)), \
+            patch("src.transcode.keyframe_times", return_value=[0.0, 180.0]), \
+            patch("src.transcode._has_audio", return_value=False), \
+            patch("src.transcode.get_duration", return_value=100.0), \
+            patch("src.transcode._run_ffmpeg") as run:
+        assert not encode_segmented(str(video), str(tmp_path / "out.mp4"), 360.0, [], [], threads=2)
+    run.assert_not_called()
+    # Short videos are never split
+    assert not encode_segmented(str(video), str(tmp_path / "out.mp4"), 60.0, [], [], threads=8)
+
+
+def test_stream_encode_pipes_source_into_ffmpeg(tmp_path):
+    piped = io.BytesIO()
+    dst = tmp_path / "v.mp4"
+
+    def popen(cmd, **kwargs):
+        assert cmd[cmd.index("-i") + 1] == "pipe:0"
+        with open(cmd[-1], "wb") as f:
+            f.write(b"encoded")
+        proc = MagicMock(returncode=0, pid=None, **{"wait.return_value": 0})
+        proc.stdin.write.side_effect = piped.write
+        return proc
+
+    with patch("src.transcode.subprocess.Popen", side_effect=popen), \
+            patch("src.transcode.get_duration", return_value=30.0):
+        assert stream_encode(io.BytesIO(b"m" * 200_000), str(dst), 30.0, compress=True, limit_mb=50)
+    assert piped.getvalue() == b"m" * 200_000
+    # Only the final file is left on disk
+    assert [p.name for p in tmp_path.iterdir()] == ["v.mp4"]
+
+    # A truncated stream is rejected and leaves nothing behind
+    dst.unlink()
+    with patch("src.transcode.subprocess.Popen", side_effect=popen), \
+            patch("src.transcode.get_duration", return_value=12.0):
+        assert not stream_encode(io.BytesIO(b"m"), str(dst), 30.0, compress=False, limit_mb=50)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,64 @@
+import threading
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.transcode_pool import TranscodeScheduler, record_usage, PRIORITY_UPLOAD, PRIORITY_DOWNLOAD
+
+
+def test_jobs_run_by_priority():
+    scheduler = TranscodeScheduler(workers=1, threads_per_job=2)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def blocker(threads):
+        started.set()
+        release.wait(5)
+
+    def job(label, threads):
+        order.append((label, threads))
+
+    scheduler.submit(blocker)
+    assert started.wait(5)
+    # Queued while the only worker is busy: the upload job jumps the download jobs
+    futures = [
+        scheduler.submit(job, "download-1", priority=PRIORITY_DOWNLOAD),
+        scheduler.submit(job, "download-2", priority=PRIORITY_DOWNLOAD),
+        scheduler.submit(job, "upload", priority=PRIORITY_UPLOAD),
+    ]
+    assert scheduler.queue_depth() == 3
+    release.set()
+    for f in futures:
+        f.result(5)
+    scheduler.shutdown()
+    assert order == [("upload", 2), ("download-1", 2), ("download-2", 2)]
+
+
+def test_stats_and_errors():
+    scheduler = TranscodeScheduler(workers=2)
+
+    def encode(threads):
+        record_usage(1.5, 200_000)
+        return "out.mp4"
+
+    def broken(threads):
+        raise RuntimeError("ffmpeg exploded")
+
+    assert scheduler.submit(encode).result(5) == "out.mp4"
+    with pytest.raises(RuntimeError):
+        scheduler.submit(broken).result(5)
+    scheduler.shutdown()
+    stats = scheduler.stats()
+    assert stats["completed"] == 2
+    assert stats["cpu_seconds"] == 1.5
+    assert stats["peak_rss_kb"] == 200_000
+    assert stats["queued"] == 0 and stats["running"] == 0
+
+
+def test_defaults_follow_cpu_count(monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 16)
+    scheduler = TranscodeScheduler()
+    assert (scheduler.workers, scheduler.threads_per_job) == (4, 4)
+    scheduler.configure(workers=8)
+    assert scheduler.threads_per_job == 2
@@ -0,0 +1,57 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.ytdl_pool import YoutubeDLPool, TIKTOK_EXTRACTORS
+
+
+def test_pool_reuses_instance_per_profile_and_cookie(tmp_path):
+    pool = YoutubeDLPool()
+    opts = {'quiet': True, 'no_warnings': True}
+
+    with pool.borrow('probe', opts) as first:
+        pass
+    with pool.borrow('probe', opts) as second:
+        assert second is first
+        # Borrowed instances are exclusive
+        with pool.borrow('probe', opts) as third:
+            assert third is not first
+    with pool.borrow('probe', dict(opts, cookiefile=str(tmp_path / 'other.txt'))) as other_cookie:
+        assert other_cookie is not first
+    with pool.borrow('listing', opts) as other_profile:
+        assert other_profile is not first
+    pool.close_all()
+
+
+def test_pool_only_registers_tiktok_extractors():
+    pool = YoutubeDLPool()
+    with pool.borrow('download', {'quiet': True}, outtmpl='/tmp/%(id)s.%(ext)s') as ydl:
+        assert list(ydl._ies) == list(TIKTOK_EXTRACTORS)
+        assert ydl.params['outtmpl']['default'] == '/tmp/%(id)s.%(ext)s'
+    pool.close_all()
+
+
+def test_pool_reloads_replaced_cookie_file(tmp_path):
+    cookies = tmp_path / "cookies.txt"
+    cookies.write_text("# Netscape HTTP Cookie File\n")
+    opts = {'quiet': True, 'cookiefile': str(cookies)}
+    pool = YoutubeDLPool()
+    with pool.borrow('probe', opts) as first:
+        assert len(first.cookiejar) == 0
+
+    # The operator drops in a fresh cookie file
+    cookies.write_text(
+        "# Netscape HTTP Cookie File\n"
+        ".tiktok.com\tTRUE\t/\tTRUE\t4102444800\tsessionid\tfresh\n"
+    )
+    mtime = os.path.getmtime(cookies) + 10
+    os.utime(cookies, (mtime, mtime))
+
+    with pool.borrow('probe', opts) as second:
+        assert second is not first
+        assert [c.value for c in second.cookiejar] == ['fresh']
+    # Saving on close keeps the new cookies; the stale jar was never written back
+    pool.close_all()
+    assert "fresh" in cookies.read_text()
+    with pool.borrow('probe', opts) as third:
+        assert [c.value for c in third.cookiejar] == ['fresh']
+    pool.close_all()